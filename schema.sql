@@ -4,8 +4,22 @@ create table if not exists sync_states(
     pending boolean,
     priority integer,
     synced timestamp,
-    result varchar
+    result varchar,
+    fingerprint varchar,
+    claimed_by varchar,
+    claimed_until timestamp,
+    next_visit timestamp,
+    revisit_interval integer,
+    failures integer
 );
+ALTER TABLE sync_states ADD COLUMN IF NOT EXISTS fingerprint VARCHAR;
+ALTER TABLE sync_states ADD COLUMN IF NOT EXISTS claimed_by VARCHAR;
+ALTER TABLE sync_states ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMP;
+ALTER TABLE sync_states ADD COLUMN IF NOT EXISTS next_visit TIMESTAMP;
+ALTER TABLE sync_states ADD COLUMN IF NOT EXISTS revisit_interval INTEGER;
+ALTER TABLE sync_states ADD COLUMN IF NOT EXISTS failures INTEGER;
+-- Retry the syncs that failed before the revisit scheduler existed
+UPDATE sync_states SET next_visit = timezone('UTC', now()) WHERE next_visit IS NULL AND failures IS NULL AND (result = 'Parse error' OR result LIKE 'HTTP error%');
 
 create table if not exists users(
     user_id integer primary key,
@@ -73,3 +87,6 @@ CREATE INDEX IF NOT EXISTS users_user_ids ON users(user_id);
 CREATE INDEX IF NOT EXISTS comment_ids_storage_ids_ru_xyz ON comment_ids_storage(comment_id_ru, comment_id_xyz);
 CREATE INDEX IF NOT EXISTS comment_ids_storage_ids_xyz_ru ON comment_ids_storage(comment_id_xyz, comment_id_ru);
 CREATE INDEX IF NOT EXISTS user_settings_ids ON user_settings(id);
+CREATE INDEX IF NOT EXISTS sync_states_pending ON sync_states(priority DESC, post_id DESC) WHERE pending;
+CREATE INDEX IF NOT EXISTS sync_states_next_visit ON sync_states(next_visit) WHERE NOT pending;
+CREATE INDEX IF NOT EXISTS sync_states_synced ON sync_states(synced);
@@ -0,0 +1,56 @@
+#/usr/bin/env python3
+import re
+import timeit
+from typing import List, Tuple
+
+from ngk.html_util import normalize_text
+
+
+# html_util.normalize_text() before the single-pass rewrite, kept as the reference
+def normalize_text_legacy(s: str) -> str:
+    s = s.replace("&#13;", "")
+
+    res = ""
+    while True:
+        m = re.search(r'<a.*?data-cfemail="(.*?)">.*?</a>', s)
+        if not m:
+            break
+
+        encoded = bytes.fromhex(m.group(1))
+        key = encoded[0]
+        decoded = "".join([chr(c ^ key) for c in encoded[1:]])
+
+        res += s[:m.start()]
+        res += decoded
+        s = s[m.end():]
+
+    return res + s
+
+
+_EMAIL = '<a href="/cdn-cgi/l/email-protection" class="__cf_email__" data-cfemail="5a373b33361a3f223b372a363f74393537">[email&#160;protected]</a>'
+_LINE = 'Ну это уже давно не новость, пиши на <b>почту</b>.<br>&#13;\n'
+
+
+def _samples() -> List[Tuple[str, str]]:
+    return [
+        ('plain', _LINE.replace('&#13;', '') * 4),
+        ('cr', _LINE * 4),
+        ('email', _LINE + _EMAIL + _LINE),
+        ('email x200', (_LINE + _EMAIL) * 200),
+        ('email x2000', (_LINE + _EMAIL) * 2000),
+    ]
+
+
+def main() -> None:
+    for name, sample in _samples():
+        assert normalize_text(sample) == normalize_text_legacy(sample), name
+
+        number = max(1, 20000 // len(sample))
+        legacy = timeit.timeit(lambda: normalize_text_legacy(sample), number=number) / number
+        current = timeit.timeit(lambda: normalize_text(sample), number=number) / number
+        print(f'{name:>12}: {len(sample):>8} chars, legacy {legacy * 1e6:10.1f} us, '
+              f'current {current * 1e6:10.1f} us, x{legacy / current:.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+#/usr/bin/env python3
+import argparse
+import importlib
+import itertools
+import json
+import resource
+import sys
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence
+
+import lxml.etree
+
+from ngk import parser_ru, parser_xyz, xpath
+from ngk.dumps import DumpPage, iter_pages
+from ngk.parser import ParsedComment, ParsedPost
+
+
+ParserFunc = Callable[[bytes], Any]
+
+
+def parse_xyz(content: bytes) -> List[parser_xyz.CommentXyz]:
+    return parser_xyz.parse_comments(lxml.etree.HTML(content))
+
+
+# Candidates for the in-tree A/B switches
+def parse_sink_dom(content: bytes) -> List[ParsedComment]:
+    return parser_ru.parse_sink(content, streaming=False)
+
+
+def parse_post_string_xpath(content: bytes) -> ParsedPost:
+    precompiled = xpath.is_precompiled()
+    xpath.set_precompiled(False)
+    try:
+        return parser_ru.parse_post(content)
+    finally:
+        xpath.set_precompiled(precompiled)
+
+
+PARSERS: Dict[str, ParserFunc] = {
+    'post': parser_ru.parse_post,
+    'sink': parser_ru.parse_sink,
+    'xyz': parse_xyz,
+}
+
+
+def _count_comments(result: Any) -> int:
+    if isinstance(result, list):
+        return len(result)
+    return len(result.comments)
+
+
+def _results_equal(expected: Any, actual: Any) -> bool:
+    if isinstance(expected, list) and isinstance(actual, list):
+        if len(expected) != len(actual):
+            return False
+        for comment_expected, comment_actual in zip(expected, actual):
+            if isinstance(comment_expected, parser_xyz.CommentXyz) and isinstance(comment_actual, parser_xyz.CommentXyz):
+                # CommentXyz.__eq__ compares time_parsed too
+                comment_actual.time_parsed = comment_expected.time_parsed
+        return all(e == a for e, a in zip(expected, actual))
+    return bool(expected == actual)
+
+
+def _percentile(sorted_values: Sequence[float], percent: float) -> float:
+    if len(sorted_values) == 0:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(percent / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def load_parser(spec: str) -> ParserFunc:
+    if spec in PARSERS:
+        return PARSERS[spec]
+    module_name, _, func_name = spec.partition(':')
+    if not func_name:
+        raise ValueError(f'Invalid parser "{spec}": expected one of {list(PARSERS)} or module:function')
+    return getattr(importlib.import_module(module_name), func_name)
+
+
+def _max_rss_kb() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# Pages are read as they are parsed: the peak RSS is the parsers' memory, not the corpus'.
+# rss_increase_kb is the growth of the peak over the one before the run.
+def run(pages: Iterable[DumpPage],
+        parser: ParserFunc,
+        repeat: int = 1,
+        candidate: Optional[ParserFunc] = None) -> Dict[str, Any]:
+    timings: List[float] = []
+    page_count = 0
+    comments = 0
+    errors: List[str] = []
+    mismatches: List[str] = []
+    baseline_rss_kb = _max_rss_kb()
+
+    for page in pages:
+        page_count += 1
+        for _ in range(repeat):
+            started = time.perf_counter()
+            try:
+                result = parser(page.content)
+            except Exception as e:
+                errors.append(f'{page.name}: {e!r}')
+                break
+            timings.append(time.perf_counter() - started)
+        else:
+            comments += _count_comments(result)
+            if candidate is not None:
+                try:
+                    candidate_result = candidate(page.content)
+                except Exception as e:
+                    mismatches.append(f'{page.name}: {e!r}')
+                else:
+                    if not _results_equal(result, candidate_result):
+                        mismatches.append(page.name)
+
+    total = sum(timings)
+    timings.sort()
+    report: Dict[str, Any] = {
+        'pages': page_count,
+        'parsed': len(timings),
+        'comments': comments,
+        'errors': errors,
+        'total_sec': total,
+        'pages_per_sec': len(timings) / total if total > 0 else 0.0,
+        'comments_per_sec': comments * repeat / total if total > 0 else 0.0,
+        'p50_ms': _percentile(timings, 50) * 1000,
+        'p99_ms': _percentile(timings, 99) * 1000,
+        'peak_rss_kb': _max_rss_kb(),
+        'rss_increase_kb': _max_rss_kb() - baseline_rss_kb,
+    }
+    if candidate is not None:
+        report['mismatches'] = mismatches
+    return report
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description='Benchmark the NGK parsers on a corpus of dumped pages')
+    arg_parser.add_argument('paths', nargs='+', help='HTML files, dump folders or .tar.gz archives')
+    arg_parser.add_argument('--parser', default='post', help=f'One of {list(PARSERS)} or module:function')
+    arg_parser.add_argument('--candidate', help='module:function to compare against --parser on every page')
+    arg_parser.add_argument('--repeat', type=int, default=1, help='Parse every page this many times')
+    arg_parser.add_argument('--limit', type=int, help='Use at most this many pages')
+    arg_parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    args = arg_parser.parse_args()
+
+    parser = load_parser(args.parser)
+    candidate = load_parser(args.candidate) if args.candidate else None
+
+    pages = itertools.islice(iter_pages(args.paths), args.limit)
+    report = run(pages, parser, args.repeat, candidate)
+    report['parser'] = args.parser
+    report['candidate'] = args.candidate
+    report['repeat'] = args.repeat
+    report['python'] = sys.version.split()[0]
+    report['lxml'] = '.'.join(map(str, lxml.etree.LXML_VERSION))
+
+    serialized = json.dumps(report, ensure_ascii=False, indent=4)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(serialized)
+    else:
+        print(serialized)
+
+    if candidate is not None and len(report['mismatches']) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,20 +7,25 @@ import json
 import logging
 import re
 import secrets
-from typing import Dict, Optional, List, Set
+import time
+from typing import Any, Dict, Optional, List, Set, Tuple
 
 import flask
-from flask_socketio import SocketIO, close_room, join_room, leave_room
+from flask_socketio import SocketIO, emit, join_room, leave_room
 import redis
 import sqlalchemy.sql as sql
-from sqlalchemy.orm import aliased
+from sqlalchemy.orm import aliased, defaultload, noload
 from sqlalchemy.sql.expression import func
 from sqlalchemy_utils.functions import escape_like
 
+from ngk.comment_buffer import CommentBuffer
 from ngk.comments_processor import CommentsProcessor
-from ngk import config
+from ngk import config, wire
+from ngk.id_map import IdMap
 from ngk.log import get_logger, redirect_basic_logging
 from ngk.schema import Comment, DATE_FORMAT, Post, ScopedSession, SyncState, User
+from ngk.stats import FINGERPRINT_HITS, FINGERPRINT_MISSES, Stats, StatsBuffer
+from ngk.subscriptions import Subscription, SubscriptionIndex
 
 
 L = get_logger('api', logging.DEBUG)
@@ -31,6 +36,33 @@ USERS_AUTOCOMPLETE_LIMIT = 15
 COMMENTS_LIMIT = 20
 RESPONSE_PARENTS_LIMIT = 15
 IO_NAMESPACE = '/ngk'
+IO_BROADCAST_ROOM = 'comments'  # clients without a subscription, one emit per message
+# Clients that have not sent set_protocol (ngk.js cached before IO_PROTOCOL) get 'new_comments': a list of full comments
+IO_LEGACY_ROOM = 'comments_legacy'
+IO_PROTOCOL = 2  # 'comments_update': the JSON string {"new": [...], "updated": [...]}, updated comments may be deltas
+CATCH_UP_BUFFER_SIZE = 2000
+CATCH_UP_LIMIT = 500  # comments sent to a reconnecting client, the newest ones if it missed more
+STATS_FLUSH_INTERVAL = 5  # seconds
+
+stats = Stats(logger=L)
+# The socket handlers and the listener only count in memory: see stats_flusher()
+io_stats = StatsBuffer(stats)
+
+# Comments are serialized with to_dict(id_map) and queried without their comment_id_storage
+id_map = IdMap()
+NO_ID_STORAGE = noload(Comment.comment_id_storage)
+
+# The newest comments, for reconnecting socket clients (see io_set_max_id)
+comment_buffer = CommentBuffer(CATCH_UP_BUFFER_SIZE)
+
+with ScopedSession() as _session:
+    L.info(f'Loaded {id_map.load(_session)} ru-xyz comment id pairs')
+    _newest = _session.query(Comment).options(NO_ID_STORAGE) \
+        .order_by(Comment.comment_id.desc()) \
+        .limit(CATCH_UP_BUFFER_SIZE).all()
+    comment_buffer.load([c.to_dict(id_map) for c in reversed(_newest)],
+                        _newest[-1].comment_id - 1 if len(_newest) == CATCH_UP_BUFFER_SIZE else 0)
+    del _newest
 
 app = flask.Flask(__name__)
 app.secret_key = config.SECRET_KEY
@@ -62,9 +94,20 @@ def state() -> flask.Response:
         pending = session.query(SyncState.post_id).filter_by(pending=True).count()
         total = session.query(SyncState.post_id).count()
 
+    counters = stats.get_all()
     return flask.jsonify({
         "pending": pending,
         "total": total,
+        "fingerprint": {
+            "hits": counters.get(FINGERPRINT_HITS, 0),
+            "misses": counters.get(FINGERPRINT_MISSES, 0)
+        },
+        "poll": {key[len('poll_'):]: value for key, value in counters.items() if key.startswith('poll_')},
+        "fanout": {key[len('fanout_'):]: value for key, value in counters.items() if key.startswith('fanout_')},
+        "stream": {key[len('stream_'):]: value for key, value in counters.items() if key.startswith('stream_')},
+        "coalesce": {key[len('coalesce_'):]: value for key, value in counters.items() if key.startswith('coalesce_')},
+        "wire": {key[len('wire_'):]: value for key, value in counters.items() if key.startswith('wire_')},
+        "catch_up": {key[len('catch_up_'):]: value for key, value in counters.items() if key.startswith('catch_up_')},
         "thread": str(listener_thread)
     })
 
@@ -74,7 +117,7 @@ def comments() -> flask.Response:
     comment_id = flask.request.args.get('id')
 
     with ScopedSession() as session:
-        query = session.query(Comment)
+        query = session.query(Comment).options(NO_ID_STORAGE)
 
         if comment_id is not None:
             query = query.filter(Comment.comment_id == comment_id)
@@ -104,7 +147,7 @@ def comments() -> flask.Response:
         for comment in query.order_by(Comment.posted.desc()).limit(COMMENTS_LIMIT).all():
             comments.append(comment)
 
-        resp = app.make_response(json.dumps([c.to_dict() for c in comments], ensure_ascii=False))
+        resp = app.make_response(json.dumps([c.to_dict(id_map) for c in comments], ensure_ascii=False))
         resp = add_api_headers(resp)
         if comment_id is not None and len(comments) == 1:
             if comments[0].is_edit_expired():
@@ -150,13 +193,15 @@ def get_replies_to(user_id: Optional[int]=None, user_name: Optional[str]=None) -
             parent_ids.append(x[0])
             baseline_ids.add(x[1])
 
-        parents = session.query(Comment).filter(Comment.comment_id.in_(parent_ids)).all()
-        parents_dict = [comment.to_dict() for comment in parents]
+        parents = session.query(Comment) \
+            .options(NO_ID_STORAGE, defaultload(Comment.children).noload(Comment.comment_id_storage)) \
+            .filter(Comment.comment_id.in_(parent_ids)).all()
+        parents_dict = [comment.to_dict(id_map) for comment in parents]
         children = [comment for parent in parents for comment in parent.children]
         children_dict = []
 
         for child in children:
-            child_dict = child.to_dict()
+            child_dict = child.to_dict(id_map)
             child_dict['baseline'] = child.comment_id in baseline_ids
             children_dict.append(child_dict)
         
@@ -179,14 +224,14 @@ def replies_to_name(user_name: str) -> flask.Response:
 def post(post_id: int) -> flask.Response:
     no_comments: bool = flask.request.args.get('no_comments', False)
     with ScopedSession() as session:
-        post = session.query(Post).get(post_id)
+        post = session.query(Post).options(defaultload(Post.comments).noload(Comment.comment_id_storage)).get(post_id)
         resp = post.to_dict()
 
         comments = []
 
         if not no_comments:
             for comment in post.comments:
-                comments.append(comment.to_dict())
+                comments.append(comment.to_dict(id_map))
         resp['comments'] = comments
 
         resp = app.make_response(json.dumps(resp, ensure_ascii=False))
@@ -210,7 +255,7 @@ def search() -> flask.Response:
 
         user_name = flask.request.args.get('username', '')
         
-        query = session.query(Comment)
+        query = session.query(Comment).options(NO_ID_STORAGE)
         
         if len(q) > 0:
             if len(q) > 2 and q.startswith('"') and q.endswith('"'):
@@ -228,7 +273,7 @@ def search() -> flask.Response:
         
         query = query.order_by(Comment.posted.desc()).limit(SEARCH_LIMIT)
         for comment in query.all():
-            comments.append(comment.to_dict())
+            comments.append(comment.to_dict(id_map))
 
     resp = app.make_response(json.dumps(comments, ensure_ascii=False))
     return add_api_headers(resp)
@@ -300,22 +345,115 @@ def posts_info(posts_list: str) -> flask.Response:
 
 ###### SocketIO ######
 rooms: Dict[str, int] = {}
+subscriptions = SubscriptionIndex()
+protocol_clients: Set[str] = set()  # sent set_protocol with IO_PROTOCOL
 
 
 @io.on('connect', namespace=IO_NAMESPACE)
 def io_connect() -> None:
     L.debug(f'IO: {flask.request.sid} connected')
     rooms[flask.request.sid] = 0
-    join_room(flask.request.sid)
+    join_room(IO_LEGACY_ROOM)
 
 
 @io.on('disconnect', namespace=IO_NAMESPACE)
 def io_disconnect() -> None:
     L.debug(f'IO: {flask.request.sid} left')
-    close_room(flask.request.sid)
-    del rooms[flask.request.sid]
+    leave_room(IO_BROADCAST_ROOM)
+    leave_room(IO_LEGACY_ROOM)
+    rooms.pop(flask.request.sid, None)
+    protocol_clients.discard(flask.request.sid)
+    subscriptions.unsubscribe(flask.request.sid)
 
 
+# Sent by ngk.js right after connecting, before subscribe and set_max_id
+@io.on('set_protocol', namespace=IO_NAMESPACE)
+def io_set_protocol(version: Any) -> None:
+    L.debug(f'IO: set_protocol {flask.request.sid} -> {version}')
+    try:
+        version_int = int(version)
+    except (TypeError, ValueError):
+        return
+    if version_int < IO_PROTOCOL:
+        return
+    protocol_clients.add(flask.request.sid)
+    leave_room(IO_LEGACY_ROOM)
+    join_room(IO_BROADCAST_ROOM)
+
+
+# Replaces the client's filters: see ngk.subscriptions.Subscription for the fields. An empty subscription gets everything.
+# Only for the clients of IO_PROTOCOL.
+@io.on('subscribe', namespace=IO_NAMESPACE)
+def io_subscribe(data: Dict[str, Any]) -> None:
+    L.debug(f'IO: subscribe {flask.request.sid} -> {data}')
+    if flask.request.sid not in protocol_clients:
+        L.warning(f'IO: subscribe {flask.request.sid}: set_protocol was not sent')
+        return
+    try:
+        subscription = Subscription.from_dict(data or {})
+    except (AttributeError, TypeError, ValueError) as e:
+        L.warning(f'IO: subscribe {flask.request.sid}: invalid subscription: {e!r}')
+        return
+    if subscription == Subscription():
+        subscriptions.unsubscribe(flask.request.sid)
+    else:
+        subscriptions.subscribe(flask.request.sid, subscription)
+    if subscription.is_everything():
+        join_room(IO_BROADCAST_ROOM)
+    else:
+        leave_room(IO_BROADCAST_ROOM)
+
+
+# Comment id -> the user id of its parent's author, for "replies to" subscriptions
+def get_parent_user_ids(comments: List[Dict[str, Any]]) -> Dict[int, int]:
+    if not subscriptions.needs_parent_users():
+        return {}
+    parent_users: Dict[int, int] = {}
+    missing: Set[int] = set()
+    for comment in comments:
+        parent_id = comment['parent_id']
+        if parent_id is None:
+            continue
+        parent = comment_buffer.get(parent_id)
+        if parent is not None:
+            parent_users[parent_id] = parent['user_id']
+        else:
+            missing.add(parent_id)
+    if len(missing) > 0:
+        with ScopedSession() as session:
+            parent_users.update(session.query(Comment.comment_id, Comment.user_id).filter(Comment.comment_id.in_(missing)))
+    return {c['id']: parent_users[c['parent_id']] for c in comments if c['parent_id'] in parent_users}
+
+
+# Comments with id > max_id: from comment_buffer, and from the DB only for the part of the gap it has evicted.
+# If there are more than CATCH_UP_LIMIT, returns the newest ones and True: the client has to reload.
+def get_missed_comments(max_id: int) -> Tuple[List[Dict[str, Any]], bool]:
+    missed = comment_buffer.since(max_id)
+    if missed is not None:
+        io_stats.incr('catch_up_buffer')
+    else:
+        covered_from = comment_buffer.covered_from
+        missed = comment_buffer.since(covered_from) or []
+        older: List[Dict[str, Any]] = []
+        if len(missed) <= CATCH_UP_LIMIT:
+            # One more than fits: tells whether the gap is truncated
+            with ScopedSession() as session:
+                query = session.query(Comment).options(NO_ID_STORAGE) \
+                    .filter(Comment.comment_id > max_id) \
+                    .filter(Comment.comment_id <= covered_from) \
+                    .order_by(Comment.comment_id.desc()) \
+                    .limit(CATCH_UP_LIMIT - len(missed) + 1)
+                older = [c.to_dict(id_map) for c in reversed(query.all())]
+        missed = older + missed
+        io_stats.incr('catch_up_db')
+
+    if len(missed) > CATCH_UP_LIMIT:
+        io_stats.incr('catch_up_truncated')
+        return missed[-CATCH_UP_LIMIT:], True
+    return missed, False
+
+
+# Clients send set_max_id on every (re)connect and after each update they receive
 @io.on('set_max_id', namespace=IO_NAMESPACE)
 def io_set_max_id(max_id: str) -> None:
     L.debug(f'IO: set_max_id {flask.request.sid} -> {max_id}')
@@ -325,29 +463,131 @@ def io_set_max_id(max_id: str) -> None:
         max_id_int = 0
     rooms[flask.request.sid] = max_id_int
 
-
+    # A new client loads /comments by itself
+    if max_id_int <= 0:
+        return
+    missed, truncated = get_missed_comments(max_id_int)
+    missed = subscriptions.filter(flask.request.sid, missed, get_parent_user_ids(missed))
+    if len(missed) > 0 or truncated:
+        L.debug(f'IO: set_max_id {flask.request.sid}: sending {len(missed)} missed comments' + \
+                (' (truncated)' if truncated else ''))
+        if flask.request.sid in protocol_clients:
+            # truncated: older comments were missed too, the client reloads them with /comments
+            emit('comments_update', json.dumps({'new': missed, 'updated': [], 'truncated': truncated}, ensure_ascii=False))
+        elif len(missed) > 0:
+            emit('new_comments', missed)
+
+
+class FanoutStats:
+    def __init__(self) -> None:
+        self.messages = 0
+        self.max_emit_ms = 0.0
+
+    # emit_sec: time spent in io.emit; latency_sec: from CommentsProcessor.publish to the end of the emit
+    # targeted: the subscribed clients that got their own copy of the message
+    def record(self, comments: int, targeted: int, emit_sec: float, latency_sec: Optional[float]) -> None:
+        self.messages += 1
+        self.max_emit_ms = max(self.max_emit_ms, emit_sec * 1000)
+        values = {
+            'messages': self.messages,
+            'clients': len(rooms),
+            'subscribed': len(subscriptions),
+            'targeted': targeted,
+            'comments': comments,
+            'emit_ms': emit_sec * 1000,
+            'max_emit_ms': self.max_emit_ms,
+        }
+        if latency_sec is not None:
+            values['latency_ms'] = latency_sec * 1000
+        io_stats.set_many({'fanout_' + key: value for key, value in values.items()})
+
+
+fanout_stats = FanoutStats()
+
+
+# Updated comments for comment_buffer: deltas are applied to the buffered versions, or dropped
+def get_full_comments(comments: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    full_comments = []
+    for comment in comments:
+        if not wire.is_delta(comment):
+            full_comments.append(comment)
+            continue
+        buffered = comment_buffer.get(comment['id'])
+        patched = wire.apply_delta(buffered, comment) if buffered is not None else None
+        if patched is not None:
+            full_comments.append(patched)
+    return full_comments
+
+
+# Each message is decoded once (ngk.wire) and JSON encoded once for the broadcast room, then once per
+# distinct list of comments for the subscribed clients it matches. Clients parse the JSON themselves
+# and apply the deltas to the comments they have. Legacy clients get one list of full comments.
 def comments_listener(comments_processor: CommentsProcessor) -> None:
     L.debug('IO: CommentsListenerTask started')
     for message in comments_processor.listen():
         try:
-            update_event = json.loads(message, encoding='utf-8')
+            decode_start = time.perf_counter()
+            update_event = wire.decode(message)
+            io_stats.incr_many({
+                'wire_decoded': 1,
+                'wire_decoded_bytes': len(message),
+                'wire_decode_us': int((time.perf_counter() - decode_start) * 1e6),
+            })
             new_comments = update_event['new']
             updated_comments = update_event['updated']
+            id_map.update((c['id'], c['id_xyz']) for c in new_comments + updated_comments if c.get('id_xyz') is not None)
+            id_map.update(update_event.get('id_pairs', []))
+            full_updated_comments = get_full_comments(updated_comments)
+            comment_buffer.add(new_comments + full_updated_comments)
             L.debug(f'IO: CommentsListenerTask: Got {len(new_comments)} new comments and {len(updated_comments)} updated comments')
-            to_send = new_comments + updated_comments
-            for room in rooms.copy():
-                max_id = rooms[room]
-                L.debug(f'IO: CommentsListenerTask: Room {room}, max_id={max_id}, to_send -> {len(to_send)}')
-                if len(to_send) > 0:
-                    io.emit('new_comments',
-                            to_send,
-                            namespace=IO_NAMESPACE,
-                            room=room)
+            comments_count = len(new_comments) + len(updated_comments)
+            if comments_count == 0:
+                continue
+
+            emit_start = time.time()
+            comments = new_comments + updated_comments
+            fanout = subscriptions.route(comments, get_parent_user_ids(comments))
+            io.emit('new_comments', new_comments + full_updated_comments, namespace=IO_NAMESPACE, room=IO_LEGACY_ROOM)
+            io.emit('comments_update',
+                    json.dumps({'new': new_comments, 'updated': updated_comments}, ensure_ascii=False),
+                    namespace=IO_NAMESPACE,
+                    room=IO_BROADCAST_ROOM,
+                    skip_sid=list(fanout.skip) if len(fanout.skip) > 0 else None)
+
+            new_ids = {c['id'] for c in new_comments}
+            payloads: Dict[Tuple[int, ...], str] = {}
+            for sid, matched in fanout.targeted.items():
+                key = tuple(c['id'] for c in matched)
+                payload = payloads.get(key)
+                if payload is None:
+                    matched_new = [c for c in matched if c['id'] in new_ids]
+                    matched_updated = [c for c in matched if c['id'] not in new_ids]
+                    payload = payloads[key] = json.dumps({'new': matched_new, 'updated': matched_updated}, ensure_ascii=False)
+                io.emit('comments_update', payload, namespace=IO_NAMESPACE, room=sid)
+            emit_end = time.time()
+
+            published = update_event.get('published')
+            fanout_stats.record(comments_count,
+                                len(fanout.targeted),
+                                emit_end - emit_start,
+                                emit_end - published if published is not None else None)
         except:
             L.exception('IO: CommentsListenerTask: exception')
     L.warning('IO: CommentsListenerTask: exiting')
 
 
+# Writes io_stats and the stream metrics to Redis every STATS_FLUSH_INTERVAL, off the listener's path
+def stats_flusher(comments_processor: CommentsProcessor) -> None:
+    while True:
+        io.sleep(STATS_FLUSH_INTERVAL)
+        try:
+            if comments_processor.stream:
+                io_stats.set_many({'stream_' + key: value for key, value in comments_processor.get_stream_metrics().items()})
+            io_stats.flush()
+        except:
+            L.exception('IO: stats_flusher: exception')
+
+
 comments_processor = CommentsProcessor(config.REDIS_HOST,
                                        config.REDIS_PORT,
                                        config.REDIS_PASSWORD,
@@ -356,4 +596,5 @@ comments_processor = CommentsProcessor(config.REDIS_HOST,
 comments_processor.subscribe()
 L.debug('IO: starting CommentsListenerTask')
 listener_thread = io.start_background_task(comments_listener, comments_processor)
+io.start_background_task(stats_flusher, comments_processor)
 L.debug('IO: started a listener_thread: ' + str(listener_thread))
@@ -0,0 +1,93 @@
+#/usr/bin/env python3
+import argparse
+import logging
+import re
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional, Tuple
+
+import sqlalchemy.sql as sql
+from sqlalchemy import Integer
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from sqlalchemy.sql.expression import func
+
+from ngk.log import get_logger, redirect_basic_logging
+from ngk.schema import ScopedSession, SyncState
+
+
+L = get_logger('backfill', logging.INFO)
+redirect_basic_logging(L)
+
+_RE_RANGE = re.compile(r'(\d+)\s*-\s*(\d+)')
+
+
+# "26440", "1-30000", "1,5,7-9"
+def parse_ids(specs: Iterable[str]) -> List[int]:
+    ids = set()
+    for spec in specs:
+        for part in spec.split(','):
+            part = part.strip()
+            if not part:
+                continue
+            m = _RE_RANGE.fullmatch(part)
+            if m is not None:
+                start, end = int(m.group(1)), int(m.group(2))
+                if start > end:
+                    raise ValueError(f'Invalid range: {part}')
+                ids.update(range(start, end + 1))
+            elif part.isdigit():
+                ids.add(int(part))
+            else:
+                raise ValueError(f'Invalid post id: {part}')
+    return sorted(ids)
+
+
+# Marks the posts as pending in a single INSERT ... ON CONFLICT, creating the missing sync_states.
+# Posts synced after now - skip_synced_within are left alone. Returns (enqueued, skipped).
+def enqueue(post_ids: List[int],
+            skip_synced_within: Optional[timedelta] = None,
+            priority: int = SyncState.PRIORITY_DUMP) -> Tuple[int, int]:
+    if len(post_ids) == 0:
+        return 0, 0
+    table = SyncState.__table__
+
+    ids = sql.select([
+        func.unnest(sql.bindparam('post_ids', post_ids, type_=ARRAY(Integer))).label('post_id'),
+        sql.true().label('pending'),
+        sql.literal(priority, Integer).label('priority'),
+    ])
+    stmt = insert(table).from_select(['post_id', 'pending', 'priority'], ids)
+
+    # Do not demote posts that are already waiting with a higher priority (e.g. new comments)
+    new_priority = sql.case([(table.c.pending == True, func.greatest(table.c.priority, stmt.excluded.priority))],
+                            else_=stmt.excluded.priority)
+    where = None
+    if skip_synced_within is not None:
+        where = sql.or_(table.c.synced == None, table.c.synced < datetime.utcnow() - skip_synced_within)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.post_id],
+        set_={'pending': True, 'priority': new_priority},
+        where=where
+    ).returning(table.c.post_id)
+
+    with ScopedSession() as session:
+        enqueued = len(session.execute(stmt).fetchall())
+    return enqueued, len(post_ids) - enqueued
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description='Enqueue posts for fetch_posts. Pacing is left to the fetcher.')
+    arg_parser.add_argument('ids', nargs='+', help='Post ids and ranges: 26440 1-30000 1,5,7-9')
+    arg_parser.add_argument('--skip-synced-within', type=float, metavar='HOURS',
+                            help='Skip posts synced less than this many hours ago')
+    arg_parser.add_argument('--priority', type=int, default=SyncState.PRIORITY_DUMP, help='sync_states priority')
+    args = arg_parser.parse_args()
+
+    post_ids = parse_ids(args.ids)
+    max_age = timedelta(hours=args.skip_synced_within) if args.skip_synced_within is not None else None
+    enqueued, skipped = enqueue(post_ids, max_age, args.priority)
+    L.info(f'{len(post_ids)} posts: {enqueued} enqueued, {skipped} skipped')
+    print(f'{enqueued} enqueued, {skipped} skipped')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from ngk import wire
+from ngk.log import get_logger
+
+
+L = get_logger('coalescer', logging.INFO)
+
+Comment = Dict[str, Any]  # Comment.to_dict()
+Publish = Callable[[List[Comment], List[Comment]], None]
+
+
+# Buffers comment updates for up to `window` seconds after the first one, or until `max_batch`
+# comments are waiting, and publishes them as one message. A comment seen several times is
+# sent once, in its latest version, and stays new if any of the merged updates had it as new.
+# Deltas (ngk.wire) are applied to the buffered version of their comment.
+class Coalescer:
+    def __init__(self,
+                 publish: Publish,
+                 window: float,
+                 max_batch: int,
+                 on_flush: Optional[Callable[[Dict[str, int]], None]] = None,
+                 logger: logging.Logger = L):
+        self.publish = publish
+        self.window = window
+        self.max_batch = max_batch
+        self.on_flush = on_flush
+        self.logger = logger
+        self._new: Dict[int, Comment] = {}
+        self._updated: Dict[int, Comment] = {}
+        self._events = 0
+        self._merged = 0
+        self._first_added: Optional[float] = None
+        self._lock = threading.Lock()
+        self._publish_lock = threading.Lock()  # keeps the messages in order
+        self._wakeup = threading.Condition(self._lock)
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, new_comments: List[Comment], updated_comments: List[Comment]) -> None:
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Coalescer is closed')
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='coalescer', daemon=True)
+                self._thread.start()
+            for comment in new_comments:
+                if comment['id'] in self._new or self._updated.pop(comment['id'], None) is not None:
+                    self._merged += 1
+                self._new[comment['id']] = comment
+            for comment in updated_comments:
+                pending = self._new if comment['id'] in self._new else self._updated
+                buffered = pending.get(comment['id'])
+                if buffered is not None:
+                    self._merged += 1
+                    if wire.is_delta(comment):
+                        comment = wire.apply_delta(buffered, comment) or buffered
+                pending[comment['id']] = comment
+            self._events += 1
+            if self._first_added is None:
+                self._first_added = time.monotonic()
+                self._wakeup.notify()
+            full = len(self._new) + len(self._updated) >= self.max_batch
+        if full:
+            self.flush()
+
+    def flush(self) -> None:
+        with self._publish_lock:
+            with self._lock:
+                if self._first_added is None:
+                    return
+                new_comments = list(self._new.values())
+                updated_comments = list(self._updated.values())
+                counters = {
+                    'coalesce_events': self._events,
+                    'coalesce_messages': 1,
+                    'coalesce_merged': self._merged,
+                    'coalesce_delay_us': int((time.monotonic() - self._first_added) * 1e6),
+                }
+                self._new = {}
+                self._updated = {}
+                self._events = 0
+                self._merged = 0
+                self._first_added = None
+            self.publish(new_comments, updated_comments)
+            if self.on_flush is not None:
+                self.on_flush(counters)
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                while self._first_added is None and not self._closed:
+                    self._wakeup.wait()
+                if self._closed:
+                    return
+                delay = self._first_added + self.window - time.monotonic()
+                if delay > 0:
+                    self._wakeup.wait(delay)
+                    continue
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.exception(e)
+
+    # Publishes what is left
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            self._wakeup.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
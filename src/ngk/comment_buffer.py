@@ -0,0 +1,50 @@
+import bisect
+from typing import Any, Dict, Iterable, List, Optional
+
+
+# The most recent serialized comments (Comment.to_dict()) ordered by id, for socket clients
+# that catch up after a reconnect. Every comment with id > covered_from that the buffer
+# was fed is in it: the smallest ids are evicted first and raise covered_from.
+class CommentBuffer:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.covered_from = 0
+        self._ids: List[int] = []
+        self._comments: Dict[int, Dict[str, Any]] = {}
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    # `comments` must be all the comments with id > covered_from, e.g. the newest ones from the DB
+    def load(self, comments: Iterable[Dict[str, Any]], covered_from: int) -> None:
+        self.covered_from = covered_from
+        self._ids = []
+        self._comments = {}
+        self.add(comments)
+
+    def add(self, comments: Iterable[Dict[str, Any]]) -> None:
+        for comment in comments:
+            comment_id = comment['id']
+            if comment_id <= self.covered_from:
+                continue
+            if comment_id not in self._comments:
+                bisect.insort(self._ids, comment_id)
+            self._comments[comment_id] = comment
+        excess = len(self._ids) - self.capacity
+        if excess > 0:
+            for comment_id in self._ids[:excess]:
+                del self._comments[comment_id]
+            self.covered_from = self._ids[excess - 1]
+            del self._ids[:excess]
+
+    def get(self, comment_id: int) -> Optional[Dict[str, Any]]:
+        return self._comments.get(comment_id)
+
+    def covers(self, max_id: int) -> bool:
+        return max_id >= self.covered_from
+
+    # Comments with id > max_id in ascending id order; None if some of them may have been evicted
+    def since(self, max_id: int) -> Optional[List[Dict[str, Any]]]:
+        if not self.covers(max_id):
+            return None
+        return [self._comments[comment_id] for comment_id in self._ids[bisect.bisect_right(self._ids, max_id):]]
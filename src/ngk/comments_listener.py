@@ -13,7 +13,8 @@ def main() -> None:
                                 config.REDIS_PORT,
                                 config.REDIS_PASSWORD,
                                 config.REDIS_CHANNEL,
-                                L)
+                                L,
+                                group='comments_listener')
     processor.subscribe()
     for x in processor.listen():
         print(len(x))
@@ -1,29 +1,81 @@
-import json
 import logging
-from typing import List, Iterator, Dict
+import socket
+import time
+from typing import Any, Collection, Dict, List, Iterator, Optional, Tuple
 
 import redis
 
+from ngk import config, wire
+from ngk.coalescer import Coalescer
 from ngk.log import get_logger
 from ngk.schema import Comment
+from ngk.stats import Stats
 
 
 L = get_logger('comments_processor', logging.INFO)
 
+STREAM_READ_COUNT = 100
+STREAM_BLOCK_MS = 5000
+STREAM_FIELD = b'data'
+
+
+def _stream_id_ms(stream_id: bytes) -> int:
+    return int(stream_id.split(b'-', 1)[0])
+
+
+# Publishes comment updates with PUBLISH (fire-and-forget) or, with `stream`, appends them to
+# a capped Redis stream. Stream readers belong to a consumer group, whose position is kept
+# by Redis: after a restart a consumer gets its unacknowledged entries first, then everything
+# added since. Every API instance needs its own group: entries are split between the consumers of one group.
+# With coalesce_ms, updates are merged and published by a ngk.coalescer.Coalescer: call close() before exiting.
+# Deltas are published only with wire_version 2: listeners of version 1 messages expect whole comments.
 class CommentsProcessor:
-    def __init__(self, redis_host: str, redis_port: int, redis_password: str, redis_channel: str, logger: logging.Logger = L):
+    def __init__(self, redis_host: str, redis_port: int, redis_password: str, redis_channel: str, logger: logging.Logger = L,
+                 stream: bool = config.REDIS_STREAM,
+                 stream_key: str = config.REDIS_PREFIX + 'comments',
+                 stream_maxlen: int = config.REDIS_STREAM_MAXLEN,
+                 group: str = config.REDIS_STREAM_GROUP,
+                 consumer: Optional[str] = None,
+                 redis_db: int = config.REDIS_DB,
+                 coalesce_ms: int = config.PUBLISH_COALESCE_MS,
+                 coalesce_max_batch: int = config.PUBLISH_COALESCE_MAX_BATCH,
+                 deltas: bool = config.PUBLISH_DELTAS,
+                 wire_version: int = config.WIRE_FORMAT_VERSION):
         self.logger = logger
-        self.redis = redis.Redis(host=redis_host, port=redis_port, password=redis_password)
+        self.redis = redis.Redis(host=redis_host, port=redis_port, password=redis_password, db=redis_db)
         self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
         self.channel = redis_channel
+        self.stream = stream
+        self.stream_key = stream_key
+        self.stream_maxlen = stream_maxlen
+        self.group = group
+        self.consumer = consumer or socket.gethostname()
+        self.last_delivered_id: Optional[bytes] = None
+        self.stats = Stats(redis_host, redis_port, redis_password, redis_db, logger=logger)
+        self.wire_version = wire_version
+        self.deltas = deltas and wire_version >= wire.VERSION_COMPACT
+        self.coalescer: Optional[Coalescer] = None
+        if coalesce_ms > 0:
+            self.coalescer = Coalescer(self.publish, coalesce_ms / 1000, coalesce_max_batch, self.stats.incr_many, logger)
 
     def subscribe(self) -> None:
-        self.pubsub.subscribe(self.channel)
-    
+        if self.stream:
+            try:
+                self.redis.xgroup_create(self.stream_key, self.group, id='$', mkstream=True)
+            except redis.ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+        else:
+            self.pubsub.subscribe(self.channel)
+
     def unsubscribe(self) -> None:
-        self.pubsub.unsubscribe(self.channel)
+        if not self.stream:
+            self.pubsub.unsubscribe(self.channel)
 
     def listen(self) -> Iterator[bytes]:
+        if self.stream:
+            yield from self._listen_stream()
+            return
         for msg in self.pubsub.listen():
             try:
                 data = msg['data']
@@ -31,16 +83,82 @@ class CommentsProcessor:
                 continue
             else:
                 yield data
-    
-    def on_comments_update(self, new_comments: List[Comment], updated_comments: List[Comment]) -> None:
+
+    # An entry is acknowledged when the caller asks for the next one, i.e. once it is processed
+    def _listen_stream(self) -> Iterator[bytes]:
+        start_id = b'0'  # this consumer's pending entries, left by a crash or restart
+        while True:
+            response = self.redis.xreadgroup(self.group,
+                                             self.consumer,
+                                             {self.stream_key: start_id},
+                                             count=STREAM_READ_COUNT,
+                                             block=STREAM_BLOCK_MS if start_id == b'>' else None)
+            entries = response[0][1] if response else []
+            if start_id != b'>' and len(entries) == 0:
+                start_id = b'>'
+                continue
+            for entry_id, fields in entries:
+                self.last_delivered_id = entry_id
+                if fields is not None and STREAM_FIELD in fields:
+                    yield fields[STREAM_FIELD]
+                self.redis.xack(self.stream_key, self.group, entry_id)
+            if start_id != b'>' and len(entries) > 0:
+                start_id = entries[-1][0]
+
+    # length: entries kept in the stream; pending: delivered, not acknowledged;
+    # lag: entries not delivered yet (Redis >= 7); lag_ms: age of the last delivered entry
+    def get_stream_metrics(self) -> Dict[str, float]:
+        metrics: Dict[str, float] = {'length': self.redis.xlen(self.stream_key)}
+        for group in self.redis.xinfo_groups(self.stream_key):
+            if group['name'] in (self.group, self.group.encode('utf-8')):
+                metrics['pending'] = group['pending']
+                if group.get('lag') is not None:
+                    metrics['lag'] = group['lag']
+        if self.last_delivered_id is not None:
+            metrics['lag_ms'] = time.time() * 1000 - _stream_id_ms(self.last_delivered_id)
+        return metrics
+
+    # changed_fields: the Comment.to_dict() fields that changed in all of updated_comments, None if unknown
+    def on_comments_update(self,
+                           new_comments: List[Comment],
+                           updated_comments: List[Comment],
+                           changed_fields: Optional[Collection[str]] = None) -> None:
         self.logger.debug(f'Listener: got {len(new_comments)} new comments and {len(updated_comments)} updated comments')
-        published_to = self.redis.publish(
-            self.channel,
-            json.dumps(
-                {
-                    'new': [comment.to_dict() for comment in new_comments],
-                    'updated': [comment.to_dict() for comment in updated_comments],
-                }
-                , ensure_ascii=False).encode('utf-8')
-        )
-        self.logger.debug(f'Listener: published to {published_to} channels')
+        # Serialized now: the comments are bound to the caller's session
+        new_dicts = [comment.to_dict() for comment in new_comments]
+        updated_dicts = [comment.to_dict() for comment in updated_comments]
+        if self.deltas and changed_fields is not None:
+            version = time.time()
+            updated_dicts = [wire.make_delta(comment, changed_fields, version) for comment in updated_dicts]
+        if self.coalescer is not None:
+            self.coalescer.add(new_dicts, updated_dicts)
+        else:
+            self.publish(new_dicts, updated_dicts)
+
+    # ru-xyz id pairs of comments the listeners may not have (not in the DB yet): published at once, on their own
+    def on_id_pairs(self, id_pairs: List[Tuple[int, int]]) -> None:
+        self.logger.debug(f'Listener: got {len(id_pairs)} id pairs')
+        if len(id_pairs) > 0:
+            self.publish([], [], id_pairs)
+
+    def close(self) -> None:
+        if self.coalescer is not None:
+            self.coalescer.close()
+
+    def publish(self,
+                new_dicts: List[Dict[str, Any]],
+                updated_dicts: List[Dict[str, Any]],
+                id_pairs: Optional[List[Tuple[int, int]]] = None) -> None:
+        encode_start = time.perf_counter()
+        data = wire.encode(new_dicts, updated_dicts, time.time(), self.wire_version, id_pairs=id_pairs)
+        self.stats.incr_many({
+            'wire_encoded': 1,
+            'wire_encoded_bytes': len(data),
+            'wire_encode_us': int((time.perf_counter() - encode_start) * 1e6),
+        })
+        if self.stream:
+            entry_id = self.redis.xadd(self.stream_key, {STREAM_FIELD: data}, maxlen=self.stream_maxlen, approximate=True)
+            self.logger.debug(f'Listener: added {entry_id!r} to {self.stream_key}')
+        else:
+            published_to = self.redis.publish(self.channel, data)
+            self.logger.debug(f'Listener: published to {published_to} channels')
@@ -26,10 +26,32 @@ REDIS_PASSWORD: str = config('REDIS_PASSWORD')
 REDIS_CHANNEL: str = config('REDIS_CHANNEL')
 REDIS_DB: int = config('REDIS_DB', cast=int)
 REDIS_PREFIX: str = config('REDIS_PREFIX')
+REDIS_STREAM: bool = config('REDIS_STREAM', default=False, cast=bool)  # comment updates through a stream instead of REDIS_CHANNEL
+REDIS_STREAM_MAXLEN: int = config('REDIS_STREAM_MAXLEN', default=10000, cast=int)
+REDIS_STREAM_GROUP: str = config('REDIS_STREAM_GROUP', default='ngk-api')  # one per API instance
+PUBLISH_COALESCE_MS: int = config('PUBLISH_COALESCE_MS', default=0, cast=int)  # 0: publish every update at once
+PUBLISH_COALESCE_MAX_BATCH: int = config('PUBLISH_COALESCE_MAX_BATCH', default=500, cast=int)  # comments
+# Only the changed fields of updated comments; needs WIRE_FORMAT_VERSION=2, ignored with 1
+PUBLISH_DELTAS: bool = config('PUBLISH_DELTAS', default=True, cast=bool)
+# ngk.wire; 1: JSON, read by every listener. Set 2 (compact, with deltas) on the producers
+# once all the API instances run a version that decodes it
+WIRE_FORMAT_VERSION: int = config('WIRE_FORMAT_VERSION', default=1, cast=int)
 
 WORKING_DIR_PATH: pathlib.Path = pathlib.Path(config('WORKING_DIR'))
 LOGS_DIR_PATH: pathlib.Path = pathlib.Path(config('LOGS_DIR'))
 DUMPS_DIR_PATH: pathlib.Path = pathlib.Path(config('DUMPS_DIR'))
+# Not inside DUMPS_DIR: compress_dumps.sh archives every folder there
+DUMP_STORE_DIR_PATH: pathlib.Path = pathlib.Path(config('DUMP_STORE_DIR', default=str(WORKING_DIR_PATH.joinpath('dump_store'))))
+DUMP_STORE: bool = config('DUMP_STORE', default=True, cast=bool)  # False: one .html file per fetch in DUMPS_DIR
+
+XPATH_PRECOMPILED: bool = config('XPATH_PRECOMPILED', default=True, cast=bool)
+
+FETCH_POSTS_CONCURRENCY: int = config('FETCH_POSTS_CONCURRENCY', default=1, cast=int)
+FETCH_POSTS_RATE: float = config('FETCH_POSTS_RATE', default=0.2, cast=float)  # requests per second per host
+FETCH_POSTS_BURST: float = config('FETCH_POSTS_BURST', default=1, cast=float)
+SYNC_LEASE_SECONDS: int = config('SYNC_LEASE_SECONDS', default=300, cast=int)
+REVISIT_BUDGET_PER_HOUR: int = config('REVISIT_BUDGET_PER_HOUR', default=300, cast=int)  # all post fetches, revisits are cut first
+INGEST_PARSE_WORKERS: int = config('INGEST_PARSE_WORKERS', default=2, cast=int)  # ngk.ingest_daemon parser processes
 
 API_INTERNAL_NAMESPACE: str = '/internal/'
 
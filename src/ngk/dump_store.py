@@ -0,0 +1,251 @@
+#/usr/bin/env python3
+import argparse
+import contextlib
+import fcntl
+import hashlib
+import os
+import pathlib
+import sqlite3
+import struct
+import threading
+import zlib
+from datetime import datetime, timezone
+from typing import BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Union
+
+from ngk import config
+from ngk.dumps import STORE_INDEX_FILE_NAME, DumpPage
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+
+SEGMENT_MAX_BYTES = 256 * 1024 * 1024
+
+# magic, post_id, fetched (UTC timestamp), codec, content hash, payload length.
+# Segments are self-describing: the index can be rebuilt from them.
+_RECORD_HEADER = struct.Struct('<4sIdB16sI')
+_RECORD_MAGIC = b'NGKD'
+
+_LOCK_FILE_NAME = 'writer.lock'
+
+_INDEX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS blobs(
+    hash TEXT PRIMARY KEY,
+    segment INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    codec INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS snapshots(
+    post_id INTEGER NOT NULL,
+    fetched REAL NOT NULL,
+    hash TEXT NOT NULL,
+    PRIMARY KEY (post_id, fetched, hash)
+);
+CREATE INDEX IF NOT EXISTS snapshots_fetched ON snapshots(fetched);
+'''
+
+
+class Snapshot(NamedTuple):
+    post_id: int
+    fetched: datetime  # naive UTC, like SyncState.synced
+    hash: str
+    segment: int
+    offset: int
+    length: int
+    codec: int
+
+
+def _to_timestamp(time: datetime) -> float:
+    return time.replace(tzinfo=timezone.utc).timestamp()
+
+
+def _from_timestamp(timestamp: float) -> datetime:
+    return datetime.fromtimestamp(timestamp, timezone.utc).replace(tzinfo=None)
+
+
+def _compress(content: bytes, codec: int) -> bytes:
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=10).compress(content)
+    return zlib.compress(content, 6)
+
+
+def _decompress(payload: bytes, codec: int) -> bytes:
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError('This snapshot is zstd-compressed, install "zstandard" to read it')
+        return zstandard.ZstdDecompressor().decompress(payload)
+    return zlib.decompress(payload)
+
+
+# Append-only page snapshots: every page is compressed on its own and appended to the current
+# segment file; a sqlite index maps (post_id, fetch time) to the page's hash and the hash to
+# its place in a segment. Identical pages are stored once. A store object can be shared by threads,
+# and several processes can write to one store: an append and its index rows are made under an
+# exclusive flock() of the store's lock file.
+class DumpStore:
+    def __init__(self,
+                 path: Union[str, pathlib.Path],
+                 segment_max_bytes: int = SEGMENT_MAX_BYTES,
+                 codec: Optional[int] = None):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.segment_max_bytes = segment_max_bytes
+        self.codec = codec if codec is not None else (CODEC_ZSTD if zstandard is not None else CODEC_ZLIB)
+        self.index = sqlite3.connect(str(self.path.joinpath(STORE_INDEX_FILE_NAME)), check_same_thread=False)
+        self.index.executescript(_INDEX_SCHEMA)
+        self._readers: Dict[int, BinaryIO] = {}
+        self._writer: Optional[BinaryIO] = None
+        self._writer_segment = 0
+        self._lock = threading.RLock()  # the index connection and the file objects
+        self._lock_file = open(self.path.joinpath(_LOCK_FILE_NAME), 'ab')
+
+    def _segment_path(self, segment: int) -> pathlib.Path:
+        return self.path.joinpath(f'segment-{segment:06d}.dat')
+
+    @contextlib.contextmanager
+    def _write_lock(self) -> Iterator[None]:
+        with self._lock:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    # Called under the write lock: other processes may have appended to the segment or started a new one
+    def _get_writer(self) -> BinaryIO:
+        row = self.index.execute('SELECT MAX(segment) FROM blobs').fetchone()
+        segment = max(row[0] if row[0] is not None else 1, self._writer_segment)
+        if self._writer is None or segment != self._writer_segment:
+            if self._writer is not None:
+                self._writer.close()
+            self._writer_segment = segment
+            self._writer = open(self._segment_path(segment), 'ab')
+        if self._writer.seek(0, os.SEEK_END) >= self.segment_max_bytes:
+            self._writer.close()
+            self._writer_segment += 1
+            self._writer = open(self._segment_path(self._writer_segment), 'ab')
+        return self._writer
+
+    def _get_reader(self, segment: int) -> BinaryIO:
+        reader = self._readers.get(segment)
+        if reader is None:
+            reader = self._readers[segment] = open(self._segment_path(segment), 'rb')
+        return reader
+
+    def put(self, post_id: int, content: bytes, fetched: Optional[datetime] = None) -> Snapshot:
+        fetched = fetched or datetime.utcnow()
+        digest = hashlib.blake2b(content, digest_size=16).digest()
+        with self._write_lock():
+            return self._put(post_id, content, fetched, digest)
+
+    def _put(self, post_id: int, content: bytes, fetched: datetime, digest: bytes) -> Snapshot:
+        content_hash = digest.hex()
+        row = self.index.execute('SELECT segment, offset, length, codec FROM blobs WHERE hash = ?', (content_hash,)).fetchone()
+        if row is not None:
+            segment, offset, length, codec = row
+        else:
+            codec = self.codec
+            payload = _compress(content, codec)
+            writer = self._get_writer()
+            segment = self._writer_segment
+            offset, length = writer.tell() + _RECORD_HEADER.size, len(payload)
+            writer.write(_RECORD_HEADER.pack(_RECORD_MAGIC, post_id, _to_timestamp(fetched), codec, digest, len(payload)))
+            writer.write(payload)
+            writer.flush()
+            self.index.execute('INSERT INTO blobs(hash, segment, offset, length, codec, size) VALUES (?, ?, ?, ?, ?, ?)',
+                               (content_hash, segment, offset, length, codec, len(content)))
+
+        self.index.execute('INSERT OR IGNORE INTO snapshots(post_id, fetched, hash) VALUES (?, ?, ?)',
+                           (post_id, _to_timestamp(fetched), content_hash))
+        self.index.commit()
+        return Snapshot(post_id, fetched, content_hash, segment, offset, length, codec)
+
+    def read(self, snapshot: Snapshot) -> bytes:
+        with self._lock:
+            reader = self._get_reader(snapshot.segment)
+            reader.seek(snapshot.offset)
+            payload = reader.read(snapshot.length)
+        return _decompress(payload, snapshot.codec)
+
+    def iter_snapshots(self,
+                       post_id: Optional[int] = None,
+                       since: Optional[datetime] = None,
+                       until: Optional[datetime] = None) -> Iterator[Snapshot]:
+        conditions: List[str] = []
+        params: List[Union[int, float]] = []
+        if post_id is not None:
+            conditions.append('s.post_id = ?')
+            params.append(post_id)
+        if since is not None:
+            conditions.append('s.fetched >= ?')
+            params.append(_to_timestamp(since))
+        if until is not None:
+            conditions.append('s.fetched < ?')
+            params.append(_to_timestamp(until))
+        where = ('WHERE ' + ' AND '.join(conditions)) if len(conditions) > 0 else ''
+        query = 'SELECT s.post_id, s.fetched, s.hash, b.segment, b.offset, b.length, b.codec ' + \
+                f'FROM snapshots s JOIN blobs b ON b.hash = s.hash {where} ORDER BY s.fetched, s.post_id'
+        with self._lock:
+            rows = self.index.execute(query, params).fetchall()
+        for post_id_, fetched, content_hash, segment, offset, length, codec in rows:
+            yield Snapshot(post_id_, _from_timestamp(fetched), content_hash, segment, offset, length, codec)
+
+    def snapshots(self, post_id: int) -> List[Snapshot]:
+        return list(self.iter_snapshots(post_id=post_id))
+
+    def latest(self, post_id: int) -> Optional[bytes]:
+        snapshots = self.snapshots(post_id)
+        return self.read(snapshots[-1]) if len(snapshots) > 0 else None
+
+    # Same pages as ngk.dumps, so the re-parse and benchmark tools can read from the store
+    def iter_pages(self,
+                   post_id: Optional[int] = None,
+                   since: Optional[datetime] = None,
+                   until: Optional[datetime] = None) -> Iterator[DumpPage]:
+        for snapshot in list(self.iter_snapshots(post_id, since, until)):
+            name = f'{snapshot.post_id}/{snapshot.fetched.strftime("%Y-%m-%d/%H-%M-%S")}.html'
+            yield DumpPage(name, snapshot.fetched, self.read(snapshot))
+
+    def close(self) -> None:
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            for reader in self._readers.values():
+                reader.close()
+            self._readers.clear()
+            self.index.close()
+            self._lock_file.close()
+
+    def __enter__(self) -> 'DumpStore':
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description='List or extract the stored snapshots of a post')
+    arg_parser.add_argument('post_id', type=int)
+    arg_parser.add_argument('--store', default=str(config.DUMP_STORE_DIR_PATH), help='Dump store folder')
+    arg_parser.add_argument('--extract', help='Write the snapshots into this folder')
+    args = arg_parser.parse_args()
+
+    with DumpStore(args.store) as store:
+        for snapshot in store.snapshots(args.post_id):
+            print(f'{snapshot.fetched:%Y-%m-%d %H:%M:%S} {snapshot.hash} segment {snapshot.segment} @ {snapshot.offset}')
+            if args.extract:
+                path = pathlib.Path(args.extract).joinpath(f'{snapshot.post_id}-{snapshot.fetched:%Y-%m-%d-%H-%M-%S}.html')
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_bytes(store.read(snapshot))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import os
+import pathlib
+import re
+import tarfile
+from datetime import datetime
+from typing import IO, Iterable, Iterator, List, NamedTuple, Optional, Union
+
+from ngk import config
+
+
+_RE_DUMP_NAME = re.compile(r'(\d{4}-\d\d-\d\d)/(\d\d-\d\d-\d\d)\.html$')
+_ARCHIVE_SUFFIXES = ('.tar.gz', '.tgz')
+STORE_INDEX_FILE_NAME = 'index.sqlite'
+
+
+class DumpPage(NamedTuple):
+    name: str
+    dumped: Optional[datetime]
+    content: bytes
+
+
+def parse_dump_time(name: str) -> Optional[datetime]:
+    m = _RE_DUMP_NAME.search(name.replace(os.sep, '/'))
+    if m is None:
+        return None
+    return datetime.strptime(f'{m.group(1)} {m.group(2)}', '%Y-%m-%d %H-%M-%S')
+
+
+def is_archive(path: Union[str, pathlib.Path]) -> bool:
+    return str(path).endswith(_ARCHIVE_SUFFIXES)
+
+
+def is_store(path: Union[str, pathlib.Path]) -> bool:
+    return pathlib.Path(path).joinpath(STORE_INDEX_FILE_NAME).is_file()
+
+
+def _read_file(path: pathlib.Path) -> DumpPage:
+    # Keep the daily folder in the name: it holds the dump date
+    name = f'{path.parent.name}/{path.name}' if path.parent.name else path.name
+    with open(path, 'rb') as f:
+        return DumpPage(name, parse_dump_time(name), f.read())
+
+
+def iter_archive(path: Union[str, pathlib.Path]) -> Iterator[DumpPage]:
+    # Streaming mode: members are read in the archive's order without seeking
+    with tarfile.open(path, 'r|gz') as tar:
+        for member in tar:
+            if not member.isfile() or not member.name.endswith('.html'):
+                continue
+            f: Optional[IO[bytes]] = tar.extractfile(member)
+            if f is None:
+                continue
+            with f:
+                yield DumpPage(member.name, parse_dump_time(member.name), f.read())
+
+
+# Daily folders and archives sort chronologically by name
+def list_sources(path: Union[str, pathlib.Path]) -> List[pathlib.Path]:
+    return sorted(pathlib.Path(path).iterdir(), key=lambda p: p.name)
+
+
+def _iter_dir(path: pathlib.Path) -> Iterator[DumpPage]:
+    for entry in list_sources(path):
+        if entry.is_dir():
+            yield from _iter_dir(entry)
+        elif is_archive(entry):
+            yield from iter_archive(entry)
+        elif entry.name.endswith('.html'):
+            yield _read_file(entry)
+
+
+def iter_pages(paths: Iterable[Union[str, pathlib.Path]]) -> Iterator[DumpPage]:
+    for path in map(pathlib.Path, paths):
+        if is_store(path):
+            # ngk.dump_store imports this module
+            from ngk.dump_store import DumpStore
+            with DumpStore(path) as store:
+                yield from store.iter_pages()
+        elif path.is_dir():
+            yield from _iter_dir(path)
+        elif is_archive(path):
+            yield from iter_archive(path)
+        else:
+            yield _read_file(path)
+
+
+def iter_dumps_dir() -> Iterator[DumpPage]:
+    return iter_pages([config.DUMPS_DIR_PATH])
@@ -4,8 +4,10 @@ import logging
 import os
 import os.path
 import re
+import threading
 import time
-from typing import List, Optional, Tuple
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional, Tuple
 
 import lxml
 import lxml.etree
@@ -14,79 +16,35 @@ import requests
 import sqlalchemy.orm
 
 from ngk.comments_processor import CommentsProcessor
-from ngk import config
+from ngk import config, ingest, scheduler
+from ngk.dump_store import DumpStore
+from ngk.http_client import HTTP_NOT_MODIFIED, get_client
 from ngk.log import get_logger, redirect_basic_logging
 from ngk.html_util import inner_html_ru, normalize_text
 from ngk.parse_error import ParseError
 from ngk.parser import ParsedComment, ParsedPost, ParsedUser
 import ngk.parser_ru as parser_ru
+from ngk.rate_limit import HostRateLimiter, parse_retry_after
 from ngk.schema import Comment, Post, ScopedSession, SyncState, User
+from ngk.stats import FINGERPRINT_HITS, FINGERPRINT_MISSES, Stats
+from ngk.sync_queue import SyncQueue
 
 
 L = get_logger('fetch_posts', logging.DEBUG)
 redirect_basic_logging(L)
 
-GK_URL = "http://govnokod.ru"
+GK_HOST = "govnokod.ru"
+GK_URL = "http://" + GK_HOST
 SUCCESS_DELAY = 5
 ERROR_DELAY = 60
 
+stats = Stats(logger=L)
+dump_store: Optional[DumpStore] = None
+dump_store_lock = threading.Lock()
+
     
 def parse_post(content: bytes) -> Tuple[Post, List[User], List[Comment]]:
-    parsed_post: ParsedPost = parser_ru.parse_post(content)
-    parsed_user: ParsedUser = parsed_post.user
-    parsed_comments: List[ParsedComment] = parsed_post.comments
-    
-    users: List[User] = []
-    comments: List[Comment] = []
-
-    # post
-    post = Post(
-        source=Post.SOURCE_GK,
-        post_id=parsed_post.id_ru,
-        user_id=parsed_user.id_ru,
-        comment_list_id=parsed_post.comment_list_id,
-        language=parsed_post.language,
-        code=parsed_post.code,
-        text=parsed_post.text,
-        posted=datetime.fromtimestamp(parsed_post.time_posted),
-        vote_plus=0,
-        vote_minus=0,
-        rating=0
-    )
-
-    # author info
-    user = User(
-        source=User.SOURCE_GK,
-        user_id=parsed_user.id_ru,
-        name=parsed_user.name,
-        avatar_hash=parsed_user.avatar_hash
-    )
-    users.append(user)
-
-    # comments
-    for parsed_comment in parsed_comments:
-        user = User(
-            source=User.SOURCE_GK,
-            user_id=parsed_comment.user.id_ru,
-            name=parsed_comment.user.name,
-            avatar_hash=parsed_comment.user.avatar_hash
-        )
-        
-        comment = Comment(parsed_comment.id_ru)
-        comment.user_id = parsed_comment.user.id_ru
-        comment.source = Comment.SOURCE_GK
-        comment.post_id = parsed_post.id_ru
-        comment.parent_id = parsed_comment.parent_id
-        comment.text = parsed_comment.text
-        comment.posted = datetime.fromtimestamp(parsed_comment.time_posted)
-        comment.vote_plus = 0
-        comment.vote_minus = 0
-        comment.rating = 0
-
-        users.append(user)
-        comments.append(comment)
-
-    return (post, users, comments)
+    return ingest.post_to_models(parser_ru.parse_post(content))
 
 
 def update_state(state: SyncState, result: str) -> None:
@@ -96,7 +54,15 @@ def update_state(state: SyncState, result: str) -> None:
     state.result = result
 
 
-def dump_post(content: bytes) -> None:
+def dump_post(post_id: int, content: bytes) -> None:
+    global dump_store
+    if config.DUMP_STORE:
+        with dump_store_lock:
+            if dump_store is None:
+                dump_store = DumpStore(config.DUMP_STORE_DIR_PATH)
+        dump_store.put(post_id, content)
+        return
+
     time = datetime.utcnow()
     subdir_path = config.get_dumps_path(time.strftime("%Y-%m-%d"))
     file_name = time.strftime("%H-%M-%S") + ".html"
@@ -106,44 +72,84 @@ def dump_post(content: bytes) -> None:
         f.write(content)
 
 
-def update_post(session: sqlalchemy.orm.Session, state: SyncState, processor: CommentsProcessor) -> None:
-    L.info("Updating post %d...", state.post_id)
+def get_post_url(post_id: int) -> str:
+    return GK_URL + "/" + str(post_id)
+
+
+def fetch_post(post_id: int) -> requests.Response:
+    return get_client().get(get_post_url(post_id))
+
+
+def apply_post(session: sqlalchemy.orm.Session,
+               state: SyncState,
+               status_code: int,
+               content: bytes,
+               processor: CommentsProcessor,
+               parse: Callable[[bytes], ParsedPost] = parser_ru.parse_post) -> None:
+    if status_code == HTTP_NOT_MODIFIED:
+        update_state(state, 'Not modified')
+        scheduler.schedule_unchanged(state)
+        return
+
+    if status_code != 200:
+        update_state(state, 'HTTP error {0}'.format(status_code))
+        scheduler.schedule_failure(state)
+        return
 
-    r = requests.get(GK_URL + "/" + str(state.post_id), headers=config.DEFAULT_HEADERS, timeout=30)
-    if r.status_code != 200:
-        update_state(state, 'HTTP error {0}'.format(r.status_code))
+    fingerprint = parser_ru.fingerprint_post(content)
+    if state.fingerprint == fingerprint:
+        hits = stats.incr(FINGERPRINT_HITS)
+        L.info(f'Post {state.post_id} has not changed since the last sync (fingerprint hits: {hits})')
+        update_state(state, 'Not changed')
+        scheduler.schedule_unchanged(state)
         return
+    misses = stats.incr(FINGERPRINT_MISSES)
+    L.debug(f'Post {state.post_id}: fingerprint {state.fingerprint} -> {fingerprint} (misses: {misses})')
 
-    dump_post(r.content)
+    dump_post(state.post_id, content)
 
     try:
-        post, users, comments = parse_post(r.content)
+        post, users, comments = ingest.post_to_models(parse(content))
     except Exception as e:
         L.exception(e)
+        get_client().forget(get_post_url(state.post_id))
         update_state(state, 'Parse error')
+        scheduler.schedule_failure(state)
         return
 
-    session.merge(post)
-    for user in users:
-        session.merge(user)
+    # Old texts in one query, then set-based upserts instead of a merge() per row.
+    # Only the comments that were inserted or actually changed come back in written_ids
+    old_texts = ingest.get_comment_texts(session, [comment.comment_id for comment in comments])
+    ingest.upsert(session, User, [ingest.model_to_row(user) for user in users])
+    ingest.upsert(session, Post, [ingest.model_to_row(post)])
+    written_ids = set(ingest.upsert(session, Comment, [ingest.model_to_row(comment) for comment in comments], returning=True) or [])
 
     last_comment_id = None
-    updated_comments: List[Comment] = []
-    new_comments: List[Comment] = []
+    new_ids: List[int] = []
+    updated_ids: List[int] = []
 
     for comment in comments:
-        old_text = session.query(Comment.text).filter(Comment.comment_id == comment.comment_id).first()
-        merged_comment = session.merge(comment)
-        if old_text is None:
-            new_comments.append(merged_comment)
-        elif old_text[0] != merged_comment.text:
-            updated_comments.append(merged_comment)
+        if comment.comment_id in written_ids:
+            if comment.comment_id not in old_texts:
+                new_ids.append(comment.comment_id)
+            elif old_texts[comment.comment_id] != comment.text:
+                updated_ids.append(comment.comment_id)
         if last_comment_id is None or comment.comment_id > last_comment_id:
             last_comment_id = comment.comment_id
 
+    loaded: Dict[int, Comment] = {}
+    if len(new_ids) > 0 or len(updated_ids) > 0:
+        query = session.query(Comment).filter(Comment.comment_id.in_(new_ids + updated_ids))
+        loaded = {comment.comment_id: comment for comment in query}
+    new_comments = [loaded[comment_id] for comment_id in new_ids]
+    updated_comments = [loaded[comment_id] for comment_id in updated_ids]
+
     update_state(state, 'OK')
+    state.fingerprint = fingerprint
+    scheduler.schedule_success(state, [post.posted.timestamp()] + [comment.posted.timestamp() for comment in comments])
     session.flush()
-    processor.on_comments_update(new_comments, updated_comments)
+    # Comments are updated only when their text changes
+    processor.on_comments_update(new_comments, updated_comments, changed_fields=('text',))
     
     # Workaround for https://govnokod.ru/26440#comment527494
     # TODO: Make an appropriate fix
@@ -158,12 +164,30 @@ def update_post(session: sqlalchemy.orm.Session, state: SyncState, processor: Co
     state.last_comment_id = last_comment_id
 
 
-def update_next_post(processor: CommentsProcessor) -> None:
+def update_post(session: sqlalchemy.orm.Session, state: SyncState, processor: CommentsProcessor) -> None:
+    L.info("Updating post %d...", state.post_id)
+
+    r = fetch_post(state.post_id)
+    apply_post(session, state, r.status_code, r.content, processor)
+
+
+def update_next_post(processor: CommentsProcessor, queue: SyncQueue, revisits: scheduler.RevisitScheduler) -> None:
     try:
-        with ScopedSession() as session:
-            state = session.query(SyncState).filter_by(pending=True).order_by(SyncState.priority.desc(), SyncState.post_id.desc()).first()
-            if state:
-                update_post(session, state, processor)
+        enqueued = revisits.tick()
+        if enqueued > 0:
+            L.info(f'Scheduled {enqueued} posts for a revisit')
+
+        for post_id in queue.claim(1):
+            try:
+                with ScopedSession() as session:
+                    state = session.query(SyncState).filter(SyncState.post_id == post_id).one_or_none()
+                    if state:
+                        update_post(session, state, processor)
+            except Exception:
+                get_client().forget(get_post_url(post_id))
+                raise
+            finally:
+                queue.release([post_id])
 
         delay = SUCCESS_DELAY
 
@@ -174,6 +198,98 @@ def update_next_post(processor: CommentsProcessor) -> None:
     time.sleep(delay)
 
 
+# Runs on the fetcher threads: returns None if the post should stay pending and be retried later
+def fetch_post_limited(post_id: int, limiter: HostRateLimiter, acquire: bool = True) -> Optional[requests.Response]:
+    if acquire:
+        limiter.acquire(GK_HOST)
+    L.info("Fetching post %d...", post_id)
+    try:
+        r = fetch_post(post_id)
+    except requests.RequestException as e:
+        backoff = limiter.on_failure(GK_HOST)
+        L.warning(f'Fetching post {post_id} failed ({e!r}), backing off for {backoff:.0f}s')
+        return None
+
+    retry_after = parse_retry_after(r.headers.get('Retry-After'))
+    if retry_after is not None and r.status_code in (429, 503):
+        limiter.on_retry_after(GK_HOST, retry_after)
+        L.warning(f'Post {post_id}: HTTP {r.status_code}, retrying after {retry_after:.0f}s')
+        return None
+    if r.status_code == 429:
+        backoff = limiter.on_failure(GK_HOST)
+        L.warning(f'Post {post_id}: HTTP 429, backing off for {backoff:.0f}s')
+        return None
+    if r.status_code >= 500:
+        backoff = limiter.on_failure(GK_HOST)
+        L.warning(f'Post {post_id}: HTTP {r.status_code}, backing off for {backoff:.0f}s')
+    else:
+        limiter.on_success(GK_HOST)
+    return r
+
+
+# The client keeps the validators of a fetched page: if applying it fails, they are dropped
+# so that the next fetch downloads the post again instead of getting a 304
+def apply_fetched_post(post_id: int,
+                       r: requests.Response,
+                       processor: CommentsProcessor,
+                       parse: Callable[[bytes], ParsedPost] = parser_ru.parse_post) -> None:
+    try:
+        with ScopedSession() as session:
+            state = session.query(SyncState).filter(SyncState.post_id == post_id).one_or_none()
+            if state is None:
+                return
+            L.info("Updating post %d...", post_id)
+            apply_post(session, state, r.status_code, r.content, processor, parse)
+    except Exception:
+        get_client().forget(get_post_url(post_id))
+        raise
+
+
+# Up to `concurrency` posts in flight on a thread pool; parsing and DB writes stay on the main thread
+def update_posts_concurrently(processor: CommentsProcessor,
+                              queue: SyncQueue,
+                              revisits: scheduler.RevisitScheduler,
+                              concurrency: int) -> None:
+    limiter = HostRateLimiter(config.FETCH_POSTS_RATE, config.FETCH_POSTS_BURST)
+    futures: Dict['Future[Optional[requests.Response]]', int] = {}
+    heartbeat_interval = queue.lease.total_seconds() / 3
+    last_heartbeat = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='fetch') as executor:
+        while True:
+            try:
+                enqueued = revisits.tick()
+                if enqueued > 0:
+                    L.info(f'Scheduled {enqueued} posts for a revisit')
+
+                if len(futures) < concurrency:
+                    for post_id in queue.claim(concurrency - len(futures)):
+                        futures[executor.submit(fetch_post_limited, post_id, limiter)] = post_id
+
+                if time.monotonic() - last_heartbeat > heartbeat_interval:
+                    queue.heartbeat(list(futures.values()))
+                    last_heartbeat = time.monotonic()
+
+                if len(futures) == 0:
+                    time.sleep(SUCCESS_DELAY)
+                    continue
+
+                done, _ = wait(futures, timeout=SUCCESS_DELAY, return_when=FIRST_COMPLETED)
+                for future in done:
+                    post_id = futures.pop(future)
+                    try:
+                        r = future.result()
+                        if r is not None:
+                            apply_fetched_post(post_id, r, processor)
+                    except Exception as e:
+                        L.exception(e)
+                    finally:
+                        queue.release([post_id])
+            except Exception as e:
+                L.exception(e)
+                time.sleep(ERROR_DELAY)
+
+
 def main() -> None:
     L.info("=== started ===")
     processor = CommentsProcessor(config.REDIS_HOST,
@@ -181,8 +297,18 @@ def main() -> None:
                                   config.REDIS_PASSWORD,
                                   config.REDIS_CHANNEL,
                                   L)
-    while True:
-        update_next_post(processor)
+    queue = SyncQueue()
+    revisits = scheduler.RevisitScheduler()
+    L.info(f"Worker id: {queue.worker_id}")
+    try:
+        if config.FETCH_POSTS_CONCURRENCY > 1:
+            L.info(f"Concurrent mode: {config.FETCH_POSTS_CONCURRENCY} posts in flight, {config.FETCH_POSTS_RATE} req/s")
+            update_posts_concurrently(processor, queue, revisits, config.FETCH_POSTS_CONCURRENCY)
+        else:
+            while True:
+                update_next_post(processor, queue, revisits)
+    finally:
+        processor.close()
 
 
 if __name__ == '__main__':
@@ -1,51 +1,86 @@
-import copy
+import html
 import re
+from typing import List, Match, Sequence, Tuple
 
 import lxml
 import lxml.etree
 import lxml.html
 
 
+_RE_CFEMAIL = re.compile(r'<a.*?data-cfemail="(.*?)">.*?</a>')
+
+
+def _decode_cfemail(m: Match[str]) -> str:
+    encoded = bytes.fromhex(m.group(1))
+    key = encoded[0]
+    return "".join([chr(c ^ key) for c in encoded[1:]])
+
+
 def normalize_text(s: str) -> str:
-    s = s.replace("&#13;", "")
+    if "&#13;" in s:
+        s = s.replace("&#13;", "")
+
+    if "data-cfemail" not in s:
+        return s
+
+    return _RE_CFEMAIL.sub(_decode_cfemail, s)
 
-    res = ""
-    while True:
-        m = re.search(r'<a.*?data-cfemail="(.*?)">.*?</a>', s)
-        if not m:
-            break
 
-        encoded = bytes.fromhex(m.group(1))
-        key = encoded[0]
-        decoded = "".join([chr(c ^ key) for c in encoded[1:]])
+def _escape_text(text: str) -> str:
+    # Same escaping as libxml2's HTML serializer (which also turns CR into &#13;)
+    return html.escape(text, quote=False).replace('\r', '&#13;')
 
-        res += s[:m.start()]
-        res += decoded
-        s = s[m.end():]
 
-    return res + s
+_RE_START_TAG = re.compile(r'''<(?:[^>"']|"[^"]*"|'[^']*')*>''')
 
 
-def _inner_html(node: lxml.etree._Element) -> str:
-    tmp = lxml.etree.Element('root')
-    tmp.text = node.text
+def _split_tag(node: lxml.etree._Element) -> Tuple[str, str]:
+    # Only reached for elements that wrap a dropped tag. The start tag is cut from the
+    # element's own serialization: copying node.attrib would turn `novalidate` into `novalidate=""`
+    serialized = lxml.html.tostring(node, encoding='unicode', with_tail=False)
+    m = _RE_START_TAG.match(serialized)
+    start_tag = m.group(0) if m is not None else ''
+    end_tag = f'</{node.tag}>'
+    if not serialized.endswith(end_tag):
+        end_tag = ''
+    return start_tag, end_tag
+
+
+def _write_children(node: lxml.etree._Element, buf: List[str], drop_tags: Sequence[str]) -> None:
+    if node.text:
+        buf.append(_escape_text(node.text))
     for child in node:
-        tmp.append(child)
+        _write_node(child, buf, drop_tags)
+
+
+def _write_node(node: lxml.etree._Element, buf: List[str], drop_tags: Sequence[str]) -> None:
+    if len(drop_tags) == 0 or not isinstance(node.tag, str) or next(node.iter(*drop_tags), None) is None:
+        buf.append(lxml.html.tostring(node, encoding='unicode', with_tail=True))
+        return
+
+    if node.tag in drop_tags:
+        _write_children(node, buf, drop_tags)
+    else:
+        start_tag, end_tag = _split_tag(node)
+        buf.append(start_tag)
+        _write_children(node, buf, drop_tags)
+        buf.append(end_tag)
+
+    if node.tail:
+        buf.append(_escape_text(node.tail))
 
-    res = lxml.html.tostring(tmp, encoding='unicode')
 
-    res = re.sub(r'^<root>', '', res)
-    res = re.sub(r'</root>$', '', res)
-    res = res.strip()
-    
-    return res
+# Serializes the node's content without touching the tree; elements
+# listed in drop_tags are left out, keeping their content (like lxml.etree.strip_tags())
+def inner_html(node: lxml.etree._Element, drop_tags: Sequence[str] = ()) -> str:
+    buf: List[str] = []
+    _write_children(node, buf, drop_tags)
+    return ''.join(buf).strip()
 
 
 def inner_html_ru(node: lxml.etree._Element) -> str:
-    return _inner_html(node)
+    return inner_html(node)
 
 
 def inner_html_xyz(node: lxml.etree._Element) -> str:
-    node = copy.deepcopy(node)
-    lxml.etree.strip_tags(node, 'a')
-    return _inner_html(node)
+    return inner_html(node, ('a',))
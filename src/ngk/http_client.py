@@ -0,0 +1,168 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Mapping, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+import requests.adapters
+
+from ngk import config
+from ngk.log import get_logger
+
+
+L = get_logger('http_client', logging.INFO)
+
+try:
+    import brotli  # noqa: F401  (urllib3 decodes "br" when it is installed)
+    ACCEPT_ENCODING = 'gzip, deflate, br'
+except ImportError:
+    ACCEPT_ENCODING = 'gzip, deflate'
+
+HTTP_NOT_MODIFIED = 304
+
+_MAX_VALIDATORS = 100000
+_STATS_LOG_INTERVAL = 600
+
+
+class HostStats:
+    __slots__ = ('requests', 'not_modified', 'errors', 'bytes', 'total_time', 'max_time')
+
+    def __init__(self) -> None:
+        self.requests: int = 0
+        self.not_modified: int = 0
+        self.errors: int = 0
+        self.bytes: int = 0
+        self.total_time: float = 0.0
+        self.max_time: float = 0.0
+
+    def to_dict(self) -> Dict[str, float]:
+        return {k: getattr(self, k) for k in HostStats.__slots__}
+
+    def __str__(self) -> str:
+        avg_ms = self.total_time / self.requests * 1000 if self.requests > 0 else 0.0
+        return f'{self.requests} requests ({self.not_modified} not modified, {self.errors} errors), ' + \
+               f'{self.bytes / 1024:.0f} KiB, avg {avg_ms:.0f} ms, max {self.max_time * 1000:.0f} ms'
+
+
+# Keep-alive sessions pooled per host, with conditional GETs: ETag/Last-Modified
+# of every successful response are sent back on the next request to the same URL.
+class HttpClient:
+    def __init__(self,
+                 headers: Mapping[str, str] = config.DEFAULT_HEADERS,
+                 timeout: float = 30,
+                 pool_size: int = 10,
+                 logger: logging.Logger = L):
+        self.headers: Dict[str, str] = dict(headers)
+        self.headers['Accept-Encoding'] = ACCEPT_ENCODING
+        self.timeout: float = timeout
+        self.pool_size: int = pool_size
+        self.logger: logging.Logger = logger
+        self._sessions: Dict[str, requests.Session] = {}
+        self._validators: 'OrderedDict[str, Tuple[Optional[str], Optional[str]]]' = OrderedDict()
+        self._stats: Dict[str, HostStats] = {}
+        self._stats_logged: float = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _get_session(self, host: str) -> requests.Session:
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                session.headers.update(self.headers)
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[host] = session
+            return session
+
+    def _get_validators(self, url: str) -> Dict[str, str]:
+        with self._lock:
+            etag, last_modified = self._validators.get(url, (None, None))
+        headers = {}
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def _store_validators(self, url: str, r: requests.Response) -> None:
+        etag = r.headers.get('ETag')
+        last_modified = r.headers.get('Last-Modified')
+        with self._lock:
+            if etag is None and last_modified is None:
+                self._validators.pop(url, None)
+                return
+            self._validators[url] = (etag, last_modified)
+            self._validators.move_to_end(url)
+            while len(self._validators) > _MAX_VALIDATORS:
+                self._validators.popitem(last=False)
+
+    def _record(self, host: str, elapsed: float, r: Optional[requests.Response]) -> None:
+        with self._lock:
+            stats = self._stats.get(host)
+            if stats is None:
+                stats = self._stats[host] = HostStats()
+            stats.requests += 1
+            stats.total_time += elapsed
+            stats.max_time = max(stats.max_time, elapsed)
+            if r is None or r.status_code >= 400:
+                stats.errors += 1
+            elif r.status_code == HTTP_NOT_MODIFIED:
+                stats.not_modified += 1
+            if r is not None:
+                stats.bytes += len(r.content)
+
+            log_stats = time.monotonic() - self._stats_logged > _STATS_LOG_INTERVAL
+            if log_stats:
+                self._stats_logged = time.monotonic()
+        if log_stats:
+            self.log_stats()
+
+    # Returns a response with status 304 (and an empty body) if the page has not changed
+    def get(self, url: str, conditional: bool = True) -> requests.Response:
+        host = urlsplit(url).netloc
+        session = self._get_session(host)
+        headers = self._get_validators(url) if conditional else {}
+
+        started = time.perf_counter()
+        try:
+            r = session.get(url, headers=headers, timeout=self.timeout)
+        except requests.RequestException:
+            self._record(host, time.perf_counter() - started, None)
+            raise
+        elapsed = time.perf_counter() - started
+        self._record(host, elapsed, r)
+        self.logger.debug(f'GET {url}: {r.status_code}, {len(r.content)} bytes in {elapsed * 1000:.0f} ms')
+
+        if conditional and r.status_code == 200:
+            self._store_validators(url, r)
+        return r
+
+    # Drops the validators, so the next get() downloads the full page (e.g. after a parse error)
+    def forget(self, url: str) -> None:
+        with self._lock:
+            self._validators.pop(url, None)
+
+    def get_stats(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {host: stats.to_dict() for host, stats in self._stats.items()}
+
+    def log_stats(self) -> None:
+        with self._lock:
+            lines = [f'{host}: {stats}' for host, stats in self._stats.items()]
+        for line in lines:
+            self.logger.info(f'HTTP stats: {line}')
+
+
+_client: Optional[HttpClient] = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> HttpClient:
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient()
+        return _client
@@ -0,0 +1,75 @@
+import threading
+from array import array
+from typing import Iterable, List, Optional, Tuple
+
+import sqlalchemy.orm
+
+from ngk.schema import CommentIdStorage
+
+
+_EMPTY = 0  # ids are positive
+_YIELD_PER = 10000
+
+
+def _grow(values: 'array[int]', size: int) -> None:
+    if size > len(values):
+        values.extend(array(values.typecode, bytes(values.itemsize * max(size - len(values), len(values) // 2))))
+
+
+# ru <-> xyz comment ids (comment_ids_storage) as two flat arrays indexed by id:
+# 8 bytes per comment id, no per-entry objects
+class IdMap:
+    def __init__(self) -> None:
+        self._ru_to_xyz: 'array[int]' = array('I')
+        self._xyz_to_ru: 'array[int]' = array('I')
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def load(self, session: sqlalchemy.orm.Session) -> int:
+        query = session.query(CommentIdStorage.comment_id_ru, CommentIdStorage.comment_id_xyz) \
+            .filter(CommentIdStorage.comment_id_xyz != None) \
+            .yield_per(_YIELD_PER)
+        return self.update(query)
+
+    def get_xyz(self, id_ru: int) -> Optional[int]:
+        if 0 <= id_ru < len(self._ru_to_xyz):
+            id_xyz = self._ru_to_xyz[id_ru]
+            return id_xyz if id_xyz != _EMPTY else None
+        return None
+
+    def get_ru(self, id_xyz: int) -> Optional[int]:
+        if 0 <= id_xyz < len(self._xyz_to_ru):
+            id_ru = self._xyz_to_ru[id_xyz]
+            return id_ru if id_ru != _EMPTY else None
+        return None
+
+    # Pairs that are not in the map yet or map to another id
+    def diff(self, pairs: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        return [(id_ru, id_xyz) for id_ru, id_xyz in pairs if self.get_xyz(id_ru) != id_xyz]
+
+    def update(self, pairs: Iterable[Tuple[int, int]]) -> int:
+        count = 0
+        with self._lock:
+            for id_ru, id_xyz in pairs:
+                if id_ru <= 0 or id_xyz is None or id_xyz <= 0:
+                    continue
+                _grow(self._ru_to_xyz, id_ru + 1)
+                _grow(self._xyz_to_ru, id_xyz + 1)
+                old_xyz = self._ru_to_xyz[id_ru]
+                if old_xyz == id_xyz:
+                    continue
+                old_ru = self._xyz_to_ru[id_xyz]
+                if old_ru != _EMPTY:
+                    self._ru_to_xyz[old_ru] = _EMPTY
+                    self._size -= 1
+                if old_xyz != _EMPTY:
+                    self._xyz_to_ru[old_xyz] = _EMPTY
+                else:
+                    self._size += 1
+                self._ru_to_xyz[id_ru] = id_xyz
+                self._xyz_to_ru[id_xyz] = id_ru
+                count += 1
+        return count
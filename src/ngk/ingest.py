@@ -0,0 +1,132 @@
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Type
+
+import sqlalchemy.orm
+import sqlalchemy.sql as sql
+from sqlalchemy.dialects.postgresql import insert
+
+from ngk.parser import ParsedComment, ParsedPost, ParsedUser
+from ngk.schema import Base, Comment, Post, User
+
+
+UPSERT_BATCH_SIZE = 1000
+
+
+def post_to_models(parsed_post: ParsedPost) -> Tuple[Post, List[User], List[Comment]]:
+    parsed_user: ParsedUser = parsed_post.user
+    parsed_comments: List[ParsedComment] = parsed_post.comments
+
+    users: List[User] = []
+    comments: List[Comment] = []
+
+    # post
+    post = Post(
+        source=Post.SOURCE_GK,
+        post_id=parsed_post.id_ru,
+        user_id=parsed_user.id_ru,
+        comment_list_id=parsed_post.comment_list_id,
+        language=parsed_post.language,
+        code=parsed_post.code,
+        text=parsed_post.text,
+        posted=datetime.fromtimestamp(parsed_post.time_posted),
+        vote_plus=0,
+        vote_minus=0,
+        rating=0
+    )
+
+    # author info
+    user = User(
+        source=User.SOURCE_GK,
+        user_id=parsed_user.id_ru,
+        name=parsed_user.name,
+        avatar_hash=parsed_user.avatar_hash
+    )
+    users.append(user)
+
+    # comments
+    for parsed_comment in parsed_comments:
+        user = User(
+            source=User.SOURCE_GK,
+            user_id=parsed_comment.user.id_ru,
+            name=parsed_comment.user.name,
+            avatar_hash=parsed_comment.user.avatar_hash
+        )
+
+        comment = Comment(parsed_comment.id_ru)
+        comment.user_id = parsed_comment.user.id_ru
+        comment.source = Comment.SOURCE_GK
+        comment.post_id = parsed_post.id_ru
+        comment.parent_id = parsed_comment.parent_id
+        comment.text = parsed_comment.text
+        comment.posted = datetime.fromtimestamp(parsed_comment.time_posted)
+        comment.vote_plus = 0
+        comment.vote_minus = 0
+        comment.rating = 0
+
+        users.append(user)
+        comments.append(comment)
+
+    return (post, users, comments)
+
+
+# Column values explicitly set on a (transient) model instance
+def model_to_row(model: Base) -> Dict[str, Any]:
+    state = model.__dict__
+    return {column.key: state[column.key] for column in model.__table__.columns if column.key in state}
+
+
+# Later duplicates win, like repeated session.merge() calls would
+def dedupe_rows(rows: Iterable[Dict[str, Any]], key: str) -> List[Dict[str, Any]]:
+    unique: Dict[Any, Dict[str, Any]] = {}
+    for row in rows:
+        unique[row[key]] = row
+    return list(unique.values())
+
+
+# Rows equal to the stored ones are not updated. With returning=True, returns the primary keys
+# of the inserted or updated rows: the unchanged ones are left out
+def upsert(session: sqlalchemy.orm.Session,
+           model: Type[Base],
+           rows: Sequence[Dict[str, Any]],
+           overwrite: bool = True,
+           returning: bool = False) -> Optional[List[Any]]:
+    table = model.__table__
+    primary_key = [column.key for column in table.primary_key.columns]
+    rows = dedupe_rows(rows, primary_key[0])
+    written: Optional[List[Any]] = [] if returning else None
+
+    for offset in range(0, len(rows), UPSERT_BATCH_SIZE):
+        batch = rows[offset:offset + UPSERT_BATCH_SIZE]
+        stmt = insert(table).values(batch)
+        update_columns = [key for key in batch[0] if key not in primary_key]
+        if overwrite and len(update_columns) > 0:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=primary_key,
+                set_={key: stmt.excluded[key] for key in update_columns},
+                where=sql.or_(*(table.c[key].is_distinct_from(stmt.excluded[key]) for key in update_columns)))
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=primary_key)
+        if written is not None:
+            stmt = stmt.returning(table.c[primary_key[0]])
+            written.extend(key for key, in session.execute(stmt))
+        else:
+            session.execute(stmt)
+
+    return written
+
+
+def upsert_models(session: sqlalchemy.orm.Session,
+                  posts: Sequence[Post],
+                  users: Sequence[User],
+                  comments: Sequence[Comment],
+                  overwrite_users: bool = True) -> None:
+    upsert(session, User, [model_to_row(user) for user in users], overwrite=overwrite_users)
+    upsert(session, Post, [model_to_row(post) for post in posts])
+    upsert(session, Comment, [model_to_row(comment) for comment in comments])
+
+
+def get_comment_texts(session: sqlalchemy.orm.Session, comment_ids: Sequence[int]) -> Dict[int, str]:
+    if len(comment_ids) == 0:
+        return {}
+    query = session.query(Comment.comment_id, Comment.text).filter(Comment.comment_id.in_(comment_ids))
+    return {comment_id: text for comment_id, text in query}
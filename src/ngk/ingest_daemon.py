@@ -0,0 +1,190 @@
+import asyncio
+import functools
+import logging
+import signal
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, List, Optional, Set, TypeVar
+
+import requests
+
+from ngk import config, fetch_posts, parser_ru, parser_xyz, scan_comments
+from ngk.comments_processor import CommentsProcessor
+from ngk.id_map import IdMap
+from ngk.log import get_logger, redirect_basic_logging
+from ngk.poll_controller import PollController
+from ngk.rate_limit import HostRateLimiter
+from ngk.scheduler import RevisitScheduler
+from ngk.schema import ScopedSession
+from ngk.sync_queue import SyncQueue
+
+
+L = get_logger('ingest_daemon', logging.INFO)
+redirect_basic_logging(L)
+
+IO_WORKERS_EXTRA = 4  # sink pollers, claims, heartbeats on top of the post fetchers
+SHUTDOWN_TIMEOUT = 60
+
+T = TypeVar('T')
+
+
+# The ru and xyz sink pollers and the post fetchers as tasks on one event loop. Blocking
+# HTTP (ngk.http_client keep-alive pools) and DB (the SQLAlchemy engine pool) calls run on one
+# bounded thread pool, parsing on a process pool, and all tasks publish through one Redis client.
+# The thread pool and the fetch semaphore are the single place where backpressure applies.
+class IngestDaemon:
+    def __init__(self,
+                 fetch_concurrency: int = config.FETCH_POSTS_CONCURRENCY,
+                 parse_workers: int = config.INGEST_PARSE_WORKERS):
+        self.fetch_concurrency = max(1, fetch_concurrency)
+        self.io_pool = ThreadPoolExecutor(max_workers=self.fetch_concurrency + IO_WORKERS_EXTRA, thread_name_prefix='io')
+        self.parse_pool = ProcessPoolExecutor(max_workers=parse_workers)
+        self.processor = CommentsProcessor(config.REDIS_HOST,
+                                           config.REDIS_PORT,
+                                           config.REDIS_PASSWORD,
+                                           config.REDIS_CHANNEL,
+                                           L)
+        self.id_map = IdMap()
+        self.queue = SyncQueue()
+        self.revisits = RevisitScheduler()
+        self.limiter = HostRateLimiter(config.FETCH_POSTS_RATE, config.FETCH_POSTS_BURST)
+        self.in_flight: Set[int] = set()
+        self.stopping: Optional[asyncio.Event] = None
+
+    async def _io(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self.io_pool, functools.partial(func, *args, **kwargs))
+
+    # For the blocking fetch/apply functions: parses on the process pool from an io thread
+    def _offload(self, parse: Callable[[bytes], T]) -> Callable[[bytes], T]:
+        return lambda content: self.parse_pool.submit(parse, content).result()
+
+    # Returns True if the daemon is stopping
+    async def _sleep(self, delay: float) -> bool:
+        assert self.stopping is not None
+        try:
+            await asyncio.wait_for(self.stopping.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        return self.stopping.is_set()
+
+    def stop(self) -> None:
+        L.info('Exiting...')
+        assert self.stopping is not None
+        self.stopping.set()
+
+    async def _poll_sink(self, name: str, fetch: Callable[[int], Optional[List[T]]], get_id: Callable[[T], Optional[int]],
+                         update: Callable[[List[T]], Any]) -> None:
+        L.info(f'=== {name} poller started ===')
+        controller = PollController(scan_comments.MIN_DELAY, scan_comments.MAX_DELAY)
+        while True:
+            try:
+                comments = await self._io(scan_comments.poll_sink, fetch, get_id, controller, name)
+                if comments is not None:
+                    await self._io(scan_comments.update_sink, name, comments, update)
+            except Exception as e:
+                L.exception(e)
+            await self._io(scan_comments.publish_poll_metrics, controller, name)
+            if await self._sleep(controller.delay):
+                break
+        L.info(f'=== {name} poller stopped ===')
+
+    async def _acquire_fetch_token(self) -> bool:
+        assert self.stopping is not None
+        while True:
+            delay = self.limiter.try_acquire(fetch_posts.GK_HOST)
+            if delay == 0:
+                return True
+            if await self._sleep(delay):
+                return False
+
+    async def _sync_post(self, post_id: int, slots: asyncio.Semaphore) -> None:
+        try:
+            if not await self._acquire_fetch_token():
+                return
+            r: Optional[requests.Response] = await self._io(fetch_posts.fetch_post_limited, post_id, self.limiter, acquire=False)
+            if r is not None:
+                await self._io(fetch_posts.apply_fetched_post, post_id, r, self.processor, self._offload(parser_ru.parse_post))
+        except Exception as e:
+            L.exception(e)
+        finally:
+            try:
+                await self._io(self.queue.release, [post_id])
+            except Exception as e:
+                L.exception(e)
+            self.in_flight.discard(post_id)
+            slots.release()
+
+    async def _fetch_posts(self) -> None:
+        L.info(f'=== post fetcher started: {self.fetch_concurrency} posts in flight, worker {self.queue.worker_id} ===')
+        assert self.stopping is not None
+        slots = asyncio.Semaphore(self.fetch_concurrency)
+        tasks: Set['asyncio.Task[None]'] = set()
+        heartbeat_interval = self.queue.lease.total_seconds() / 3
+        loop = asyncio.get_running_loop()
+        last_heartbeat = loop.time()
+
+        while not self.stopping.is_set():
+            try:
+                enqueued = await self._io(self.revisits.tick)
+                if enqueued > 0:
+                    L.info(f'Scheduled {enqueued} posts for a revisit')
+
+                if loop.time() - last_heartbeat > heartbeat_interval:
+                    await self._io(self.queue.heartbeat, list(self.in_flight))
+                    last_heartbeat = loop.time()
+
+                free = self.fetch_concurrency - len(self.in_flight)
+                post_ids = await self._io(self.queue.claim, free) if free > 0 else []
+                for post_id in post_ids:
+                    await slots.acquire()
+                    self.in_flight.add(post_id)
+                    task = asyncio.ensure_future(self._sync_post(post_id, slots))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                delay = fetch_posts.SUCCESS_DELAY if len(post_ids) == 0 else 1
+            except Exception as e:
+                L.exception(e)
+                delay = fetch_posts.ERROR_DELAY
+            if await self._sleep(delay):
+                break
+
+        if len(tasks) > 0:
+            L.info(f'Waiting for {len(tasks)} posts in flight...')
+            await asyncio.wait(tasks, timeout=SHUTDOWN_TIMEOUT)
+        L.info('=== post fetcher stopped ===')
+
+    async def run(self) -> None:
+        self.stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.stop)
+
+        def load_id_map() -> int:
+            with ScopedSession() as session:
+                return self.id_map.load(session)
+        L.info(f'Loaded {await self._io(load_id_map)} ru-xyz comment id pairs')
+
+        fetch_ru = functools.partial(scan_comments.fetch_latest_comments, parse=self._offload(parser_ru.parse_sink))
+        fetch_xyz = functools.partial(scan_comments.fetch_latest_comments_xyz, parse=self._offload(parser_xyz.parse_sink))
+        update_ru = functools.partial(scan_comments.update_sync_states, processor=self.processor)
+        update_xyz = functools.partial(scan_comments.update_xyz_states, processor=self.processor, id_map=self.id_map)
+        try:
+            await asyncio.gather(
+                self._poll_sink('ru', fetch_ru, lambda c: c.id_ru, update_ru),
+                self._poll_sink('xyz', fetch_xyz, lambda c: c.id_xyz, update_xyz),
+                self._fetch_posts(),
+            )
+        finally:
+            # io threads still running may publish or wait for a parser process
+            self.io_pool.shutdown(wait=True)
+            self.processor.close()
+            self.parse_pool.shutdown(wait=True)
+            L.info('All tasks stopped. Goodbye!')
+
+
+def main() -> None:
+    L.info('=== started ===')
+    asyncio.run(IngestDaemon().run())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,43 @@
+import hashlib
+import io
 import re
 import time
 from datetime import datetime, timedelta, timezone
-from typing import Any, List, Optional, Tuple
+from typing import Any, Iterator, List, Optional, Tuple
 
 import lxml.etree
 
+from ngk import xpath
 from ngk.html_util import inner_html_ru, normalize_text
 from ngk.parser import ParsedComment, ParsedPost, ParsedUser, ParseError
 
 
+_XPATH_ENTRY_COMMENT = xpath.get('./div[contains(@class, "entry-comment")]')  # sink (/comments)
+_XPATH_COMMENT_TEXT = xpath.get('./span[@class="comment-text"]')              # normal post (/1234)
+_XPATH_ENTRY_INFO = xpath.get('./p[@class="entry-info"]')
+_XPATH_PUBLISHED = xpath.get('./abbr[@class="published"]')
+_XPATH_ENTRY_AUTHOR_LINK = xpath.get('./strong[@class="entry-author"]/a')
+_XPATH_AVATAR = xpath.get('./img[@class="avatar"]')
+_XPATH_COMMENT_WRAPPER = xpath.get('./div[@class="entry-comment-wrapper"]')
+_XPATH_COMMENT_LINK = xpath.get('./p[@class="entry-info"]/a[@class="comment-link"]')
+_XPATH_ALL_COMMENTS = xpath.get('.//li[@class="hcomment"]')
+_XPATH_TOP_COMMENTS = xpath.get('./li[@class="hcomment"]')
+_XPATH_CHILD_COMMENTS = xpath.get('./ul/li[@class="hcomment"]')
+
+_XPATH_POST = xpath.get('//li[@class="hentry"]')
+_XPATH_POST_AUTHOR = xpath.get('.//p[@class="author"]')
+_XPATH_POST_COMMENTS = xpath.get('./div[@class="entry-comments"]/ul')
+_XPATH_POST_AUTHOR_LINK = xpath.get('a[1]')
+_XPATH_POST_AUTHOR_NAME = xpath.get('./a[contains(@href, "/user/") and text()]')
+_XPATH_POST_AUTHOR_AVATAR = xpath.get('./a/img[@class="avatar"]')
+_XPATH_POST_TITLE = xpath.get('.//a[@class="entry-title"]')
+_XPATH_POST_LANGUAGE = xpath.get('.//a[@rel="chapter"]')
+_XPATH_POST_CONTENT = xpath.get('div[@class="entry-content"]')
+_XPATH_POST_CODE = xpath.get('.//code')
+_XPATH_POST_DESCRIPTION = xpath.get('div[@class="description"]')
+_XPATH_POST_DATE = xpath.get('./abbr')
+
+
 def _parse_date(date: str) -> datetime:
     date = re.sub(r'(\d\d):(\d\d)$', r'\1\2', date)
     return datetime.strptime(date, '%Y-%m-%dT%H:%M:%S%z').astimezone(timezone(timedelta()))
@@ -23,23 +52,23 @@ def _parse_avatar(url: str) -> Optional[str]:
 
 
 def _parse_comment_node(comment_wrapper: lxml.etree._Element, post_id: int, comment_id: int, parent_id: Optional[int] = None) -> ParsedComment:
-    entry_comment_node = comment_wrapper.xpath('./div[contains(@class, "entry-comment")]')[0]  # sink (/comments)
-    text_nodes = entry_comment_node.xpath('./span[@class="comment-text"]')          # normal post (/1234)
+    entry_comment_node = _XPATH_ENTRY_COMMENT(comment_wrapper)[0]
+    text_nodes = _XPATH_COMMENT_TEXT(entry_comment_node)
     if len(text_nodes) > 0:  
         entry_comment_node = text_nodes[0]
 
     text = normalize_text(inner_html_ru(entry_comment_node))
 
-    info_node = comment_wrapper.xpath('./p[@class="entry-info"]')[0]
-    time_posted = _parse_date(info_node.xpath('./abbr[@class="published"]')[0].get('title'))
+    info_node = _XPATH_ENTRY_INFO(comment_wrapper)[0]
+    time_posted = _parse_date(_XPATH_PUBLISHED(info_node)[0].get('title'))
 
-    user_node = info_node.xpath('./strong[@class="entry-author"]/a')[0]
+    user_node = _XPATH_ENTRY_AUTHOR_LINK(info_node)[0]
     m = re.search(r'/user/(\d+)$', user_node.get('href'))
     if m is None:
         raise ParseError('No comment\'s user id found')
     user_id = int(m.group(1))
     user_name = user_node.text
-    user_avatar_hash = _parse_avatar(info_node.xpath('./img[@class="avatar"]')[0].get('src'))
+    user_avatar_hash = _parse_avatar(_XPATH_AVATAR(info_node)[0].get('src'))
 
     comment = ParsedComment(id_ru=comment_id,
                             id_xyz=None,
@@ -52,36 +81,70 @@ def _parse_comment_node(comment_wrapper: lxml.etree._Element, post_id: int, comm
     return comment
 
 
+def _parse_comment_link(comment_wrapper: lxml.etree._Element) -> Tuple[int, int]:
+    comment_link = _XPATH_COMMENT_LINK(comment_wrapper)[0]
+    m = re.search(r'govnokod\.ru/(\d+)#comment(\d+)$', comment_link.get('href', ''))
+    if m is None:
+        raise ParseError('Invalid comment-link (no regex match)')
+    return int(m.group(1)), int(m.group(2))
+
+
 # all_at_once = True for the sink parsing (/comments), False for optimized post parsing
 def _parse_comments(comments_node: lxml.etree._Element, all_at_once: bool = False) -> List[ParsedComment]:
     comments: List[ParsedComment] = []
 
     if all_at_once:
-        hcomment_xpath = './/li[@class="hcomment"]'
+        hcomment_selector = _XPATH_ALL_COMMENTS
     else:
-        hcomment_xpath = './li[@class="hcomment"]'
+        hcomment_selector = _XPATH_TOP_COMMENTS
     
-    comment_nodes: List[Tuple[Optional[int], Any]] = [(None, c) for c in comments_node.xpath(hcomment_xpath)]
+    comment_nodes: List[Tuple[Optional[int], Any]] = [(None, c) for c in hcomment_selector(comments_node)]
 
     while len(comment_nodes) > 0:
         parent_id, comment_node = comment_nodes.pop()
 
-        comment_wrapper = comment_node.xpath('./div[@class="entry-comment-wrapper"]')[0]
-        comment_link = comment_wrapper.xpath('./p[@class="entry-info"]/a[@class="comment-link"]')[0]
-        m = re.search(r'govnokod\.ru/(\d+)#comment(\d+)$', comment_link.get('href', ''))
-        if m is None:
-            raise ParseError('Invalid comment-link (no regex match)')
-        post_id = int(m.group(1))
-        comment_id = int(m.group(2))
+        comment_wrapper = _XPATH_COMMENT_WRAPPER(comment_node)[0]
+        post_id, comment_id = _parse_comment_link(comment_wrapper)
         comments.append(_parse_comment_node(comment_wrapper, post_id, comment_id, parent_id))
 
-        for node in comment_node.xpath('./ul/li[@class="hcomment"]'):
+        for node in _XPATH_CHILD_COMMENTS(comment_node):
             comment_nodes.append((comment_id, node))
 
     return comments
 
 
-def parse_sink(content: bytes) -> List[ParsedComment]:
+# Single pass over the sink: every comment is parsed once, when its
+# <li class="hcomment"> closes, and its subtree is freed right after.
+def iter_sink(content: bytes) -> Iterator[ParsedComment]:
+    events = lxml.etree.iterparse(io.BytesIO(content), events=('end',), tag='li', html=True, recover=True, huge_tree=True)
+    for _, comment_node in events:
+        if comment_node.get('class') != 'hcomment':
+            continue
+
+        parent_id = None
+        parent_node = comment_node.getparent()
+        if parent_node is not None and parent_node.tag == 'ul':
+            parent_node = parent_node.getparent()
+            if parent_node is not None and parent_node.tag == 'li' and parent_node.get('class') == 'hcomment':
+                parent_id = _parse_comment_link(_XPATH_COMMENT_WRAPPER(parent_node)[0])[1]
+
+        comment_wrapper = _XPATH_COMMENT_WRAPPER(comment_node)[0]
+        post_id, comment_id = _parse_comment_link(comment_wrapper)
+        yield _parse_comment_node(comment_wrapper, post_id, comment_id, parent_id)
+
+        comment_node.clear()
+        while comment_node.getprevious() is not None:
+            del comment_node.getparent()[0]
+
+
+# streaming = False falls back to the full DOM parser (kept for comparison)
+def parse_sink(content: bytes, streaming: bool = True) -> List[ParsedComment]:
+    if streaming:
+        # _parse_comments() pops its stack from the end, so the sink comes out in reverse document order
+        comments = list(iter_sink(content))
+        comments.reverse()
+        return comments
+
     parser = lxml.etree.HTMLParser(recover=True, huge_tree=True)
     root = lxml.etree.HTML(content, parser=parser)
     return _parse_comments(root, all_at_once=True)
@@ -105,27 +168,27 @@ def parse_post(content: bytes) -> ParsedPost:
     root = lxml.etree.HTML(content, parser=parser)
 
     try:
-        post_node = root.xpath('//li[@class="hentry"]')[0]
-        author_node = post_node.xpath('.//p[@class="author"]')[0]
-        comments_node = post_node.xpath('./div[@class="entry-comments"]/ul')[0]
+        post_node = _XPATH_POST(root)[0]
+        author_node = _XPATH_POST_AUTHOR(post_node)[0]
+        comments_node = _XPATH_POST_COMMENTS(post_node)[0]
     except IndexError:
         raise ParseError('Invalid document (no post_node/author_node/comments_node)')
 
     # author info
-    user_url = author_node.xpath('a[1]')[0].get('href')
+    user_url = _XPATH_POST_AUTHOR_LINK(author_node)[0].get('href')
     m = re.search(r'/user/(\d+)$', user_url)
     if m is None:
         raise ParseError('No post\'s user id found')
     user_id = int(m.group(1))
-    user_name = author_node.xpath('./a[contains(@href, "/user/") and text()]')[0].text
+    user_name = _XPATH_POST_AUTHOR_NAME(author_node)[0].text
     try:
-        user_avatar_hash = _parse_avatar(author_node.xpath('./a/img[@class="avatar"]')[0].get('src'))
+        user_avatar_hash = _parse_avatar(_XPATH_POST_AUTHOR_AVATAR(author_node)[0].get('src'))
     except IndexError:  # Old posts by guest
         user_avatar_hash = None
     user = ParsedUser(id_ru=user_id, id_xyz=None, name=user_name, avatar_hash=user_avatar_hash)
 
     # post
-    post_url = post_node.xpath('.//a[@class="entry-title"]')[0].get('href')
+    post_url = _XPATH_POST_TITLE(post_node)[0].get('href')
     m = re.search(r'/(\d+)$', post_url)
     if m is None:
         raise ParseError('Post id not found')
@@ -137,19 +200,19 @@ def parse_post(content: bytes) -> ParsedPost:
         raise ParseError('Comments_list_id not found')
     comment_list_id = int(m.group(1))
 
-    language = post_node.xpath('.//a[@rel="chapter"]')[0].text
+    language = _XPATH_POST_LANGUAGE(post_node)[0].text
 
-    post_content = post_node.xpath('div[@class="entry-content"]')[0]
-    post_code_nodes = post_content.xpath('.//code')
+    post_content = _XPATH_POST_CONTENT(post_node)[0]
+    post_code_nodes = _XPATH_POST_CODE(post_content)
     if len(post_code_nodes) > 0:
         code = post_code_nodes[0].text
     else:
         code = inner_html_ru(post_content)
     
-    text = normalize_text(inner_html_ru(post_node.xpath('div[@class="description"]')[0]))
+    text = normalize_text(inner_html_ru(_XPATH_POST_DESCRIPTION(post_node)[0]))
 
     try:
-        posted = _parse_date(author_node.xpath('./abbr')[0].get('title'))
+        posted = _parse_date(_XPATH_POST_DATE(author_node)[0].get('title'))
     except IndexError:
         raise ParseError('Post date not found (old html?)')
 
@@ -169,3 +232,17 @@ def parse_post(content: bytes) -> ParsedPost:
         time_parsed=time.time()
     )
     return post
+
+
+# Page fingerprint for skipping unchanged posts: a hash of the post and its comments with the votes,
+# which NGK does not store, stripped. Whitespace is kept: comment texts are stored with it.
+# Cheap enough to run before parse_post().
+_RE_FINGERPRINT_START = re.compile(rb'<li\s+class="hentry"')
+_RE_FINGERPRINT_END = re.compile(rb'<div\s+id="footer"')
+_RE_FINGERPRINT_VOTES = re.compile(rb'<span\s+class="comment-vote">.*?</span>', re.DOTALL)
+def fingerprint_post(content: bytes) -> str:
+    start = _RE_FINGERPRINT_START.search(content)
+    end = _RE_FINGERPRINT_END.search(content, start.end() if start is not None else 0)
+    region = content[start.start() if start is not None else 0:end.start() if end is not None else len(content)]
+    region = _RE_FINGERPRINT_VOTES.sub(b'', region)
+    return hashlib.blake2b(region, digest_size=16).hexdigest()
@@ -11,6 +11,7 @@ import lxml.etree
 import lxml.html
 import lxml.sax
 
+from ngk import xpath
 from ngk.html_util import inner_html_xyz, normalize_text
 from ngk.parse_error import ParseError
 from ngk.schema import DATE_FORMAT
@@ -21,6 +22,14 @@ _COMMENT_LINK_RU_RE = re.compile(r'^https?://govnokod.ru/(\d+)#comment(\d+)/?$')
 _USER_LINK_XYZ_RE = re.compile(r'^https?://govnokod.xyz/user/(\d+)/?$')
 _USER_LINK_RU_RE = re.compile(r'^https?://govnokod.ru/user/(\d+)/?$')
 
+_XPATH_COMMENTS = xpath.get('//li[@class="hcomment"]')
+_XPATH_COMMENT_ARTICLES = xpath.get('//article[starts-with(@id, "div-comment")]')
+_XPATH_ENTRY_INFO = xpath.get('.//p[@class="entry-info" or @class="comment-meta entry-info"]')
+_XPATH_ENTRY_COMMENT = xpath.get('.//div[@class="comment-content entry-comment" or @class="entry-comment"]')
+_XPATH_COMMENT_LINK = xpath.get('a[@class="comment-link"]')
+_XPATH_LINKS = xpath.get('.//a')
+_XPATH_TIME = xpath.get('.//time')
+
 
 class CommentXyz:
     __slots__ = ('id_ru', 'id_xyz', 'post_id', 'text', 'user_id_ru', 'user_id_xyz', 'time_posted', 'time_parsed')
@@ -88,19 +97,19 @@ class CommentXyz:
 def parse_comments(root: lxml.etree._Element) -> List[CommentXyz]:
     comments: List[CommentXyz] = []
 
-    comment_entry_nodes = root.xpath('//li[@class="hcomment"]')
+    comment_entry_nodes = _XPATH_COMMENTS(root)
     if len(comment_entry_nodes) == 0:
-        comment_entry_nodes = root.xpath('//article[starts-with(@id, "div-comment")]')
+        comment_entry_nodes = _XPATH_COMMENT_ARTICLES(root)
     if len(comment_entry_nodes) == 0:
         raise ParseError('No comment entries found')
 
     for comment_entry in comment_entry_nodes:
-        info_nodes = comment_entry.xpath('.//p[@class="entry-info" or @class="comment-meta entry-info"]')
+        info_nodes = _XPATH_ENTRY_INFO(comment_entry)
         if len(info_nodes) == 0:
             raise ParseError('No entry-info node found')
         info_node = info_nodes[0]
         
-        comment_nodes = comment_entry.xpath('.//div[@class="comment-content entry-comment" or @class="entry-comment"]')
+        comment_nodes = _XPATH_ENTRY_COMMENT(comment_entry)
         if len(comment_nodes) == 0:
             raise ParseError('No entry-comment node found')
         comment_node = comment_nodes[0]
@@ -112,7 +121,7 @@ def parse_comments(root: lxml.etree._Element) -> List[CommentXyz]:
         post_id = None
         comment_text = normalize_text(inner_html_xyz(comment_node))
 
-        comment_link_nodes = info_node.xpath('a[@class="comment-link"]')
+        comment_link_nodes = _XPATH_COMMENT_LINK(info_node)
         if len(comment_link_nodes) == 0:
             raise ParseError('No comment-link node found')
         comment_link = comment_link_nodes[0]
@@ -125,7 +134,7 @@ def parse_comments(root: lxml.etree._Element) -> List[CommentXyz]:
         if id_ru_attr is not None and len(id_ru_attr) > 0:
             id_ru = int(id_ru_attr)
         
-        for link_node in info_node.xpath('.//a'):
+        for link_node in _XPATH_LINKS(info_node):
             link = link_node.get('href', '')
 
             match = _COMMENT_LINK_XYZ_RE.match(link)
@@ -147,7 +156,7 @@ def parse_comments(root: lxml.etree._Element) -> List[CommentXyz]:
                 user_id_ru = int(match.group(1))
 
         try:
-            time_node = info_node.xpath('.//time')[0]
+            time_node = _XPATH_TIME(info_node)[0]
         except IndexError:
             raise ParseError('No time element found')
             
@@ -168,3 +177,7 @@ def parse_comments(root: lxml.etree._Element) -> List[CommentXyz]:
         comments.append(comment)
 
     return comments
+
+
+def parse_sink(content: bytes) -> List[CommentXyz]:
+    return parse_comments(lxml.etree.HTML(content))
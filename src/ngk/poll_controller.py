@@ -0,0 +1,74 @@
+import time
+from typing import Dict, Iterable, Optional, Set
+
+
+# Picks the delay before the next sink poll from an EWMA of the comment arrival rate,
+# so that a poll is expected to find at most `target_fill` of a sink page of new comments.
+# A poll that shares no comments with the previous one is an overflow: comments may have
+# been pushed past the first page, and the scanner should page deeper.
+class PollController:
+    def __init__(self,
+                 min_delay: float,
+                 max_delay: float,
+                 target_fill: float = 0.5,
+                 alpha: float = 0.3,
+                 max_ids: int = 1000):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.target_fill = target_fill
+        self.alpha = alpha
+        self.max_ids = max_ids
+        self.rate: float = 0.0  # comments per second
+        self.delay: float = min_delay
+        self.page_size: int = 0
+        self.polls: int = 0
+        self.overflows: int = 0
+        self.deep_pages: int = 0
+        self._seen: Set[int] = set()
+        self._last_poll: Optional[float] = None
+
+    # True if none of the page's ids were seen before: the scanner should fetch the next page
+    def is_overflow(self, ids: Iterable[int]) -> bool:
+        return len(self._seen) > 0 and self._seen.isdisjoint(ids)
+
+    def on_deep_page(self) -> None:
+        self.deep_pages += 1
+
+    # `ids`: every comment id fetched by this poll, deeper pages included; None if the sink has not changed
+    def observe(self,
+                ids: Optional[Iterable[int]],
+                page_size: int = 0,
+                overflow: bool = False,
+                now: Optional[float] = None) -> float:
+        now = now if now is not None else time.monotonic()
+        ids = set(ids) if ids is not None else self._seen
+        new_count = len(ids - self._seen)
+        self.page_size = max(self.page_size, page_size)
+        self.polls += 1
+        if overflow:
+            self.overflows += 1
+
+        if self._last_poll is not None and len(self._seen) > 0:
+            elapsed = max(1.0, now - self._last_poll)
+            sample = new_count / elapsed
+            self.rate = self.alpha * sample + (1 - self.alpha) * self.rate
+        self._last_poll = now
+
+        self._seen = ids if len(ids) <= self.max_ids else set(sorted(ids)[-self.max_ids:])
+
+        if self.rate > 0 and self.page_size > 0:
+            delay = self.target_fill * self.page_size / self.rate
+        else:
+            delay = self.max_delay
+        self.delay = min(self.max_delay, max(self.min_delay, delay))
+        return self.delay
+
+    def get_metrics(self) -> Dict[str, float]:
+        return {
+            'rate_per_min': self.rate * 60,
+            'delay': self.delay,
+            'page_size': self.page_size,
+            'polls': self.polls,
+            'overflows': self.overflows,
+            'deep_pages': self.deep_pages,
+        }
@@ -0,0 +1,121 @@
+import email.utils
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+
+# `now` arguments are time.monotonic() values, taken from the clock if None
+class TokenBucket:
+    def __init__(self, rate: float, burst: float, now: Optional[float] = None):
+        self.rate: float = rate
+        self.burst: float = burst
+        self.tokens: float = burst
+        self.updated: float = now if now is not None else time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Takes a token if one is available, otherwise returns the seconds to wait for it
+    def try_acquire(self, now: Optional[float] = None) -> float:
+        if now is None:
+            now = time.monotonic()
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class HostState:
+    def __init__(self, rate: float, burst: float, now: float):
+        self.bucket: TokenBucket = TokenBucket(rate, burst, now)
+        self.blocked_until: float = 0.0
+        self.backoff: float = 0.0
+
+
+# Token bucket per host. Failures (5xx, timeouts) halve the host's rate and block it
+# for an exponentially growing backoff; successes restore the rate step by step.
+class HostRateLimiter:
+    def __init__(self,
+                 rate: float,
+                 burst: float = 1.0,
+                 min_rate: Optional[float] = None,
+                 min_backoff: float = 5.0,
+                 max_backoff: float = 600.0):
+        self.rate: float = rate
+        self.burst: float = burst
+        self.min_rate: float = min_rate if min_rate is not None else rate / 16
+        self.min_backoff: float = min_backoff
+        self.max_backoff: float = max_backoff
+        self._hosts: Dict[str, HostState] = {}
+        self._lock = threading.Lock()
+
+    def _get_host(self, host: str, now: float) -> HostState:
+        state = self._hosts.get(host)
+        if state is None:
+            state = HostState(self.rate, self.burst, now)
+            self._hosts[host] = state
+        return state
+
+    # Takes a token for the host if one is available, otherwise returns the seconds to wait
+    def try_acquire(self, host: str, now: Optional[float] = None) -> float:
+        now = now if now is not None else time.monotonic()
+        with self._lock:
+            state = self._get_host(host, now)
+            if now < state.blocked_until:
+                return state.blocked_until - now
+            return state.bucket.try_acquire(now)
+
+    def acquire(self, host: str, stop_event: Optional[threading.Event] = None) -> bool:
+        while True:
+            delay = self.try_acquire(host)
+            if delay == 0:
+                return True
+            if stop_event is not None:
+                if stop_event.wait(delay):
+                    return False
+            else:
+                time.sleep(delay)
+
+    def on_success(self, host: str) -> None:
+        with self._lock:
+            state = self._get_host(host, time.monotonic())
+            state.backoff = 0.0
+            state.bucket.rate = min(self.rate, state.bucket.rate * 1.25)
+
+    def on_failure(self, host: str, now: Optional[float] = None) -> float:
+        now = now if now is not None else time.monotonic()
+        with self._lock:
+            state = self._get_host(host, now)
+            state.backoff = min(self.max_backoff, max(self.min_backoff, state.backoff * 2))
+            state.bucket.rate = max(self.min_rate, state.bucket.rate / 2)
+            state.blocked_until = max(state.blocked_until, now + state.backoff)
+            return state.backoff
+
+    def on_retry_after(self, host: str, seconds: float, now: Optional[float] = None) -> None:
+        now = now if now is not None else time.monotonic()
+        with self._lock:
+            state = self._get_host(host, now)
+            state.blocked_until = max(state.blocked_until, now + min(seconds, self.max_backoff))
+
+    def get_rate(self, host: str) -> float:
+        with self._lock:
+            return self._get_host(host, time.monotonic()).bucket.rate
+
+
+# Seconds to wait from a Retry-After header: delay-seconds or an HTTP-date, compared with `now`
+def parse_retry_after(value: Optional[str], now: Optional[datetime] = None) -> Optional[float]:
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max(0.0, (date - (now if now is not None else datetime.now(timezone.utc))).total_seconds())
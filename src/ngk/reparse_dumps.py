@@ -0,0 +1,251 @@
+import argparse
+import json
+import logging
+import os
+import pathlib
+import re
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+import sqlalchemy.sql as sql
+from sqlalchemy import Integer
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from ngk import config, ingest
+from ngk.dumps import DumpPage, is_archive, is_store, iter_pages, list_sources
+from ngk.log import get_logger, redirect_basic_logging
+from ngk.parser import ParsedPost
+import ngk.parser_ru as parser_ru
+from ngk.schema import Comment, Post, ScopedSession, SyncState, User
+
+
+L = get_logger('reparse_dumps', logging.INFO)
+redirect_basic_logging(L)
+
+CHECKPOINT_PATH = config.WORKING_DIR_PATH.joinpath('reparse_dumps.checkpoint.json')
+IN_FLIGHT_PER_WORKER = 4
+WRITE_BATCH_POSTS = 500
+# fetch_posts dumps a page while applying it, shortly before it sets SyncState.synced
+DUMP_APPLY_MARGIN = timedelta(minutes=1)
+# Sync results after which the DB holds the page with SyncState.fingerprint
+SYNCED_RESULTS = ('OK', 'Not modified', 'Not changed')
+
+_RE_DAY = re.compile(r'\d{4}-\d\d-\d\d')
+
+ParseResult = Tuple[str, Optional[datetime], Optional[ParsedPost], Optional[str], Optional[str]]
+SyncInfo = Tuple[Optional[datetime], Optional[str], Optional[str]]  # SyncState synced, result, fingerprint
+
+
+class DumpedPost(NamedTuple):
+    dumped: datetime  # datetime.min if unknown
+    fingerprint: str  # parser_ru.fingerprint_post() of the page
+    post: ParsedPost
+
+
+def _parse_page(page: DumpPage) -> ParseResult:
+    try:
+        return page.name, page.dumped, parser_ru.parse_post(page.content), parser_ru.fingerprint_post(page.content), None
+    except Exception as e:
+        return page.name, page.dumped, None, None, repr(e)
+
+
+def _day_name(source: pathlib.Path) -> str:
+    name = source.name
+    for suffix in ('.tar.gz', '.tgz'):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return name
+
+
+def get_sources(paths: Iterable[pathlib.Path]) -> List[pathlib.Path]:
+    sources: List[pathlib.Path] = []
+    for path in paths:
+        if is_archive(path) or is_store(path) or _RE_DAY.fullmatch(path.name) or not path.is_dir():
+            sources.append(path)
+        else:
+            sources.extend(p for p in list_sources(path) if p.is_dir() or is_archive(p))
+    return sources
+
+
+# done: finished sources; written: the dump time of the page each post was last written from
+class Checkpoint(NamedTuple):
+    done: Set[str]
+    written: Dict[int, datetime]
+
+
+def load_checkpoint(path: pathlib.Path) -> Checkpoint:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return Checkpoint(set(), {})
+    written = {int(post_id): datetime.fromisoformat(dumped) for post_id, dumped in data.get('written', {}).items()}
+    return Checkpoint(set(data['done']), written)
+
+
+def save_checkpoint(path: pathlib.Path, checkpoint: Checkpoint) -> None:
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({
+            'done': sorted(checkpoint.done),
+            'written': {str(post_id): dumped.isoformat() for post_id, dumped in sorted(checkpoint.written.items())},
+        }, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.pages = 0
+        self.errors = 0
+        self.posts = 0
+        self.comments = 0
+        self.skipped = 0  # posts with a newer copy in the DB or already written from a newer page
+
+    def __str__(self) -> str:
+        return f'{self.pages} pages, {self.errors} errors, {self.posts} posts, {self.comments} comments, ' + \
+               f'{self.skipped} skipped'
+
+
+def _collect(futures: Iterable['Future[ParseResult]'],
+             newest: Dict[int, DumpedPost],
+             stats: Stats) -> None:
+    for future in futures:
+        name, dumped, parsed_post, fingerprint, error = future.result()
+        stats.pages += 1
+        if parsed_post is None or fingerprint is None:
+            stats.errors += 1
+            L.warning(f'Failed to parse {name}: {error}')
+            continue
+        if parsed_post.id_ru is None:
+            continue
+        dumped = dumped or datetime.min
+        previous = newest.get(parsed_post.id_ru)
+        if previous is None or dumped >= previous.dumped:
+            newest[parsed_post.id_ru] = DumpedPost(dumped, fingerprint, parsed_post)
+
+
+# The newest page of every post in the source
+def parse_source(executor: ProcessPoolExecutor, source: pathlib.Path, workers: int, stats: Stats) -> Dict[int, DumpedPost]:
+    newest: Dict[int, DumpedPost] = {}
+    pending: Set['Future[ParseResult]'] = set()
+    for page in iter_pages([source]):
+        pending.add(executor.submit(_parse_page, page))
+        if len(pending) >= workers * IN_FLIGHT_PER_WORKER:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            _collect(done, newest, stats)
+    _collect(pending, newest, stats)
+    return newest
+
+
+def load_sync_states(post_ids: List[int]) -> Dict[int, SyncInfo]:
+    with ScopedSession() as session:
+        query = session.query(SyncState.post_id, SyncState.synced, SyncState.result, SyncState.fingerprint).filter(
+            SyncState.post_id == sql.any_(sql.bindparam('post_ids', post_ids, type_=ARRAY(Integer))))
+        return {post_id: (synced, result, fingerprint) for post_id, synced, result, fingerprint in query}
+
+
+# A dumped page is older than the DB copy if fetch_posts applied a different page after it
+def is_db_newer(dumped_post: DumpedPost, state: Optional[SyncInfo]) -> bool:
+    if state is None:
+        return False
+    synced, result, fingerprint = state
+    if synced is None or result not in SYNCED_RESULTS or fingerprint == dumped_post.fingerprint:
+        return False
+    return synced > dumped_post.dumped + DUMP_APPLY_MARGIN
+
+
+def write_posts(parsed_posts: Iterable[ParsedPost], stats: Stats) -> None:
+    posts: List[Post] = []
+    users: List[User] = []
+    comments: List[Comment] = []
+    for parsed_post in parsed_posts:
+        post, post_users, post_comments = ingest.post_to_models(parsed_post)
+        posts.append(post)
+        users.extend(post_users)
+        comments.extend(post_comments)
+
+    with ScopedSession() as session:
+        ingest.upsert_models(session, posts, users, comments)
+
+    stats.posts += len(posts)
+    stats.comments += len(comments)
+
+
+# Sources are written one by one and checkpointed with the dump time of every written post:
+# a post is only written again from a newer page, also in another source or a resumed run
+def write_source(newest: Dict[int, DumpedPost], written: Dict[int, datetime], stats: Stats) -> None:
+    post_ids = sorted(post_id for post_id, dumped_post in newest.items()
+                      if post_id not in written or dumped_post.dumped > written[post_id])
+    stats.skipped += len(newest) - len(post_ids)
+    for offset in range(0, len(post_ids), WRITE_BATCH_POSTS):
+        batch = post_ids[offset:offset + WRITE_BATCH_POSTS]
+        states = load_sync_states(batch)
+        parsed_posts: List[ParsedPost] = []
+        for post_id in batch:
+            if is_db_newer(newest[post_id], states.get(post_id)):
+                stats.skipped += 1
+            else:
+                parsed_posts.append(newest[post_id].post)
+        if len(parsed_posts) > 0:
+            write_posts(parsed_posts, stats)
+        for post_id in batch:
+            written[post_id] = newest[post_id].dumped
+
+
+def reparse(paths: Iterable[pathlib.Path], workers: int, checkpoint_path: pathlib.Path, dry_run: bool = False) -> Stats:
+    checkpoint = load_checkpoint(checkpoint_path)
+    today = datetime.utcnow().strftime('%Y-%m-%d')
+    stats = Stats()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for source in get_sources(paths):
+            if str(source) in checkpoint.done:
+                L.info(f'Skipping {source} (checkpoint)')
+                continue
+
+            started = time.time()
+            source_stats = Stats()
+            newest = parse_source(executor, source, workers, source_stats)
+            if dry_run:
+                source_stats.posts = len(newest)
+            else:
+                write_source(newest, checkpoint.written, source_stats)
+                # fetch_posts is still writing today's folder and the dump store
+                if _day_name(source) != today and not is_store(source):
+                    checkpoint.done.add(str(source))
+                save_checkpoint(checkpoint_path, checkpoint)
+            L.info(f'{source}: {source_stats} in {time.time() - started:.1f}s')
+
+            stats.pages += source_stats.pages
+            stats.errors += source_stats.errors
+            stats.posts += source_stats.posts
+            stats.comments += source_stats.comments
+            stats.skipped += source_stats.skipped
+
+    return stats
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description='Re-parse dumped post pages and re-import them into the DB')
+    arg_parser.add_argument('paths', nargs='*',
+                            help='Dumps folders, daily folders, .tar.gz archives or dump stores ' + \
+                                 '(default: DUMPS_DIR and DUMP_STORE_DIR)')
+    arg_parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Parser processes')
+    arg_parser.add_argument('--checkpoint', default=str(CHECKPOINT_PATH), help='Checkpoint file')
+    arg_parser.add_argument('--dry-run', action='store_true', help='Parse only, do not write to the DB')
+    args = arg_parser.parse_args()
+
+    L.info('=== started ===')
+    started = time.time()
+    if len(args.paths) > 0:
+        paths = [pathlib.Path(p) for p in args.paths]
+    else:
+        paths = [p for p in (config.DUMPS_DIR_PATH, config.DUMP_STORE_DIR_PATH) if p.exists()]
+    stats = reparse(paths, args.workers, pathlib.Path(args.checkpoint), args.dry_run)
+    L.info(f'=== done: {stats} in {time.time() - started:.1f}s ===')
+
+
+if __name__ == '__main__':
+    main()
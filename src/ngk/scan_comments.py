@@ -5,128 +5,228 @@ import re
 import signal
 import threading
 import time
-from typing import Any, List, Optional, Sequence, Tuple
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple, TypeVar
 
 import lxml
 import lxml.etree
-import requests
+import sqlalchemy.sql as sql
+from sqlalchemy import Integer
+from sqlalchemy.dialects.postgresql import ARRAY
 
-from ngk import config, parser_xyz
+from ngk import config, ingest, parser_xyz
 from ngk.comments_processor import CommentsProcessor
+from ngk.http_client import HTTP_NOT_MODIFIED, get_client
+from ngk.id_map import IdMap
 from ngk.log import get_logger, redirect_basic_logging
 from ngk.html_util import inner_html_ru, normalize_text
 from ngk.parse_error import ParseError
 from ngk.parser import ParsedComment, ParsedPost, ParsedUser
 from ngk.parser_ru import parse_sink, parse_post
-from ngk.schema import Comment, CommentIdStorage, ScopedSession, SyncState
+from ngk.poll_controller import PollController
+from ngk.schema import Comment, CommentIdStorage, ScopedSession, SyncState, count_queries
+from ngk.stats import Stats
 
 
 L = get_logger('scan_comments', logging.INFO)
 redirect_basic_logging(L)
 
 COMMENTS_URL = 'http://govnokod.ru/comments'
+COMMENTS_PAGE_URL = 'http://govnokod.ru/comments?page={page}'
 COMMENTS_URL_XYZ = 'https://govnokod.xyz/comments/'
-FAST_DELAY = 15
-SLOW_DELAY = 60
-FAST_TO_SLOW_STEPS = 20
+COMMENTS_PAGE_URL_XYZ = 'https://govnokod.xyz/comments/page/{page}/'
+MIN_DELAY = 10
+MAX_DELAY = 120
+MAX_SINK_PAGES = 5  # pages fetched by one poll when the sink overflows
+SINK_URLS = {
+    'ru': (COMMENTS_URL, COMMENTS_PAGE_URL),
+    'xyz': (COMMENTS_URL_XYZ, COMMENTS_PAGE_URL_XYZ),
+}
 
 GK_GUEST8_ID = 25580
 
 exit_event = threading.Event()
 threads_exited_events: List[threading.Event] = []
-
-
-def fetch_latest_comments() -> List[ParsedComment]:
-    L.debug("Fetching comments from ru...")
-    r = requests.get(COMMENTS_URL, headers=config.DEFAULT_HEADERS, timeout=30)
+stats = Stats(logger=L)
+
+
+# Both return None if the page has not changed since the previous fetch
+def fetch_latest_comments(page: int = 1,
+                          parse: Callable[[bytes], List[ParsedComment]] = parse_sink) -> Optional[List[ParsedComment]]:
+    L.debug(f"Fetching comments from ru (page {page})...")
+    url = COMMENTS_URL if page == 1 else COMMENTS_PAGE_URL.format(page=page)
+    client = get_client()
+    r = client.get(url)
+    if r.status_code == HTTP_NOT_MODIFIED:
+        return None
     r.raise_for_status()
-    return parse_sink(r.content)
-
-
-def fetch_latest_comments_xyz() -> List[parser_xyz.CommentXyz]:
-    L.debug("Fetching comments from xyz...")
-    r = requests.get(COMMENTS_URL_XYZ, headers=config.DEFAULT_HEADERS, timeout=30)
+    try:
+        return parse(r.content)
+    except Exception:
+        client.forget(url)
+        raise
+
+
+def fetch_latest_comments_xyz(page: int = 1,
+                              parse: Callable[[bytes], List[parser_xyz.CommentXyz]] = parser_xyz.parse_sink
+                              ) -> Optional[List[parser_xyz.CommentXyz]]:
+    L.debug(f"Fetching comments from xyz (page {page})...")
+    url = COMMENTS_URL_XYZ if page == 1 else COMMENTS_PAGE_URL_XYZ.format(page=page)
+    client = get_client()
+    r = client.get(url)
+    if r.status_code == HTTP_NOT_MODIFIED:
+        return None
     r.raise_for_status()
-    root = lxml.etree.HTML(r.content)
-    return parser_xyz.parse_comments(root)
+    try:
+        return parse(r.content)
+    except Exception:
+        client.forget(url)
+        raise
+
+
+SinkComment = TypeVar('SinkComment', ParsedComment, parser_xyz.CommentXyz)
+
+
+# Polls the sink: returns None if it has not changed, otherwise its first page and, if the
+# controller sees an overflow, the deeper pages up to the first one overlapping the previous poll
+def poll_sink(fetch: Callable[[int], Optional[List[SinkComment]]],
+              get_id: Callable[[SinkComment], Optional[int]],
+              controller: PollController,
+              name: str) -> Optional[List[SinkComment]]:
+    comments = fetch(1)
+    if comments is None:
+        controller.observe(None)
+        return None
+
+    page_size = len(comments)
+    overflow = controller.is_overflow(get_id(c) for c in comments)
+    if overflow:
+        L.warning(f'{name}: sink overflow, fetching up to {MAX_SINK_PAGES - 1} more pages')
+        for page in range(2, MAX_SINK_PAGES + 1):
+            deeper = fetch(page) or []
+            controller.on_deep_page()
+            comments.extend(deeper)
+            if len(deeper) == 0 or not controller.is_overflow(get_id(c) for c in deeper):
+                break
+
+    controller.observe((i for i in map(get_id, comments) if i is not None), page_size, overflow)
+    return comments
+
+
+# Drops the validators of every page poll_sink() may have fetched, so the next poll downloads them again
+def forget_sink(name: str) -> None:
+    client = get_client()
+    first_url, page_url = SINK_URLS[name]
+    client.forget(first_url)
+    for page in range(2, MAX_SINK_PAGES + 1):
+        client.forget(page_url.format(page=page))
+
+
+# The pages are not modified for the HTTP client once fetched: if applying them fails,
+# the next poll has to download them unconditionally or their comments are lost
+def update_sink(name: str, comments: List[SinkComment], update: Callable[[List[SinkComment]], Any]) -> None:
+    try:
+        update(comments)
+    except Exception:
+        forget_sink(name)
+        raise
+
+
+def publish_poll_metrics(controller: PollController, name: str) -> None:
+    metrics = controller.get_metrics()
+    stats.set_many({f'poll_{name}_{key}': value for key, value in metrics.items()})
+    L.debug(f'{name}: {metrics["rate_per_min"]:.2f} comments/min, next poll in {metrics["delay"]:.0f}s, ' + \
+            f'{metrics["overflows"]} overflows')
 
 
 def update_sync_states(comments: Sequence[ParsedComment], processor: CommentsProcessor) -> bool:
+    started = time.perf_counter()
     has_updates = False
     updated_comments: List[Comment] = []
+    comment_ids = list({comment.id_ru for comment in comments})
+    post_ids = list({comment.post_id for comment in comments})
+
     with ScopedSession() as session:
-        for comment_sink in comments:
-            post_id, comment_id, comment_text = comment_sink.post_id, comment_sink.id_ru, comment_sink.text
-            comment_db = session.query(Comment).filter(Comment.comment_id == comment_id).first()
-            if comment_db is not None and comment_db.text != comment_text:
-                comment_db.text = comment_text
-                updated_comments.append(comment_db)
-
-            state = session.query(SyncState).filter(SyncState.post_id == post_id).one_or_none()
-            if not state:
-                L.info("Got new comment %d for new post %d", comment_id, post_id)
-                has_updates = True
-                state = SyncState(post_id=post_id, last_comment_id=comment_id, pending=True, priority=SyncState.PRIORITY_HAS_COMMENTS)
-                session.add(state)
-            else:
-                if state.last_comment_id is None or comment_id > state.last_comment_id:
+        with count_queries(session) as queries:
+            comments_db = {c.comment_id: c for c in session.query(Comment).filter(
+                Comment.comment_id == sql.any_(sql.bindparam('comment_ids', comment_ids, type_=ARRAY(Integer))))}
+            last_comment_ids: Dict[int, Optional[int]] = {post_id: last_comment_id for post_id, last_comment_id in session.query(
+                SyncState.post_id, SyncState.last_comment_id).filter(
+                SyncState.post_id == sql.any_(sql.bindparam('post_ids', post_ids, type_=ARRAY(Integer))))}
+
+            changed_post_ids: Set[int] = set()
+            for comment_sink in comments:
+                post_id, comment_id, comment_text = comment_sink.post_id, comment_sink.id_ru, comment_sink.text
+                comment_db = comments_db.get(comment_id)
+                if comment_db is not None and comment_db.text != comment_text:
+                    comment_db.text = comment_text
+                    updated_comments.append(comment_db)
+
+                if post_id not in last_comment_ids:
+                    L.info("Got new comment %d for new post %d", comment_id, post_id)
+                else:
+                    last_comment_id = last_comment_ids[post_id]
+                    if last_comment_id is not None and comment_id <= last_comment_id:
+                        continue
                     L.info("Got new comment %d for post %d", comment_id, post_id)
-                    has_updates = True
-                    state.last_comment_id = comment_id
-                    state.pending = True
-                    state.priority=SyncState.PRIORITY_HAS_COMMENTS
+                has_updates = True
+                last_comment_ids[post_id] = comment_id
+                changed_post_ids.add(post_id)
+
+            if len(changed_post_ids) > 0:
+                ingest.upsert(session, SyncState, [
+                    {
+                        'post_id': post_id,
+                        'last_comment_id': last_comment_ids[post_id],
+                        'pending': True,
+                        'priority': SyncState.PRIORITY_HAS_COMMENTS
+                    } for post_id in changed_post_ids
+                ])
+            session.flush()
+
+        L.info(f'Reconciled {len(comments)} sink comments with {queries.count} queries ' + \
+                f'in {(time.perf_counter() - started) * 1000:.0f} ms')
 
         if len(updated_comments) > 0:
             L.info(f'Fast-fetched {len(updated_comments)} updated ' + \
                    f'comment{"s" if len(updated_comments) > 1 else ""}: {[c.comment_id for c in updated_comments]}')
             session.commit()
-            processor.on_comments_update([], updated_comments)
+            processor.on_comments_update([], updated_comments, changed_fields=('text',))
 
     return has_updates
 
 
-def update_xyz_states(comments: Sequence[parser_xyz.CommentXyz], processor: CommentsProcessor) -> None:
-    with ScopedSession() as session:   
-        updated_comments = []
-        prefetched_comment_id_pairs = []
-        for comment in comments:
-            if comment.id_xyz is not None and comment.id_ru is not None:
-                comment_db = session.query(Comment).filter(Comment.comment_id == comment.id_ru).first()
-                if comment_db is None or comment_db.comment_id_storage is None:
-                    id_storage = session.query(CommentIdStorage).filter(CommentIdStorage.comment_id_ru == comment.id_ru).first()
-                    if id_storage is None:
-                        id_storage = CommentIdStorage()
-                        id_storage.comment_id_ru = comment.id_ru
-                        id_storage.comment_id_xyz = comment.id_xyz
-                        session.add(id_storage)
-                        prefetched_comment_id_pairs.append((comment.id_ru, comment.id_xyz))
-                    elif id_storage.comment_id_xyz != comment.id_xyz:
-                        id_storage.comment_id_xyz = comment.id_xyz
-                        prefetched_comment_id_pairs.append((comment.id_ru, comment.id_xyz))
-
-                    if comment_db is not None:
-                        comment_db.comment_id_storage = id_storage
-                        updated_comments.append(comment_db)
-
-                elif comment_db.comment_id_storage.comment_id_xyz != comment.id_xyz:
-                    comment_db.comment_id_storage.comment_id_xyz = comment.id_xyz
-                    session.merge(comment_db.comment_id_storage)
-                    updated_comments.append(comment_db)
+def update_xyz_states(comments: Sequence[parser_xyz.CommentXyz], processor: CommentsProcessor, id_map: IdMap) -> None:
+    pairs = [(comment.id_ru, comment.id_xyz) for comment in comments if comment.id_xyz is not None and comment.id_ru is not None]
+    changed_pairs = id_map.diff(pairs)
+    if len(changed_pairs) == 0:
+        return
 
+    with ScopedSession() as session:
+        ingest.upsert(session, CommentIdStorage, [
+            {'comment_id_ru': id_ru, 'comment_id_xyz': id_xyz} for id_ru, id_xyz in changed_pairs
+        ])
+        updated_comments: List[Comment] = session.query(Comment) \
+            .filter(Comment.comment_id.in_([id_ru for id_ru, _ in changed_pairs])) \
+            .all()
+
+        updated_ids = {comment.comment_id for comment in updated_comments}
+        prefetched_comment_id_pairs: list = [pair for pair in changed_pairs if pair[0] not in updated_ids]
         if len(prefetched_comment_id_pairs) > 0:
-            session.flush()
-            to_print: list = prefetched_comment_id_pairs[:5]
+            to_print = prefetched_comment_id_pairs[:5]
             if len(prefetched_comment_id_pairs) > 5:
                 to_print.append('...')
             L.info(f'Prefetched xyz ids for {len(prefetched_comment_id_pairs)} comments: [{", ".join(map(str, to_print))}]')
+            # The API keeps its own id map: it gets the pairs before the comments reach the DB
+            processor.on_id_pairs(prefetched_comment_id_pairs)
 
         if len(updated_comments) > 0:
-            session.commit()
             to_print = [(c.comment_id, c.comment_id_storage.comment_id_xyz) for c in updated_comments[:5]]
             if len(updated_comments) > 5:
                 to_print.append('...')
             L.info(f'Fetched xyz ids for {len(updated_comments)} comments: [{", ".join(map(str, to_print))}]')
-            processor.on_comments_update([], updated_comments)
+            processor.on_comments_update([], updated_comments, changed_fields=('id_xyz',))
+
+    id_map.update(changed_pairs)
 
 
 def worker_ru(thread_exited_event: threading.Event) -> None:
@@ -137,26 +237,20 @@ def worker_ru(thread_exited_event: threading.Event) -> None:
                                   config.REDIS_CHANNEL,
                                   L)
     L.info("=== ru worker started ===")
-    fast_requests = 0
+    controller = PollController(MIN_DELAY, MAX_DELAY)
     while True:
         try:
-            comments = fetch_latest_comments()
-            has_updates = update_sync_states(comments, processor)
-            if has_updates:
-                fast_requests = FAST_TO_SLOW_STEPS
+            comments = poll_sink(fetch_latest_comments, lambda c: c.id_ru, controller, 'ru')
+            if comments is not None:
+                update_sink('ru', comments, lambda c: update_sync_states(c, processor))
         except Exception as e:
             L.exception(e)
-            fast_requests = 0
+        publish_poll_metrics(controller, 'ru')
 
-        if fast_requests > 0:
-            delay = FAST_DELAY
-            fast_requests -= 1
-        else:
-            delay = SLOW_DELAY
-
-        if exit_event.wait(delay):
+        if exit_event.wait(controller.delay):
             break
-        
+
+    processor.close()
     thread_exited_event.set()
 
 
@@ -168,29 +262,23 @@ def worker_xyz(thread_exited_event: threading.Event) -> None:
                                   config.REDIS_CHANNEL,
                                   L)
     L.info("=== xyz worker started ===")
-    fast_requests = 0
-    last_xyz_id: Optional[int] = -1
+    id_map = IdMap()
+    with ScopedSession() as session:
+        L.info(f'Loaded {id_map.load(session)} ru-xyz comment id pairs')
+    controller = PollController(MIN_DELAY, MAX_DELAY)
     while True:
         try:
-            comments = fetch_latest_comments_xyz()
-            update_xyz_states(comments, processor)
-
-            if comments[0].id_xyz != last_xyz_id:
-                fast_requests = FAST_TO_SLOW_STEPS
-                last_xyz_id = comments[0].id_xyz
+            xyz_comments = poll_sink(fetch_latest_comments_xyz, lambda c: c.id_xyz, controller, 'xyz')
+            if xyz_comments is not None:
+                update_sink('xyz', xyz_comments, lambda c: update_xyz_states(c, processor, id_map))
         except Exception as e:
             L.exception(e)
-            fast_requests = 0
-
-        if fast_requests > 0:
-            delay = FAST_DELAY
-            fast_requests -= 1
-        else:
-            delay = SLOW_DELAY
+        publish_poll_metrics(controller, 'xyz')
 
-        if exit_event.wait(delay):
+        if exit_event.wait(controller.delay):
             break
 
+    processor.close()
     thread_exited_event.set()
 
 
@@ -0,0 +1,112 @@
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Iterable, Optional
+
+import sqlalchemy.sql as sql
+from sqlalchemy.sql.expression import func
+
+from ngk import config
+from ngk.schema import ScopedSession, SyncState
+
+
+RATE_WINDOW = 24 * 3600        # comments within this window make up the comment rate
+DECAY_FACTOR = 0.5             # revisit after half the time since the last comment...
+MIN_INTERVAL = 10 * 60
+MAX_INTERVAL = 7 * 24 * 3600
+COLD_AGE = 30 * 24 * 3600      # ...and never, once the thread has been quiet for a month
+
+BASE_BACKOFF = 5 * 60
+MAX_BACKOFF = 24 * 3600
+MAX_FAILURES = 10
+
+SCHEDULE_INTERVAL = 60
+
+
+# Seconds until the next visit of a post whose comments (and the post itself) were posted
+# at `posted_timestamps`, or None for a cold thread that only the sink should wake up
+def get_revisit_interval(posted_timestamps: Iterable[float], now: Optional[float] = None) -> Optional[float]:
+    now = now or time.time()
+    last_posted: Optional[float] = None
+    recent = 0
+    for posted in posted_timestamps:
+        if last_posted is None or posted > last_posted:
+            last_posted = posted
+        if now - posted < RATE_WINDOW:
+            recent += 1
+    if last_posted is None or now - last_posted > COLD_AGE:
+        return None
+
+    interval = max(0.0, now - last_posted) * DECAY_FACTOR
+    if recent > 0:
+        interval = min(interval, RATE_WINDOW / recent)
+    return min(MAX_INTERVAL, max(MIN_INTERVAL, interval))
+
+
+def get_backoff(failures: int) -> float:
+    backoff = min(MAX_BACKOFF, BASE_BACKOFF * 2 ** (failures - 1))
+    return backoff * random.uniform(0.5, 1.0)
+
+
+def schedule_success(state: SyncState, posted_timestamps: Iterable[float]) -> None:
+    state.failures = 0
+    interval = get_revisit_interval(posted_timestamps)
+    state.revisit_interval = int(interval) if interval is not None else None
+    state.next_visit = datetime.utcnow() + timedelta(seconds=interval) if interval is not None else None
+
+
+# The page is the same as last time: the thread is cooling down
+def schedule_unchanged(state: SyncState) -> None:
+    state.failures = 0
+    if state.revisit_interval is None:
+        state.next_visit = None
+        return
+    state.revisit_interval = min(MAX_INTERVAL, state.revisit_interval * 2)
+    state.next_visit = datetime.utcnow() + timedelta(seconds=state.revisit_interval)
+
+
+def schedule_failure(state: SyncState) -> None:
+    state.failures = (state.failures or 0) + 1
+    if state.failures > MAX_FAILURES:
+        state.next_visit = None
+        return
+    state.next_visit = datetime.utcnow() + timedelta(seconds=get_backoff(state.failures))
+
+
+# Marks due posts as pending, hottest threads first, without letting all fetches
+# (sink-triggered ones included) exceed `budget_per_hour`. Returns the number of enqueued posts.
+def enqueue_due(budget_per_hour: int = config.REVISIT_BUDGET_PER_HOUR) -> int:
+    table = SyncState.__table__
+    now = datetime.utcnow()
+    with ScopedSession() as session:
+        fetched = session.query(func.count(SyncState.post_id)).filter(SyncState.synced > now - timedelta(hours=1)).scalar()
+        pending = session.query(func.count(SyncState.post_id)).filter(SyncState.pending == True).scalar()
+        budget = budget_per_hour - fetched - pending
+        if budget <= 0:
+            return 0
+
+        # Uses the sync_states_next_visit partial index
+        due = sql.select([table.c.post_id]) \
+            .where(table.c.pending == False) \
+            .where(table.c.next_visit <= now) \
+            .order_by(table.c.revisit_interval.asc().nullslast(), table.c.next_visit.asc()) \
+            .limit(budget) \
+            .with_for_update(skip_locked=True)
+        stmt = table.update() \
+            .where(table.c.post_id.in_(due)) \
+            .values(pending=True, priority=SyncState.PRIORITY_REVISIT, next_visit=None)
+        return int(session.execute(stmt).rowcount)
+
+
+class RevisitScheduler:
+    def __init__(self, budget_per_hour: int = config.REVISIT_BUDGET_PER_HOUR, interval: float = SCHEDULE_INTERVAL):
+        self.budget_per_hour = budget_per_hour
+        self.interval = interval
+        self.last_run = 0.0
+
+    # Cheap to call on every iteration of a fetch loop
+    def tick(self) -> int:
+        if time.monotonic() - self.last_run < self.interval:
+            return 0
+        self.last_run = time.monotonic()
+        return enqueue_due(self.budget_per_hour)
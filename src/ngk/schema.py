@@ -2,7 +2,7 @@ import datetime
 import re
 import time
 from contextlib import contextmanager
-from typing import Any, Dict, Iterator
+from typing import TYPE_CHECKING, Any, Dict, Iterator, Optional
 
 import sqlalchemy.orm
 from sqlalchemy import (Boolean, Column, DateTime, ForeignKey, Integer,
@@ -15,6 +15,9 @@ from sqlalchemy.types import ARRAY
 from ngk import config
 from ngk.html_util import normalize_text
 
+if TYPE_CHECKING:
+    from ngk.id_map import IdMap
+
 
 DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 
@@ -37,6 +40,26 @@ def ScopedSession() -> Iterator[sqlalchemy.orm.Session]:
         session.close()
 
 
+class QueryCounter:
+    def __init__(self) -> None:
+        self.count = 0
+
+    def __call__(self, *args: Any) -> None:
+        self.count += 1
+
+
+# Counts the statements sent over the session's current connection
+@contextmanager
+def count_queries(session: sqlalchemy.orm.Session) -> Iterator[QueryCounter]:
+    counter = QueryCounter()
+    connection = session.connection()
+    event.listen(connection, 'before_cursor_execute', counter)
+    try:
+        yield counter
+    finally:
+        event.remove(connection, 'before_cursor_execute', counter)
+
+
 class SyncState(Base):
     __tablename__ = 'sync_states'
 
@@ -46,9 +69,16 @@ class SyncState(Base):
     priority = Column(Integer)
     synced = Column(DateTime)
     result = Column(String)
+    fingerprint = Column(String)  # parser_ru.fingerprint_post() of the last synced page
+    claimed_by = Column(String)  # sync_queue lease
+    claimed_until = Column(DateTime)
+    next_visit = Column(DateTime)  # scheduler revisit/retry time, None: wait for the sink
+    revisit_interval = Column(Integer)
+    failures = Column(Integer)
 
     PRIORITY_HAS_COMMENTS = 10
     PRIORITY_DUMP = 9
+    PRIORITY_REVISIT = 5
 
 
 class User(Base):
@@ -138,10 +168,15 @@ class Comment(Base):
     def is_edit_expired(self) -> bool:
         return time.time() - (self.posted or datetime.datetime.now()).timestamp() > Comment._EDIT_EXPIRE_SEC
 
-    def to_dict(self) -> Dict[str, Any]:
+    # With an id_map, comment_id_storage is not touched: query with noload(Comment.comment_id_storage)
+    def to_dict(self, id_map: Optional['IdMap'] = None) -> Dict[str, Any]:
+        if id_map is not None:
+            id_xyz = id_map.get_xyz(self.comment_id)
+        else:
+            id_xyz = self.comment_id_storage.comment_id_xyz if self.comment_id_storage is not None else None
         return {
             'id': self.comment_id,
-            'id_xyz': self.comment_id_storage.comment_id_xyz if self.comment_id_storage is not None else None,
+            'id_xyz': id_xyz,
             'parent_id': self.parent_id,
             'post_id': self.post_id,
             'text': normalize_text(self.text or ''),
@@ -0,0 +1,98 @@
+import logging
+import threading
+from typing import Dict, Mapping, Optional, Union
+
+import redis
+
+from ngk import config
+from ngk.log import get_logger
+
+
+L = get_logger('stats', logging.INFO)
+
+STATS_KEY = config.REDIS_PREFIX + 'stats'
+
+FINGERPRINT_HITS = 'fingerprint_hits'
+FINGERPRINT_MISSES = 'fingerprint_misses'
+
+
+def _parse_number(value: bytes) -> Union[int, float]:
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+# Counters and gauges shared by all NGK processes, stored in a Redis hash. Failures are logged
+# and swallowed: the stats must never break fetching.
+class Stats:
+    def __init__(self,
+                 redis_host: str = config.REDIS_HOST,
+                 redis_port: int = config.REDIS_PORT,
+                 redis_password: str = config.REDIS_PASSWORD,
+                 redis_db: int = config.REDIS_DB,
+                 key: str = STATS_KEY,
+                 logger: logging.Logger = L):
+        self.logger = logger
+        self.redis = redis.Redis(host=redis_host, port=redis_port, password=redis_password, db=redis_db)
+        self.key = key
+
+    def incr(self, field: str, amount: int = 1) -> Optional[int]:
+        try:
+            return int(self.redis.hincrby(self.key, field, amount))
+        except redis.RedisError as e:
+            self.logger.warning(f'Stats: could not increment {field}: {e!r}')
+            return None
+
+    def incr_many(self, values: Mapping[str, int]) -> None:
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            for field, amount in values.items():
+                pipeline.hincrby(self.key, field, amount)
+            pipeline.execute()
+        except redis.RedisError as e:
+            self.logger.warning(f'Stats: could not increment {list(values)}: {e!r}')
+
+    def set_many(self, values: Mapping[str, Union[int, float]]) -> None:
+        try:
+            self.redis.hset(self.key, mapping=dict(values))
+        except redis.RedisError as e:
+            self.logger.warning(f'Stats: could not set {list(values)}: {e!r}')
+
+    def get_all(self) -> Dict[str, Union[int, float]]:
+        try:
+            return {k.decode('utf-8'): _parse_number(v) for k, v in self.redis.hgetall(self.key).items()}
+        except redis.RedisError as e:
+            self.logger.warning(f'Stats: could not read {self.key}: {e!r}')
+            return {}
+
+
+# Keeps counters and gauges in memory for a hot loop; flush() writes them to `stats` with at most
+# two round trips, e.g. from a timer
+class StatsBuffer:
+    def __init__(self, stats: Stats):
+        self.stats = stats
+        self._counters: Dict[str, int] = {}
+        self._gauges: Dict[str, Union[int, float]] = {}
+        self._lock = threading.Lock()
+
+    def incr(self, field: str, amount: int = 1) -> None:
+        self.incr_many({field: amount})
+
+    def incr_many(self, values: Mapping[str, int]) -> None:
+        with self._lock:
+            for field, amount in values.items():
+                self._counters[field] = self._counters.get(field, 0) + amount
+
+    def set_many(self, values: Mapping[str, Union[int, float]]) -> None:
+        with self._lock:
+            self._gauges.update(values)
+
+    def flush(self) -> None:
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            gauges, self._gauges = self._gauges, {}
+        if len(counters) > 0:
+            self.stats.incr_many(counters)
+        if len(gauges) > 0:
+            self.stats.set_many(gauges)
@@ -0,0 +1,112 @@
+from collections import defaultdict
+from typing import Any, Dict, FrozenSet, Iterable, List, Mapping, NamedTuple, Optional, Set
+
+
+Comment = Dict[str, Any]  # Comment.to_dict()
+
+MAX_IDS = 1000  # per filter
+
+
+def _parse_ids(values: Any, limit: int) -> FrozenSet[int]:
+    if values is None:
+        return frozenset()
+    if not isinstance(values, (list, tuple)):
+        raise ValueError(f'Expected a list of ids, got {type(values).__name__}')
+    if len(values) > limit:
+        raise ValueError(f'Too many ids: {len(values)} > {limit}')
+    return frozenset(int(value) for value in values)
+
+
+# What a socket client wants to receive. Without post_ids, user_ids and replies_to it gets every
+# comment, less the ignored ones; otherwise only the comments that match one of them.
+class Subscription(NamedTuple):
+    post_ids: FrozenSet[int] = frozenset()
+    user_ids: FrozenSet[int] = frozenset()
+    replies_to: FrozenSet[int] = frozenset()  # user ids: replies to their comments
+    ignored_users: FrozenSet[int] = frozenset()
+    ignored_posts: FrozenSet[int] = frozenset()
+
+    @staticmethod
+    def from_dict(data: Mapping[str, Any], limit: int = MAX_IDS) -> 'Subscription':
+        return Subscription(*(_parse_ids(data.get(field), limit) for field in Subscription._fields))
+
+    def is_everything(self) -> bool:
+        return len(self.post_ids) == 0 and len(self.user_ids) == 0 and len(self.replies_to) == 0
+
+    def matches(self, comment: Comment, parent_user_id: Optional[int]) -> bool:
+        if comment['user_id'] in self.ignored_users or comment['post_id'] in self.ignored_posts:
+            return False
+        return self.is_everything() \
+            or comment['post_id'] in self.post_ids \
+            or comment['user_id'] in self.user_ids \
+            or parent_user_id in self.replies_to
+
+
+class Fanout(NamedTuple):
+    skip: Set[str]  # sids that get every comment but some of these: they are in `targeted` instead
+    targeted: Dict[str, List[Comment]]  # sid -> its comments, in the message order
+
+
+# Inverted indexes from post and user ids to the sids subscribed to (or ignoring) them, so that routing
+# a message costs in proportion to the matching subscriptions rather than to the connected clients.
+# Clients without a subscription get every comment and are not indexed.
+class SubscriptionIndex:
+    def __init__(self) -> None:
+        self.subscriptions: Dict[str, Subscription] = {}
+        self._indexes: Dict[str, Dict[int, Set[str]]] = {field: defaultdict(set) for field in Subscription._fields}
+
+    def __len__(self) -> int:
+        return len(self.subscriptions)
+
+    def get(self, sid: str) -> Optional[Subscription]:
+        return self.subscriptions.get(sid)
+
+    def subscribe(self, sid: str, subscription: Subscription) -> None:
+        self.unsubscribe(sid)
+        self.subscriptions[sid] = subscription
+        for field, index in self._indexes.items():
+            for key in getattr(subscription, field):
+                index[key].add(sid)
+
+    def unsubscribe(self, sid: str) -> None:
+        subscription = self.subscriptions.pop(sid, None)
+        if subscription is None:
+            return
+        for field, index in self._indexes.items():
+            for key in getattr(subscription, field):
+                sids = index[key]
+                sids.discard(sid)
+                if len(sids) == 0:
+                    del index[key]
+
+    # Only replies_to needs the parents' authors
+    def needs_parent_users(self) -> bool:
+        return len(self._indexes['replies_to']) > 0
+
+    def _lookup(self, field: str, key: Optional[int]) -> Iterable[str]:
+        return self._indexes[field].get(key, ()) if key is not None else ()
+
+    # parent_user_ids: comment id -> the user id of its parent's author
+    def route(self, comments: List[Comment], parent_user_ids: Mapping[int, int]) -> Fanout:
+        candidates: Set[str] = set()
+        ignoring: Set[str] = set()
+        for comment in comments:
+            candidates.update(self._lookup('post_ids', comment['post_id']))
+            candidates.update(self._lookup('user_ids', comment['user_id']))
+            candidates.update(self._lookup('replies_to', parent_user_ids.get(comment['id'])))
+            ignoring.update(self._lookup('ignored_users', comment['user_id']))
+            ignoring.update(self._lookup('ignored_posts', comment['post_id']))
+
+        skip = {sid for sid in ignoring if self.subscriptions[sid].is_everything()}
+        targeted: Dict[str, List[Comment]] = {}
+        for sid in candidates | skip:
+            matched = self.filter(sid, comments, parent_user_ids)
+            if len(matched) > 0:
+                targeted[sid] = matched
+        return Fanout(skip, targeted)
+
+    def filter(self, sid: str, comments: List[Comment], parent_user_ids: Mapping[int, int]) -> List[Comment]:
+        subscription = self.subscriptions.get(sid)
+        if subscription is None:
+            return comments
+        return [c for c in comments if subscription.matches(c, parent_user_ids.get(c['id']))]
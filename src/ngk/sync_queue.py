@@ -0,0 +1,67 @@
+import os
+import socket
+from datetime import timedelta
+from typing import List, Optional, Sequence
+
+import sqlalchemy.sql as sql
+
+from ngk import config
+from ngk.schema import ScopedSession, SyncState
+
+
+def get_worker_id() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+# claimed_until is a naive UTC timestamp, like the other sync_states times
+def _db_utcnow() -> sql.ColumnElement:
+    return sql.func.timezone('UTC', sql.func.now())
+
+
+# Pending sync_states as a work queue shared by any number of fetch_posts processes.
+# A claim is a lease: claimed_until is extended by heartbeat() while the post is being
+# fetched, and a crashed worker's posts become claimable again once their lease expires.
+# Leases use the database's clock: the workers' clocks may disagree.
+class SyncQueue:
+    def __init__(self, worker_id: Optional[str] = None, lease_seconds: int = config.SYNC_LEASE_SECONDS):
+        self.worker_id: str = worker_id or get_worker_id()
+        self.lease: timedelta = timedelta(seconds=lease_seconds)
+
+    def claim(self, limit: int) -> List[int]:
+        table = SyncState.__table__
+        now = _db_utcnow()
+        with ScopedSession() as session:
+            # Uses the sync_states_pending partial index
+            candidates = sql.select([table.c.post_id]) \
+                .where(table.c.pending == True) \
+                .where(sql.or_(table.c.claimed_until == None, table.c.claimed_until < now)) \
+                .order_by(table.c.priority.desc(), table.c.post_id.desc()) \
+                .limit(limit) \
+                .with_for_update(skip_locked=True)
+            stmt = table.update() \
+                .where(table.c.post_id.in_(candidates)) \
+                .values(claimed_by=self.worker_id, claimed_until=now + self.lease) \
+                .returning(table.c.post_id, table.c.priority)
+            claimed = session.execute(stmt).fetchall()
+        claimed.sort(key=lambda row: (row.priority or 0, row.post_id), reverse=True)
+        return [row.post_id for row in claimed]
+
+    def heartbeat(self, post_ids: Sequence[int]) -> None:
+        if len(post_ids) == 0:
+            return
+        table = SyncState.__table__
+        with ScopedSession() as session:
+            session.execute(table.update()
+                            .where(table.c.post_id.in_(post_ids))
+                            .where(table.c.claimed_by == self.worker_id)
+                            .values(claimed_until=_db_utcnow() + self.lease))
+
+    def release(self, post_ids: Sequence[int]) -> None:
+        if len(post_ids) == 0:
+            return
+        table = SyncState.__table__
+        with ScopedSession() as session:
+            session.execute(table.update()
+                            .where(table.c.post_id.in_(post_ids))
+                            .where(table.c.claimed_by == self.worker_id)
+                            .values(claimed_by=None, claimed_until=None))
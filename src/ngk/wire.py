@@ -0,0 +1,173 @@
+import json
+import struct
+import zlib
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from ngk import config
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# Comment update messages between CommentsProcessor and its listeners.
+# Version 1 is the plain JSON document of Comment.to_dict() objects, without a header.
+# Version 2 starts with _HEADER: each user is sent once per message and comments are rows of COMMENT_FIELDS,
+# deltas are sent as they are.
+# Listeners decode both, so producers can be switched with WIRE_FORMAT_VERSION after the listeners are updated.
+VERSION_JSON = 1
+VERSION_COMPACT = 2
+
+CODEC_ZLIB_JSON = 1
+CODEC_MSGPACK = 2
+
+_HEADER = struct.Struct('<2sBB')  # magic, version, codec
+_MAGIC = b'NK'
+
+# `user` is an index in the message's users, `comment_list_id` is stored per post
+# `posted` is sent as it is: rebuilding it from posted_timestamp would depend on the listener's time zone
+COMMENT_FIELDS = ('id', 'id_xyz', 'parent_id', 'post_id', 'text', 'posted', 'posted_timestamp', 'user', 'source')
+
+# {'new': [comment dicts], 'updated': [comment dicts and deltas], 'published': float, 'id_pairs': [[id_ru, id_xyz]]}.
+# id_pairs are ru-xyz comment id pairs for comments that may not be in the DB yet; a version 1 message
+# has the key only if it has pairs.
+Update = Dict[str, Any]
+
+# A delta is an updated comment with only its changed fields, the fields used to route it and
+# 'delta': True. 'version' (the change time) orders the deltas of a comment.
+DELTA_KEY_FIELDS = ('id', 'post_id', 'user_id', 'parent_id')
+
+
+def make_delta(comment: Dict[str, Any], fields: Iterable[str], version: float) -> Dict[str, Any]:
+    delta = {field: comment[field] for field in DELTA_KEY_FIELDS}
+    delta.update((field, comment[field]) for field in fields)
+    delta['delta'] = True
+    delta['version'] = version
+    return delta
+
+
+def is_delta(comment: Dict[str, Any]) -> bool:
+    return comment.get('delta', False)
+
+
+# The comment with the delta applied, None if the delta is older than the comment.
+# Merging a delta into another delta gives a delta.
+def apply_delta(comment: Dict[str, Any], delta: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    if comment.get('version', 0) > delta['version']:
+        return None
+    patched = dict(comment)
+    patched.update(delta)
+    if not is_delta(comment):
+        del patched['delta']
+    return patched
+
+
+def _get_default_codec() -> int:
+    return CODEC_MSGPACK if msgpack is not None else CODEC_ZLIB_JSON
+
+
+def _pack(body: Dict[str, Any], codec: int) -> bytes:
+    if codec == CODEC_MSGPACK:
+        if msgpack is None:
+            raise ValueError('msgpack is not installed')
+        return msgpack.packb(body, use_bin_type=True)
+    if codec == CODEC_ZLIB_JSON:
+        return zlib.compress(json.dumps(body, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+    raise ValueError(f'Unknown codec {codec}')
+
+
+def _unpack(data: bytes, codec: int) -> Dict[str, Any]:
+    if codec == CODEC_MSGPACK:
+        if msgpack is None:
+            raise ValueError('msgpack is not installed')
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+    if codec == CODEC_ZLIB_JSON:
+        return json.loads(zlib.decompress(data))
+    raise ValueError(f'Unknown codec {codec}')
+
+
+def _encode_comments(comments: List[Dict[str, Any]],
+                     users: Dict[int, int],
+                     user_rows: List[List[Any]],
+                     posts: Dict[int, Optional[int]]) -> List[List[Any]]:
+    rows = []
+    for comment in comments:
+        user_index = users.get(comment['user_id'])
+        if user_index is None:
+            user_index = users[comment['user_id']] = len(user_rows)
+            user_rows.append([comment['user_id'], comment['user_name'], comment['user_avatar']])
+        posts[comment['post_id']] = comment['comment_list_id']
+        rows.append([comment[field] if field != 'user' else user_index for field in COMMENT_FIELDS])
+    return rows
+
+
+def _decode_comments(rows: List[List[Any]], user_rows: List[List[Any]], posts: Dict[int, Optional[int]]) -> List[Dict[str, Any]]:
+    comments = []
+    for row in rows:
+        comment = dict(zip(COMMENT_FIELDS, row))
+        user_id, user_name, user_avatar = user_rows[comment.pop('user')]
+        comment.update({
+            'user_id': user_id,
+            'user_name': user_name,
+            'user_avatar': user_avatar,
+            'comment_list_id': posts.get(comment['post_id']),
+        })
+        comments.append(comment)
+    return comments
+
+
+def encode(new_comments: List[Dict[str, Any]],
+           updated_comments: List[Dict[str, Any]],
+           published: float,
+           version: int = config.WIRE_FORMAT_VERSION,
+           codec: Optional[int] = None,
+           id_pairs: Optional[List[Tuple[int, int]]] = None) -> bytes:
+    if version == VERSION_JSON:
+        update: Update = {'new': new_comments, 'updated': updated_comments, 'published': published}
+        if id_pairs:
+            update['id_pairs'] = id_pairs
+        return json.dumps(update, ensure_ascii=False).encode('utf-8')
+    if version != VERSION_COMPACT:
+        raise ValueError(f'Unknown wire format version {version}')
+
+    codec = codec if codec is not None else _get_default_codec()
+    users: Dict[int, int] = {}
+    user_rows: List[List[Any]] = []
+    posts: Dict[int, Optional[int]] = {}
+    new_rows = _encode_comments(new_comments, users, user_rows, posts)
+    updated_rows = _encode_comments([c for c in updated_comments if not is_delta(c)], users, user_rows, posts)
+    body = {
+        'published': published,
+        'users': user_rows,
+        'posts': [[post_id, comment_list_id] for post_id, comment_list_id in posts.items()],
+        'new': new_rows,
+        'updated': updated_rows,
+        'deltas': [c for c in updated_comments if is_delta(c)],
+        'id_pairs': id_pairs or [],
+    }
+    return _HEADER.pack(_MAGIC, VERSION_COMPACT, codec) + _pack(body, codec)
+
+
+def get_version(data: bytes) -> Tuple[int, int]:
+    if data[:len(_MAGIC)] != _MAGIC:
+        return VERSION_JSON, 0
+    _, version, codec = _HEADER.unpack_from(data)
+    return version, codec
+
+
+def decode(data: bytes) -> Update:
+    version, codec = get_version(data)
+    if version == VERSION_JSON:
+        return json.loads(data)
+    if version != VERSION_COMPACT:
+        raise ValueError(f'Unknown wire format version {version}')
+
+    body = _unpack(data[_HEADER.size:], codec)
+    posts = {post_id: comment_list_id for post_id, comment_list_id in body['posts']}
+    return {
+        'new': _decode_comments(body['new'], body['users'], posts),
+        'updated': _decode_comments(body['updated'], body['users'], posts) + body.get('deltas', []),
+        'published': body.get('published'),
+        'id_pairs': body.get('id_pairs', []),
+    }
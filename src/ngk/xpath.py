@@ -0,0 +1,50 @@
+from typing import Any, Dict, List
+
+import lxml.etree
+
+from ngk import config
+
+
+NAMESPACES: Dict[str, str] = {
+    're': 'http://exslt.org/regular-expressions'
+}
+
+_precompiled: bool = config.XPATH_PRECOMPILED
+
+
+class Selector:
+    __slots__ = ('path', 'compiled')
+
+    def __init__(self, path: str):
+        self.path: str = path
+        self.compiled: lxml.etree.XPath = lxml.etree.XPath(path, namespaces=NAMESPACES)
+
+    def __call__(self, node: lxml.etree._Element) -> List[Any]:
+        if _precompiled:
+            return self.compiled(node)
+        else:
+            return node.xpath(self.path, namespaces=NAMESPACES)
+
+    def __repr__(self) -> str:
+        return f'Selector({self.path!r})'
+
+
+_registry: Dict[str, Selector] = {}
+
+
+def get(path: str) -> Selector:
+    selector = _registry.get(path)
+    if selector is None:
+        selector = Selector(path)
+        _registry[path] = selector
+    return selector
+
+
+# False makes every selector evaluate its string path with node.xpath() (A/B comparison)
+def set_precompiled(enabled: bool) -> None:
+    global _precompiled
+    _precompiled = enabled
+
+
+def is_precompiled() -> bool:
+    return _precompiled
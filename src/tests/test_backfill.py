@@ -0,0 +1,79 @@
+import contextlib
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Tuple
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from ngk import backfill
+from ngk.backfill import enqueue, parse_ids
+from ngk.schema import SyncState
+
+
+class FakeSession:
+    def __init__(self, returned: List[Tuple[int]]) -> None:
+        self.returned = returned
+        self.statements: List[Tuple[str, Dict[str, Any]]] = []
+
+    def execute(self, stmt: Any) -> 'FakeSession':
+        compiled = stmt.compile(dialect=postgresql.dialect())
+        self.statements.append((str(compiled), compiled.params))
+        return self
+
+    def fetchall(self) -> List[Tuple[int]]:
+        return self.returned
+
+
+def _fake_session(monkeypatch: pytest.MonkeyPatch, returned: List[Tuple[int]]) -> FakeSession:
+    fake = FakeSession(returned)
+
+    @contextlib.contextmanager
+    def scoped_session() -> Iterator[FakeSession]:
+        yield fake
+    monkeypatch.setattr(backfill, 'ScopedSession', scoped_session)
+    return fake
+
+
+class Test_parse_ids:
+    def test_ranges_and_lists(self) -> None:
+        assert parse_ids(['26440']) == [26440]
+        assert parse_ids(['1-3', '7,9-10', '2']) == [1, 2, 3, 7, 9, 10]
+
+    def test_invalid(self) -> None:
+        with pytest.raises(ValueError):
+            parse_ids(['5-1'])
+        with pytest.raises(ValueError):
+            parse_ids(['abc'])
+
+
+class Test_enqueue:
+    def test_insert_on_conflict(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        session = _fake_session(monkeypatch, [(1,), (3,)])
+        assert enqueue([1, 2, 3]) == (2, 1)
+
+        (sql, params), = session.statements
+        assert sql.startswith('INSERT INTO sync_states (post_id, pending, priority) ' +
+                              'SELECT unnest(%(post_ids)s::INTEGER[]) AS post_id, true AS pending, %(param_1)s AS priority ' +
+                              'ON CONFLICT (post_id) DO UPDATE SET pending = %(param_2)s, ')
+        # A pending post keeps its priority if it is higher
+        assert 'priority = CASE WHEN (sync_states.pending = true) ' + \
+               'THEN greatest(sync_states.priority, excluded.priority) ELSE excluded.priority END' in sql
+        assert ' WHERE ' not in sql
+        assert sql.endswith('RETURNING sync_states.post_id')
+        assert params['post_ids'] == [1, 2, 3]
+        assert params['param_1'] == SyncState.PRIORITY_DUMP
+
+    def test_skip_synced_within(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        session = _fake_session(monkeypatch, [])
+        started = datetime.utcnow()
+        assert enqueue([5, 6], skip_synced_within=timedelta(hours=2), priority=3) == (0, 2)
+
+        (sql, params), = session.statements
+        assert 'WHERE sync_states.synced IS NULL OR sync_states.synced < %(synced_1)s RETURNING' in sql
+        assert started - timedelta(hours=2) <= params['synced_1'] <= datetime.utcnow() - timedelta(hours=2)
+        assert params['param_1'] == 3
+
+    def test_nothing_to_enqueue(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        session = _fake_session(monkeypatch, [])
+        assert enqueue([]) == (0, 0)
+        assert session.statements == []
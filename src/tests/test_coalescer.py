@@ -0,0 +1,71 @@
+import threading
+from typing import Any, Dict, List, Tuple
+
+from ngk.coalescer import Coalescer
+
+
+def _comment(comment_id: int, text: str = '') -> Dict[str, Any]:
+    return {'id': comment_id, 'text': text}
+
+
+class Recorder:
+    def __init__(self) -> None:
+        self.messages: List[Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]] = []
+        self.counters: List[Dict[str, int]] = []
+        self.published = threading.Event()
+
+    def publish(self, new: List[Dict[str, Any]], updated: List[Dict[str, Any]]) -> None:
+        self.messages.append((new, updated))
+        self.published.set()
+
+
+class Test_Coalescer:
+    def test_merge(self) -> None:
+        recorder = Recorder()
+        coalescer = Coalescer(recorder.publish, 60, 100, recorder.counters.append)
+        coalescer.add([_comment(1, 'a')], [_comment(10, 'a')])
+        coalescer.add([], [_comment(1, 'b'), _comment(10, 'b')])
+        coalescer.add([_comment(2)], [])
+        coalescer.flush()
+        coalescer.flush()  # nothing left
+
+        assert len(recorder.messages) == 1
+        new, updated = recorder.messages[0]
+        assert new == [_comment(1, 'b'), _comment(2)]
+        assert updated == [_comment(10, 'b')]
+        assert recorder.counters[0]['coalesce_events'] == 3
+        assert recorder.counters[0]['coalesce_merged'] == 2
+        coalescer.close()
+
+    def test_max_batch(self) -> None:
+        recorder = Recorder()
+        coalescer = Coalescer(recorder.publish, 60, 3)
+        coalescer.add([_comment(1), _comment(2)], [])
+        assert recorder.messages == []
+        coalescer.add([], [_comment(3)])
+        assert len(recorder.messages) == 1
+        coalescer.close()
+
+    def test_window(self) -> None:
+        recorder = Recorder()
+        coalescer = Coalescer(recorder.publish, 0.05, 100)
+        coalescer.add([_comment(1)], [])
+        coalescer.add([_comment(2)], [])
+        assert recorder.published.wait(5)
+        assert recorder.messages == [([_comment(1), _comment(2)], [])]
+
+        coalescer.add([_comment(3)], [])
+        coalescer.close()
+        assert recorder.messages[-1] == ([_comment(3)], [])
+
+    def test_delta(self) -> None:
+        recorder = Recorder()
+        coalescer = Coalescer(recorder.publish, 60, 100)
+        coalescer.add([], [_comment(1, 'a')])
+        coalescer.add([], [{'id': 1, 'id_xyz': 5, 'delta': True, 'version': 1.0}])
+        coalescer.add([], [{'id': 2, 'id_xyz': 6, 'delta': True, 'version': 1.0}])
+        coalescer.close()
+        assert recorder.messages == [([], [
+            {'id': 1, 'text': 'a', 'id_xyz': 5, 'version': 1.0},
+            {'id': 2, 'id_xyz': 6, 'delta': True, 'version': 1.0},
+        ])]
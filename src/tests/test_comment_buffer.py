@@ -0,0 +1,42 @@
+from typing import Any, Dict
+
+from ngk.comment_buffer import CommentBuffer
+
+
+def _comment(comment_id: int, text: str = '') -> Dict[str, Any]:
+    return {'id': comment_id, 'text': text}
+
+
+class Test_CommentBuffer:
+    def test_since(self) -> None:
+        buffer = CommentBuffer(10)
+        buffer.add([_comment(5), _comment(3), _comment(4)])
+        assert [c['id'] for c in buffer.since(3)] == [4, 5]
+        assert buffer.since(5) == []
+        assert [c['id'] for c in buffer.since(0)] == [3, 4, 5]
+
+    def test_update_replaces(self) -> None:
+        buffer = CommentBuffer(10)
+        buffer.add([_comment(1, 'old'), _comment(2)])
+        buffer.add([_comment(1, 'new')])
+        assert len(buffer) == 2
+        assert buffer.since(0)[0]['text'] == 'new'
+
+    def test_eviction(self) -> None:
+        buffer = CommentBuffer(3)
+        buffer.add(_comment(i) for i in range(1, 6))
+        assert buffer.covered_from == 2
+        assert buffer.covers(2)
+        assert not buffer.covers(1)
+        assert buffer.since(1) is None
+        assert [c['id'] for c in buffer.since(2)] == [3, 4, 5]
+
+        # Evicted ids are not taken back
+        buffer.add([_comment(2)])
+        assert len(buffer) == 3
+
+    def test_load(self) -> None:
+        buffer = CommentBuffer(3)
+        buffer.load([_comment(10), _comment(11), _comment(12)], covered_from=9)
+        assert buffer.since(8) is None
+        assert [c['id'] for c in buffer.since(9)] == [10, 11, 12]
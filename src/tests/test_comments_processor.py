@@ -0,0 +1,143 @@
+import itertools
+from typing import Any, Dict, List, Optional, Tuple
+
+import redis
+
+from ngk import wire
+from ngk.comments_processor import CommentsProcessor
+
+
+def _parse_id(entry_id: bytes) -> Tuple[int, int]:
+    ms, _, seq = entry_id.partition(b'-')
+    return int(ms), int(seq or 0)
+
+
+# In-memory stand-in for the Redis stream commands used by CommentsProcessor
+class FakeStreamRedis:
+    def __init__(self) -> None:
+        self.entries: List[Tuple[bytes, Dict[bytes, bytes]]] = []
+        self.groups: Dict[str, Dict[str, Any]] = {}
+        self.seq = itertools.count(1)
+        self.hashes: Dict[str, Dict[str, int]] = {}
+
+    def xadd(self, key: str, fields: Dict[bytes, bytes], maxlen: int, approximate: bool = True) -> bytes:
+        entry_id = f'1700000000000-{next(self.seq)}'.encode()
+        self.entries.append((entry_id, fields))
+        del self.entries[:-maxlen]
+        return entry_id
+
+    def xgroup_create(self, key: str, group: str, id: str, mkstream: bool = False) -> None:
+        if group in self.groups:
+            raise redis.ResponseError('BUSYGROUP Consumer Group name already exists')
+        last = self.entries[-1][0] if id == '$' and self.entries else b'0-0'
+        self.groups[group] = {'last': last, 'pending': {}}
+
+    def xreadgroup(self, group: str, consumer: str, streams: Dict[str, bytes], count: int, block: Optional[int] = None) -> Any:
+        key, start = next(iter(streams.items()))
+        state = self.groups[group]
+        if start == b'>':
+            entries = [e for e in self.entries if _parse_id(e[0]) > _parse_id(state['last'])][:count]
+            if len(entries) == 0:
+                return []
+            for entry_id, _ in entries:
+                state['pending'][entry_id] = consumer
+            state['last'] = entries[-1][0]
+            return [[key.encode(), entries]]
+        stored = dict(self.entries)
+        pending = sorted((i for i, c in state['pending'].items() if c == consumer and _parse_id(i) > _parse_id(start)), key=_parse_id)
+        return [[key.encode(), [(i, stored.get(i)) for i in pending[:count]]]]
+
+    def xack(self, key: str, group: str, entry_id: bytes) -> int:
+        return 1 if self.groups[group]['pending'].pop(entry_id, None) is not None else 0
+
+    def xlen(self, key: str) -> int:
+        return len(self.entries)
+
+    # Stats.incr_many
+    def pipeline(self, transaction: bool = True) -> 'FakeStreamRedis':
+        return self
+
+    def hincrby(self, key: str, field: str, amount: int) -> None:
+        values = self.hashes.setdefault(key, {})
+        values[field] = values.get(field, 0) + amount
+
+    def execute(self) -> None:
+        pass
+
+    def xinfo_groups(self, key: str) -> List[Dict[str, Any]]:
+        return [{'name': name.encode(), 'pending': len(state['pending'])} for name, state in self.groups.items()]
+
+
+def _processor(fake: FakeStreamRedis, maxlen: int = 100, wire_version: int = wire.VERSION_JSON) -> CommentsProcessor:
+    processor = CommentsProcessor('localhost', 6379, '', 'ngk', stream=True, stream_key='comments', stream_maxlen=maxlen,
+                                  group='api', consumer='api-1', deltas=True, wire_version=wire_version)
+    processor.redis = fake  # type: ignore
+    processor.stats.redis = fake  # type: ignore
+    return processor
+
+
+def _publish(processor: CommentsProcessor, count: int) -> None:
+    for _ in range(count):
+        processor.on_comments_update([], [])
+
+
+class Test_CommentsProcessor_stream:
+    def test_resume_after_restart(self) -> None:
+        fake = FakeStreamRedis()
+        consumer = _processor(fake)
+        consumer.subscribe()
+        _publish(_processor(fake), 3)
+
+        messages = consumer.listen()
+        assert wire.decode(next(messages))['new'] == []
+        next(messages)  # acknowledges the first entry
+        # The whole batch was read: the second entry is being processed, the third one waits
+        assert consumer.get_stream_metrics()['pending'] == 2
+
+        # Restart: the unacknowledged entries come first
+        restarted = _processor(fake)
+        restarted.subscribe()
+        delivered = list(itertools.islice(restarted.listen(), 2))
+        assert len(delivered) == 2
+        assert restarted.last_delivered_id == fake.entries[-1][0]
+
+    def test_maxlen(self) -> None:
+        fake = FakeStreamRedis()
+        processor = _processor(fake, maxlen=2)
+        processor.subscribe()
+        _publish(processor, 5)
+        assert processor.get_stream_metrics()['length'] == 2
+        assert fake.hashes[processor.stats.key]['wire_encoded'] == 5
+
+
+class _Comment:
+    def to_dict(self) -> Dict[str, Any]:
+        return {'id': 1, 'id_xyz': 5, 'parent_id': None, 'post_id': 2, 'text': 'text', 'posted': None,
+                'posted_timestamp': None, 'user_id': 3, 'user_name': 'user', 'user_avatar': None,
+                'comment_list_id': 4, 'source': 0}
+
+
+class Test_CommentsProcessor_deltas:
+    def test_deltas_need_compact_format(self) -> None:
+        for wire_version, expected in ((wire.VERSION_JSON, _Comment().to_dict()),
+                                       (wire.VERSION_COMPACT, {'id': 1, 'id_xyz': 5, 'post_id': 2, 'user_id': 3, 'parent_id': None})):
+            fake = FakeStreamRedis()
+            processor = _processor(fake, wire_version=wire_version)
+            processor.on_comments_update([], [_Comment()], changed_fields=('id_xyz',))  # type: ignore
+
+            data = fake.entries[-1][1][b'data']
+            assert wire.get_version(data)[0] == wire_version
+            updated, = wire.decode(data)['updated']
+            assert wire.is_delta(updated) == (wire_version == wire.VERSION_COMPACT)
+            updated.pop('delta', None)
+            updated.pop('version', None)
+            assert updated == expected
+
+    def test_id_pairs(self) -> None:
+        fake = FakeStreamRedis()
+        processor = _processor(fake, wire_version=wire.VERSION_COMPACT)
+        processor.on_id_pairs([])
+        assert fake.entries == []
+        processor.on_id_pairs([(538001, 37001)])
+        update = wire.decode(fake.entries[-1][1][b'data'])
+        assert (update['new'], update['updated'], update['id_pairs']) == ([], [], [[538001, 37001]])
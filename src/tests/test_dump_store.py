@@ -0,0 +1,66 @@
+import multiprocessing
+import pathlib
+from datetime import datetime
+
+from ngk.dump_store import CODEC_ZLIB, DumpStore
+from ngk.dumps import iter_pages
+
+
+def _put_pages(path: pathlib.Path, writer: int) -> None:
+    with DumpStore(path, segment_max_bytes=4096, codec=CODEC_ZLIB) as store:
+        for i in range(50):
+            store.put(writer * 1000 + i, f'writer {writer}, page {i} '.encode('utf-8') * 50)
+
+
+class Test_DumpStore:
+    def test_put_and_read(self, tmp_path: pathlib.Path) -> None:
+        with DumpStore(tmp_path, codec=CODEC_ZLIB) as store:
+            first = store.put(26440, b'<html>v1</html>', datetime(2020, 4, 7, 12, 0, 0))
+            second = store.put(26440, b'<html>v2</html>', datetime(2020, 4, 7, 12, 0, 0, 500000))
+            store.put(26441, b'<html>other</html>', datetime(2020, 4, 7, 12, 0, 1))
+
+            snapshots = store.snapshots(26440)
+            assert snapshots == [first, second]
+            assert [store.read(s) for s in snapshots] == [b'<html>v1</html>', b'<html>v2</html>']
+            assert store.latest(26441) == b'<html>other</html>'
+            assert store.latest(1) is None
+
+    def test_dedupe(self, tmp_path: pathlib.Path) -> None:
+        with DumpStore(tmp_path, codec=CODEC_ZLIB) as store:
+            first = store.put(1, b'same page', datetime(2020, 4, 7, 12, 0, 0))
+            second = store.put(1, b'same page', datetime(2020, 4, 7, 13, 0, 0))
+            assert (first.segment, first.offset) == (second.segment, second.offset)
+            assert len(store.snapshots(1)) == 2
+
+    def test_rolling_segments(self, tmp_path: pathlib.Path) -> None:
+        with DumpStore(tmp_path, segment_max_bytes=64, codec=CODEC_ZLIB) as store:
+            for i in range(5):
+                store.put(i, f'page {i}'.encode('utf-8') * 20)
+        assert len(list(tmp_path.glob('segment-*.dat'))) > 1
+
+        with DumpStore(tmp_path) as store:
+            assert [page.content for page in store.iter_pages()] == [f'page {i}'.encode('utf-8') * 20 for i in range(5)]
+
+    def test_iter_pages(self, tmp_path: pathlib.Path) -> None:
+        with DumpStore(tmp_path, codec=CODEC_ZLIB) as store:
+            store.put(26440, b'page', datetime(2020, 4, 8, 3, 2, 14))
+
+        pages = list(iter_pages([tmp_path]))
+        assert [(page.name, page.dumped, page.content) for page in pages] == \
+            [('26440/2020-04-08/03-02-14.html', datetime(2020, 4, 8, 3, 2, 14), b'page')]
+
+    def test_concurrent_writers(self, tmp_path: pathlib.Path) -> None:
+        context = multiprocessing.get_context('fork')
+        processes = [context.Process(target=_put_pages, args=(tmp_path, writer)) for writer in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            assert process.exitcode == 0
+
+        with DumpStore(tmp_path) as store:
+            snapshots = list(store.iter_snapshots())
+            assert len(snapshots) == 200
+            for snapshot in snapshots:
+                writer, i = divmod(snapshot.post_id, 1000)
+                assert store.read(snapshot) == f'writer {writer}, page {i} '.encode('utf-8') * 50
@@ -0,0 +1,31 @@
+import pathlib
+import tarfile
+from datetime import datetime
+
+from ngk.dumps import iter_pages, parse_dump_time
+
+
+class Test_iter_pages:
+    def test_folders_and_archives(self, tmp_path: pathlib.Path) -> None:
+        dumps_dir = tmp_path.joinpath('dumps')
+        for day, names in (('2020-04-07', ['23-59-59.html']), ('2020-04-08', ['00-00-01.html', '12-30-00.html'])):
+            day_dir = dumps_dir.joinpath(day)
+            day_dir.mkdir(parents=True)
+            for name in names:
+                day_dir.joinpath(name).write_bytes(f'{day} {name}'.encode('utf-8'))
+
+        with tarfile.open(dumps_dir.joinpath('2020-04-07.tar.gz'), 'w:gz') as tar:
+            tar.add(dumps_dir.joinpath('2020-04-07'), arcname='2020-04-07')
+        for path in dumps_dir.joinpath('2020-04-07').iterdir():
+            path.unlink()
+        dumps_dir.joinpath('2020-04-07').rmdir()
+
+        pages = list(iter_pages([dumps_dir]))
+
+        assert [page.name for page in pages] == ['2020-04-07/23-59-59.html', '2020-04-08/00-00-01.html', '2020-04-08/12-30-00.html']
+        assert [page.content for page in pages] == [f'{page.name[:10]} {page.name[11:]}'.encode('utf-8') for page in pages]
+        assert pages[0].dumped == datetime(2020, 4, 7, 23, 59, 59)
+
+    def test_parse_dump_time(self) -> None:
+        assert parse_dump_time('dumps/2020-04-08/03-02-14.html') == datetime(2020, 4, 8, 3, 2, 14)
+        assert parse_dump_time('03-02-14.html') is None
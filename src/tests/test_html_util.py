@@ -0,0 +1,46 @@
+import lxml.etree
+
+from ngk.html_util import inner_html, normalize_text
+
+
+_EMAIL = '<a href="/cdn-cgi/l/email-protection" class="__cf_email__" data-cfemail="5a373b33361a3f223b372a363f74393537">[email&#160;protected]</a>'
+
+
+class Test_normalize_text:
+    def test_plain(self) -> None:
+        text = 'Ну это уже давно не новость.<br>\n<a href="http://govnokod.ru/">ГК</a>'
+        assert normalize_text(text) is text
+
+    def test_carriage_return(self) -> None:
+        assert normalize_text('a<br>&#13;\nb&#13;') == 'a<br>\nb'
+
+    def test_cfemail(self) -> None:
+        assert normalize_text(_EMAIL) == 'mail@example.com'
+        assert normalize_text(f'пиши на {_EMAIL}, или на {_EMAIL}.') == 'пиши на mail@example.com, или на mail@example.com.'
+
+    def test_cfemail_split_by_carriage_return(self) -> None:
+        assert normalize_text(_EMAIL.replace('data-cfemail', 'data-cf&#13;email')) == 'mail@example.com'
+
+    def test_cfemail_many(self) -> None:
+        text = ('x' + _EMAIL) * 1000
+        assert normalize_text(text) == 'xmail@example.com' * 1000
+
+
+class Test_inner_html:
+    _HTML = '<div class="entry-comment">Ссылка&#13;: <a href="/x?a=1&amp;b=2">те<b>кст</b></a> <p hidden title=\'"\'>p<a>q</a></p><br>хвост&lt; </div>'
+
+    def _node(self) -> lxml.etree._Element:
+        return lxml.etree.HTML(self._HTML).xpath('//div')[0]
+
+    def test_inner_html(self) -> None:
+        assert inner_html(self._node()) == 'Ссылка&#13;: <a href="/x?a=1&amp;b=2">те<b>кст</b></a> <p hidden title=\'"\'>p<a>q</a></p><br>хвост&lt;'
+
+    def test_drop_tags(self) -> None:
+        assert inner_html(self._node(), ('a',)) == 'Ссылка&#13;: те<b>кст</b> <p hidden title=\'"\'>pq</p><br>хвост&lt;'
+
+    def test_tree_untouched(self) -> None:
+        node = self._node()
+        serialized = lxml.etree.tostring(node)
+        inner_html(node)
+        inner_html(node, ('a',))
+        assert lxml.etree.tostring(node) == serialized
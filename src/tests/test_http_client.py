@@ -0,0 +1,106 @@
+import contextlib
+import http.server
+import threading
+from typing import Iterator, List
+
+import pytest
+
+from ngk import fetch_posts
+from ngk.http_client import HTTP_NOT_MODIFIED, HttpClient
+from ngk.schema import SyncState
+
+
+ETAG = '"v1"'
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    seen: List[dict] = []
+
+    def do_GET(self) -> None:
+        _Handler.seen.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == ETAG:
+            self.send_response(HTTP_NOT_MODIFIED)
+            self.send_header('ETag', ETAG)
+            self.end_headers()
+            return
+        body = b'<html>page</html>'
+        self.send_response(200)
+        self.send_header('ETag', ETAG)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args: object) -> None:
+        pass
+
+
+@pytest.fixture
+def server_url() -> Iterator[str]:
+    _Handler.seen = []
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}/comments'
+    server.shutdown()
+    server.server_close()
+
+
+class Test_HttpClient:
+    def test_conditional_get(self, server_url: str) -> None:
+        client = HttpClient(headers={'User-Agent': 'test'})
+
+        r = client.get(server_url)
+        assert r.status_code == 200
+        assert r.content == b'<html>page</html>'
+        assert 'If-None-Match' not in _Handler.seen[0]
+        assert 'gzip' in _Handler.seen[0]['Accept-Encoding']
+
+        r = client.get(server_url)
+        assert r.status_code == HTTP_NOT_MODIFIED
+        assert _Handler.seen[1]['If-None-Match'] == ETAG
+
+        client.forget(server_url)
+        r = client.get(server_url)
+        assert r.status_code == 200
+        assert 'If-None-Match' not in _Handler.seen[2]
+
+        stats = next(iter(client.get_stats().values()))
+        assert stats['requests'] == 3
+        assert stats['not_modified'] == 1
+        assert stats['errors'] == 0
+
+
+class Test_apply_fetched_post:
+    def test_failed_apply_forgets_validators(self, server_url: str, monkeypatch: pytest.MonkeyPatch) -> None:
+        client = HttpClient(headers={'User-Agent': 'test'})
+        monkeypatch.setattr(fetch_posts, 'get_client', lambda: client)
+        monkeypatch.setattr(fetch_posts, 'GK_URL', server_url)
+
+        class FakeSession:
+            def query(self, *args: object) -> 'FakeSession':
+                return self
+
+            def filter(self, *args: object) -> 'FakeSession':
+                return self
+
+            def one_or_none(self) -> SyncState:
+                return SyncState(post_id=1)
+
+        @contextlib.contextmanager
+        def scoped_session() -> Iterator[FakeSession]:
+            yield FakeSession()
+        monkeypatch.setattr(fetch_posts, 'ScopedSession', scoped_session)
+
+        def apply_post(*args: object) -> None:
+            raise RuntimeError('commit failed')
+        monkeypatch.setattr(fetch_posts, 'apply_post', apply_post)
+
+        r = fetch_posts.fetch_post(1)
+        assert r.status_code == 200
+        with pytest.raises(RuntimeError):
+            fetch_posts.apply_fetched_post(1, r, processor=None)  # type: ignore
+
+        r = fetch_posts.fetch_post(1)
+        assert r.status_code == 200
+        assert 'If-None-Match' not in _Handler.seen[1]
@@ -0,0 +1,27 @@
+from ngk.id_map import IdMap
+
+
+class Test_IdMap:
+    def test_bidirectional(self) -> None:
+        id_map = IdMap()
+        assert id_map.update([(538601, 100), (538606, 101)]) == 2
+        assert id_map.get_xyz(538601) == 100
+        assert id_map.get_ru(101) == 538606
+        assert id_map.get_xyz(1) is None
+        assert id_map.get_ru(10 ** 9) is None
+        assert len(id_map) == 2
+
+    def test_diff_and_remap(self) -> None:
+        id_map = IdMap()
+        id_map.update([(1, 10), (2, 20)])
+        assert id_map.diff([(1, 10), (2, 21), (3, 30)]) == [(2, 21), (3, 30)]
+
+        assert id_map.update([(2, 21)]) == 1
+        assert id_map.get_ru(20) is None
+        assert id_map.get_ru(21) == 2
+
+        # xyz id moved to another ru comment
+        id_map.update([(3, 10)])
+        assert id_map.get_xyz(1) is None
+        assert id_map.get_ru(10) == 3
+        assert len(id_map) == 2
@@ -0,0 +1,34 @@
+from typing import Any, List
+
+from sqlalchemy.dialects import postgresql
+
+from ngk import ingest
+from ngk.schema import Comment
+
+
+class FakeSession:
+    def __init__(self) -> None:
+        self.statements: List[str] = []
+
+    def execute(self, stmt: Any) -> List[Any]:
+        self.statements.append(str(stmt.compile(dialect=postgresql.dialect())))
+        return []
+
+
+class Test_upsert:
+    def test_unchanged_rows_are_not_updated(self) -> None:
+        session = FakeSession()
+        rows = [{'comment_id': 1, 'post_id': 10, 'text': 'a'}, {'comment_id': 2, 'post_id': 10, 'text': 'b'}]
+        assert ingest.upsert(session, Comment, rows, returning=True) == []  # type: ignore
+
+        sql, = session.statements
+        assert 'ON CONFLICT (comment_id) DO UPDATE SET post_id = excluded.post_id, text = excluded.text ' + \
+               'WHERE comments.post_id IS DISTINCT FROM excluded.post_id ' + \
+               'OR comments.text IS DISTINCT FROM excluded.text RETURNING comments.comment_id' in sql
+
+    def test_no_overwrite(self) -> None:
+        session = FakeSession()
+        ingest.upsert(session, Comment, [{'comment_id': 1, 'text': 'a'}], overwrite=False)  # type: ignore
+
+        sql, = session.statements
+        assert sql.endswith('ON CONFLICT (comment_id) DO NOTHING')
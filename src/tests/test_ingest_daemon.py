@@ -0,0 +1,66 @@
+import asyncio
+import pathlib
+import threading
+import time
+from typing import Any, List
+
+import pytest
+
+from ngk import fetch_posts
+from ngk.dump_store import DumpStore
+from ngk.ingest_daemon import IngestDaemon
+from ngk.rate_limit import HostRateLimiter
+
+
+class Test_IngestDaemon:
+    def test_concurrent_post_syncs(self, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+        post_ids = list(range(1, 33))
+        errors: List[BaseException] = []
+        threads = set()
+
+        def fetch_post_limited(post_id: int, limiter: HostRateLimiter, acquire: bool = True) -> Any:
+            return f'<html>{post_id}</html>'.encode()
+
+        # Everything apply_fetched_post does after the fetch but the DB: the page goes to the dump store
+        def apply_fetched_post(post_id: int, content: bytes, processor: Any, parse: Any) -> None:
+            threads.add(threading.get_ident())
+            time.sleep(0.01)
+            try:
+                fetch_posts.dump_post(post_id, content)
+            except BaseException as e:
+                errors.append(e)
+                raise
+
+        monkeypatch.setattr(fetch_posts.config, 'DUMP_STORE', True)
+        monkeypatch.setattr(fetch_posts.config, 'DUMP_STORE_DIR_PATH', tmp_path)
+        monkeypatch.setattr(fetch_posts, 'dump_store', None)
+        monkeypatch.setattr(fetch_posts, 'fetch_post_limited', fetch_post_limited)
+        monkeypatch.setattr(fetch_posts, 'apply_fetched_post', apply_fetched_post)
+
+        daemon = IngestDaemon(fetch_concurrency=8, parse_workers=1)
+        daemon.limiter = HostRateLimiter(1000, 1000)
+        monkeypatch.setattr(daemon.queue, 'release', lambda post_ids: None)
+
+        async def sync_all() -> None:
+            daemon.stopping = asyncio.Event()
+            slots = asyncio.Semaphore(daemon.fetch_concurrency)
+            tasks = []
+            for post_id in post_ids:
+                await slots.acquire()
+                daemon.in_flight.add(post_id)
+                tasks.append(asyncio.ensure_future(daemon._sync_post(post_id, slots)))
+            await asyncio.gather(*tasks)
+
+        try:
+            asyncio.run(sync_all())
+        finally:
+            daemon.io_pool.shutdown(wait=True)
+            daemon.parse_pool.shutdown(wait=True)
+            if fetch_posts.dump_store is not None:
+                fetch_posts.dump_store.close()
+
+        assert errors == []
+        assert len(threads) > 1
+        assert daemon.in_flight == set()
+        with DumpStore(tmp_path) as store:
+            assert sorted(s.post_id for s in store.iter_snapshots()) == post_ids
@@ -0,0 +1,91 @@
+import json
+import os
+import pathlib
+from typing import Any, Dict, List, Union
+
+from ngk import xpath
+from ngk.parser import ParsedComment, ParsedPost, ParsedUser
+from ngk.parser_ru import fingerprint_post, iter_sink, parse_post, parse_sink
+
+
+DATA_DIR = pathlib.Path(os.path.dirname(os.path.realpath(__file__))).joinpath('data')
+
+
+def _comment_from_dict(dictionary: Dict[str, Any]) -> ParsedComment:
+    dictionary = dict(dictionary)
+    dictionary['user'] = ParsedUser(**dictionary['user'])
+    return ParsedComment.from_dict(dictionary)
+
+
+def _read_bytes(path: Union[str, pathlib.Path]) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _read_json(path: Union[str, pathlib.Path]) -> Any:
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.loads(f.read())
+
+
+class Test_parse_sink:
+    def _comments_real(self) -> List[ParsedComment]:
+        return [_comment_from_dict(c) for c in _read_json(DATA_DIR.joinpath('ru_comments.json'))]
+
+    def test_real_comments(self) -> None:
+        html_bytes = _read_bytes(DATA_DIR.joinpath('ru_comments.html'))
+        comments_real = self._comments_real()
+
+        for streaming in (True, False):
+            comments_parsed = parse_sink(html_bytes, streaming=streaming)
+            assert comments_parsed == comments_real
+
+    def test_streaming_emits_once(self) -> None:
+        html_bytes = _read_bytes(DATA_DIR.joinpath('ru_post.html'))
+        comments_parsed = list(iter_sink(html_bytes))
+        comments_real = parse_post(html_bytes).comments
+
+        assert len(comments_parsed) == len(set(c.id_ru for c in comments_parsed))
+        assert sorted(comments_parsed, key=lambda c: c.id_ru) == sorted(comments_real, key=lambda c: c.id_ru)
+
+
+class Test_parse_post:
+    def test_real_post(self) -> None:
+        post_dict = _read_json(DATA_DIR.joinpath('ru_post.json'))
+        post_dict['user'] = ParsedUser(**post_dict['user'])
+        post_dict['comments'] = [_comment_from_dict(c) for c in post_dict['comments']]
+        post_real = ParsedPost(**post_dict)
+
+        post_parsed = parse_post(_read_bytes(DATA_DIR.joinpath('ru_post.html')))
+
+        assert post_parsed == post_real
+
+    def test_string_xpath_fallback(self) -> None:
+        html_bytes = _read_bytes(DATA_DIR.joinpath('ru_post.html'))
+        post_compiled = parse_post(html_bytes)
+
+        xpath.set_precompiled(False)
+        try:
+            post_string = parse_post(html_bytes)
+        finally:
+            xpath.set_precompiled(True)
+
+        assert post_compiled == post_string
+
+
+class Test_fingerprint_post:
+    def test_ignores_votes(self) -> None:
+        content = _read_bytes(DATA_DIR.joinpath('ru_post.html'))
+        changed = content.replace(b'<strong class="good" title="">+1</strong>', b'<strong class="good" title="">+2</strong>', 1)
+        assert changed != content
+        assert fingerprint_post(changed) == fingerprint_post(content)
+
+    def test_detects_comment_edits(self) -> None:
+        content = _read_bytes(DATA_DIR.joinpath('ru_post.html'))
+        changed = content.replace('конец'.encode('utf-8'), 'начало'.encode('utf-8'), 1)
+        assert changed != content
+        assert fingerprint_post(changed) != fingerprint_post(content)
+
+    def test_detects_whitespace_edits(self) -> None:
+        content = _read_bytes(DATA_DIR.joinpath('ru_post.html'))
+        changed = content.replace('конец'.encode('utf-8'), 'конец\n'.encode('utf-8'), 1)
+        assert fingerprint_post(changed) != fingerprint_post(content)
@@ -0,0 +1,31 @@
+from ngk.poll_controller import PollController
+
+
+class Test_PollController:
+    def test_quiet_sink_backs_off(self) -> None:
+        controller = PollController(10, 120)
+        ids = list(range(100, 120))
+        controller.observe(ids, 20, now=0)
+        for i in range(1, 10):
+            delay = controller.observe(None, now=i * 60)
+        assert delay == 120
+        assert controller.rate == 0
+
+    def test_busy_sink_speeds_up(self) -> None:
+        controller = PollController(10, 120)
+        controller.observe(range(0, 20), 20, now=0)
+        # 10 new comments per minute: keep a poll under half a page (10 comments)
+        delay = 0.0
+        for i in range(1, 30):
+            delay = controller.observe(range(i * 10, i * 10 + 20), 20, now=i * 60)
+        assert 55 < delay < 65
+
+    def test_overflow(self) -> None:
+        controller = PollController(10, 120)
+        assert not controller.is_overflow(range(0, 20))
+        controller.observe(range(0, 20), 20, now=0)
+        assert not controller.is_overflow(range(10, 30))
+        assert controller.is_overflow(range(100, 120))
+        controller.observe(range(80, 120), 20, overflow=True, now=10)
+        assert controller.delay == 10
+        assert controller.get_metrics()['overflows'] == 1
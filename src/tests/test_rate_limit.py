@@ -0,0 +1,68 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from ngk.rate_limit import HostRateLimiter, TokenBucket, parse_retry_after
+
+
+HOST = 'govnokod.ru'
+
+
+class Test_TokenBucket:
+    def test_burst_and_refill(self) -> None:
+        bucket = TokenBucket(rate=0.5, burst=2, now=100.0)
+        assert bucket.try_acquire(100.0) == 0
+        assert bucket.try_acquire(100.0) == 0
+        assert bucket.try_acquire(100.0) == pytest.approx(2.0)
+        assert bucket.try_acquire(101.0) == pytest.approx(1.0)
+        assert bucket.try_acquire(102.0) == 0
+
+    def test_refill_is_capped_by_burst(self) -> None:
+        bucket = TokenBucket(rate=1, burst=2, now=0.0)
+        assert [bucket.try_acquire(1000.0) for _ in range(3)] == [0, 0, pytest.approx(1.0)]
+
+
+class Test_HostRateLimiter:
+    def test_failures_back_off_and_slow_down(self) -> None:
+        limiter = HostRateLimiter(rate=1, burst=1, min_backoff=5, max_backoff=20)
+        assert limiter.try_acquire(HOST, now=0.0) == 0
+
+        assert limiter.on_failure(HOST, now=1.0) == 5
+        assert limiter.get_rate(HOST) == 0.5
+        assert limiter.try_acquire(HOST, now=2.0) == pytest.approx(4.0)
+        assert limiter.on_failure(HOST, now=6.0) == 10
+        assert limiter.on_failure(HOST, now=16.0) == 20
+        assert limiter.on_failure(HOST, now=36.0) == 20
+        assert limiter.get_rate(HOST) == 1 / 16  # min_rate
+        assert limiter.try_acquire(HOST, now=50.0) == pytest.approx(6.0)
+        assert limiter.try_acquire('other.host', now=50.0) == 0
+
+        limiter.on_success(HOST)
+        assert limiter.get_rate(HOST) == pytest.approx(1.25 / 16)
+        assert limiter.on_failure(HOST, now=60.0) == 5
+
+    def test_retry_after(self) -> None:
+        limiter = HostRateLimiter(rate=1, burst=1, max_backoff=60)
+        limiter.on_retry_after(HOST, 30, now=0.0)
+        assert limiter.try_acquire(HOST, now=10.0) == pytest.approx(20.0)
+        assert limiter.try_acquire(HOST, now=30.0) == 0
+        # An earlier Retry-After does not shorten the block, a long one is capped by max_backoff
+        limiter.on_retry_after(HOST, 3600, now=30.0)
+        limiter.on_retry_after(HOST, 1, now=30.0)
+        assert limiter.try_acquire(HOST, now=40.0) == pytest.approx(50.0)
+        assert limiter.get_rate(HOST) == 1
+
+
+class Test_parse_retry_after:
+    def test_seconds(self) -> None:
+        assert parse_retry_after('120') == 120.0
+        assert parse_retry_after(' 0 ') == 0.0
+        assert parse_retry_after(None) is None
+        assert parse_retry_after('soon') is None
+        assert parse_retry_after('-5') is None
+
+    def test_http_date(self) -> None:
+        now = datetime(2020, 4, 7, 12, 0, 0, tzinfo=timezone.utc)
+        assert parse_retry_after('Tue, 07 Apr 2020 12:01:30 GMT', now) == 90.0
+        assert parse_retry_after('Tue, 07 Apr 2020 11:00:00 GMT', now) == 0.0
+        assert parse_retry_after('Tue, 07 Apr 2020 14:01:30 +0200', now) == 90.0
@@ -0,0 +1,71 @@
+import pathlib
+from datetime import datetime
+from typing import Any, Dict, Iterable, List
+
+import pytest
+
+from ngk import reparse_dumps
+from ngk.dump_store import CODEC_ZLIB, DumpStore
+from ngk.parser import ParsedPost
+from ngk.reparse_dumps import DumpedPost, Stats, is_db_newer
+
+
+DATA_PATH = pathlib.Path(__file__).parent.joinpath('data')
+
+
+class Test_reparse:
+    def test_newest_page_across_sources(self, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+        content = DATA_PATH.joinpath('ru_post.html').read_bytes()
+        day_dir = tmp_path.joinpath('dumps', '2020-04-07')
+        day_dir.mkdir(parents=True)
+        day_dir.joinpath('12-00-00.html').write_bytes(content)
+        with DumpStore(tmp_path.joinpath('store'), codec=CODEC_ZLIB) as store:
+            store.put(26440, content, datetime(2020, 4, 8, 12, 0, 0))
+
+        written: List[List[ParsedPost]] = []
+        sync_states: Dict[int, Any] = {}
+
+        def write_posts(parsed_posts: Iterable[ParsedPost], stats: Stats) -> None:
+            written.append(list(parsed_posts))
+            stats.posts += len(written[-1])
+        monkeypatch.setattr(reparse_dumps, 'write_posts', write_posts)
+        monkeypatch.setattr(reparse_dumps, 'load_sync_states', lambda post_ids: sync_states)
+
+        checkpoint_path = tmp_path.joinpath('checkpoint.json')
+        day_source, store_source = tmp_path.joinpath('dumps'), tmp_path.joinpath('store')
+        # The store's page is newer: the older folder is not written over it
+        stats = reparse_dumps.reparse([store_source, day_source], 1, checkpoint_path)
+        assert (stats.pages, stats.posts, stats.skipped) == (2, 1, 1)
+        assert len(written) == 1
+        post_id = written[0][0].id_ru
+        checkpoint = reparse_dumps.load_checkpoint(checkpoint_path)
+        # The store is still written to
+        assert checkpoint.done == {str(day_dir)}
+        assert checkpoint.written == {post_id: datetime(2020, 4, 8, 12, 0, 0)}
+
+        # Resumed: the store's page was written already
+        stats = reparse_dumps.reparse([day_source, store_source], 1, checkpoint_path)
+        assert (stats.pages, stats.posts, stats.skipped) == (1, 0, 1)
+        assert len(written) == 1
+
+        sync_states[post_id] = (datetime(2020, 4, 9), 'OK', 'newer page')
+        stats = reparse_dumps.reparse([store_source], 1, tmp_path.joinpath('checkpoint2.json'))
+        assert (stats.posts, stats.skipped) == (0, 1)
+        assert len(written) == 1
+
+
+class Test_is_db_newer:
+    def test_is_db_newer(self) -> None:
+        dumped = DumpedPost(datetime(2020, 4, 8, 12, 0, 0), 'dumped page', None)  # type: ignore
+        later = datetime(2020, 4, 9)
+        assert not is_db_newer(dumped, None)
+        assert not is_db_newer(dumped, (None, None, None))
+        assert is_db_newer(dumped, (later, 'OK', 'newer page'))
+        assert is_db_newer(dumped, (later, 'Not modified', 'newer page'))
+        # The dumped page itself, re-parsed
+        assert not is_db_newer(dumped, (later, 'Not changed', 'dumped page'))
+        # Applied just after it was dumped
+        assert not is_db_newer(dumped, (datetime(2020, 4, 8, 12, 0, 5), 'OK', None))
+        # The DB copy is older than the last sync
+        assert not is_db_newer(dumped, (later, 'Parse error', 'older page'))
+        assert not is_db_newer(dumped, (datetime(2020, 4, 8), 'OK', 'older page'))
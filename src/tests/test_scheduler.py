@@ -0,0 +1,45 @@
+from ngk import scheduler
+from ngk.schema import SyncState
+
+
+NOW = 1600000000.0
+HOUR = 3600.0
+
+
+class Test_get_revisit_interval:
+    def test_hot_thread(self) -> None:
+        # 48 comments in the last day, the last one a minute ago
+        posted = [NOW - 60 - i * 0.5 * HOUR for i in range(48)]
+        assert scheduler.get_revisit_interval(posted, NOW) == scheduler.MIN_INTERVAL
+
+    def test_decays_with_quiet_time(self) -> None:
+        assert scheduler.get_revisit_interval([NOW - 10 * HOUR], NOW) == 5 * HOUR
+        assert scheduler.get_revisit_interval([NOW - 100 * HOUR], NOW) == 50 * HOUR
+        assert scheduler.get_revisit_interval([NOW - 20 * 24 * HOUR], NOW) == scheduler.MAX_INTERVAL
+
+    def test_cold_thread(self) -> None:
+        assert scheduler.get_revisit_interval([NOW - 60 * 24 * HOUR], NOW) is None
+        assert scheduler.get_revisit_interval([], NOW) is None
+
+
+class Test_schedule:
+    def test_failure_backoff(self) -> None:
+        state = SyncState(post_id=1)
+        for failures in range(1, scheduler.MAX_FAILURES + 1):
+            scheduler.schedule_failure(state)
+            assert state.failures == failures
+            assert state.next_visit is not None
+        scheduler.schedule_failure(state)
+        assert state.next_visit is None
+
+    def test_backoff_jitter(self) -> None:
+        for failures in (1, 3, 20):
+            backoff = min(scheduler.MAX_BACKOFF, scheduler.BASE_BACKOFF * 2 ** (failures - 1))
+            assert backoff / 2 <= scheduler.get_backoff(failures) <= backoff
+
+    def test_unchanged_doubles_interval(self) -> None:
+        state = SyncState(post_id=1, revisit_interval=scheduler.MIN_INTERVAL, failures=2)
+        scheduler.schedule_unchanged(state)
+        assert state.revisit_interval == 2 * scheduler.MIN_INTERVAL
+        assert state.failures == 0
+        assert state.next_visit is not None
@@ -0,0 +1,35 @@
+from typing import Any, Dict, List, Mapping, Tuple
+
+from ngk.stats import StatsBuffer
+
+
+class FakeStats:
+    def __init__(self) -> None:
+        self.calls: List[Tuple[str, Dict[str, Any]]] = []
+
+    def incr_many(self, values: Mapping[str, int]) -> None:
+        self.calls.append(('incr_many', dict(values)))
+
+    def set_many(self, values: Mapping[str, Any]) -> None:
+        self.calls.append(('set_many', dict(values)))
+
+
+class Test_StatsBuffer:
+    def test_flush(self) -> None:
+        stats = FakeStats()
+        buffer = StatsBuffer(stats)  # type: ignore
+        for _ in range(3):
+            buffer.incr_many({'wire_decoded': 1, 'wire_decoded_bytes': 100})
+            buffer.set_many({'fanout_emit_ms': 1.5})
+        buffer.incr('catch_up_db')
+        buffer.set_many({'fanout_emit_ms': 2.5})
+        assert stats.calls == []
+
+        buffer.flush()
+        assert stats.calls == [
+            ('incr_many', {'wire_decoded': 3, 'wire_decoded_bytes': 300, 'catch_up_db': 1}),
+            ('set_many', {'fanout_emit_ms': 2.5}),
+        ]
+
+        buffer.flush()
+        assert len(stats.calls) == 2
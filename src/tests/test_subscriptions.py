@@ -0,0 +1,58 @@
+from typing import Any, Dict, Optional
+
+import pytest
+
+from ngk.subscriptions import Subscription, SubscriptionIndex
+
+
+def _comment(comment_id: int, post_id: int, user_id: int, parent_id: Optional[int] = None) -> Dict[str, Any]:
+    return {'id': comment_id, 'post_id': post_id, 'user_id': user_id, 'parent_id': parent_id}
+
+
+class Test_Subscription:
+    def test_from_dict(self) -> None:
+        subscription = Subscription.from_dict({'post_ids': [1, '2'], 'ignored_users': [3]})
+        assert subscription.post_ids == {1, 2}
+        assert subscription.ignored_users == {3}
+        assert not subscription.is_everything()
+        assert Subscription.from_dict({'ignored_posts': [1]}).is_everything()
+
+        with pytest.raises(ValueError):
+            Subscription.from_dict({'post_ids': 1})
+        with pytest.raises(ValueError):
+            Subscription.from_dict({'user_ids': list(range(11))}, limit=10)
+
+
+class Test_SubscriptionIndex:
+    def test_route(self) -> None:
+        index = SubscriptionIndex()
+        index.subscribe('post', Subscription(post_ids=frozenset([10])))
+        index.subscribe('user', Subscription(user_ids=frozenset([5])))
+        index.subscribe('replies', Subscription(replies_to=frozenset([7])))
+        index.subscribe('ignoring', Subscription(ignored_users=frozenset([5])))
+        index.subscribe('other', Subscription(post_ids=frozenset([99])))
+
+        comments = [_comment(1, 10, 1), _comment(2, 20, 5), _comment(3, 30, 2, parent_id=100)]
+        fanout = index.route(comments, {3: 7})
+        assert fanout.skip == {'ignoring'}
+        assert {sid: [c['id'] for c in matched] for sid, matched in fanout.targeted.items()} == {
+            'post': [1],
+            'user': [2],
+            'replies': [3],
+            'ignoring': [1, 3],
+        }
+
+    def test_unsubscribe(self) -> None:
+        index = SubscriptionIndex()
+        index.subscribe('a', Subscription(post_ids=frozenset([10])))
+        index.subscribe('a', Subscription(post_ids=frozenset([11])))
+        assert index.route([_comment(1, 10, 1)], {}).targeted == {}
+        index.unsubscribe('a')
+        assert len(index) == 0
+        assert index.route([_comment(1, 11, 1)], {}).targeted == {}
+        assert not index.needs_parent_users()
+
+    def test_filter_unsubscribed(self) -> None:
+        index = SubscriptionIndex()
+        comments = [_comment(1, 10, 1)]
+        assert index.filter('unknown', comments, {}) == comments
@@ -0,0 +1,43 @@
+import contextlib
+from typing import Any, Iterator, List
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from ngk import sync_queue
+from ngk.sync_queue import SyncQueue
+
+
+class FakeSession:
+    def __init__(self) -> None:
+        self.statements: List[str] = []
+
+    def execute(self, stmt: Any) -> 'FakeSession':
+        self.statements.append(str(stmt.compile(dialect=postgresql.dialect())))
+        return self
+
+    def fetchall(self) -> List[Any]:
+        return []
+
+
+@pytest.fixture
+def session(monkeypatch: pytest.MonkeyPatch) -> FakeSession:
+    fake = FakeSession()
+
+    @contextlib.contextmanager
+    def scoped_session() -> Iterator[FakeSession]:
+        yield fake
+    monkeypatch.setattr(sync_queue, 'ScopedSession', scoped_session)
+    return fake
+
+
+class Test_SyncQueue:
+    def test_leases_use_database_time(self, session: FakeSession) -> None:
+        queue = SyncQueue('worker', lease_seconds=60)
+        assert queue.claim(5) == []
+        queue.heartbeat([1, 2])
+
+        claim, heartbeat = session.statements
+        assert 'sync_states.claimed_until < timezone(%(timezone_1)s, now())' in claim
+        assert 'claimed_until=(timezone(%(timezone_1)s, now()) + %(timezone_2)s)' in claim
+        assert 'claimed_until=(timezone(%(timezone_1)s, now()) + %(timezone_2)s)' in heartbeat
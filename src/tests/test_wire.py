@@ -0,0 +1,94 @@
+import json
+from typing import Any, Dict
+
+import pytest
+
+from ngk import wire
+
+
+def _comment(comment_id: int, user_id: int, post_id: int) -> Dict[str, Any]:
+    return {
+        'id': comment_id,
+        'id_xyz': comment_id - 1000 if comment_id % 2 == 0 else None,
+        'parent_id': None,
+        'post_id': post_id,
+        'text': f'Коммент {comment_id}',
+        'posted': '2020-04-07T00:25:03Z',
+        'posted_timestamp': 1586219103.0,
+        'user_id': user_id,
+        'user_name': f'user{user_id}',
+        'user_avatar': 'f' * 32,
+        'comment_list_id': post_id + 1,
+        'source': 0,
+    }
+
+
+class Test_wire:
+    def test_compact_roundtrip(self) -> None:
+        new = [_comment(538000 + i, i % 3, 26555) for i in range(50)]
+        updated = [_comment(537000, 5, 26000)]
+        data = wire.encode(new, updated, 1.5, version=wire.VERSION_COMPACT, codec=wire.CODEC_ZLIB_JSON)
+        assert wire.get_version(data) == (wire.VERSION_COMPACT, wire.CODEC_ZLIB_JSON)
+
+        decoded = wire.decode(data)
+        assert decoded['published'] == 1.5
+        for comments, comments_decoded in ((new, decoded['new']), (updated, decoded['updated'])):
+            assert len(comments) == len(comments_decoded)
+            for comment, comment_decoded in zip(comments, comments_decoded):
+                assert comment_decoded == comment
+
+        legacy = wire.encode(new, updated, 1.5, version=wire.VERSION_JSON)
+        assert len(data) < len(legacy) / 4
+
+    def test_id_pairs(self) -> None:
+        for version in (wire.VERSION_JSON, wire.VERSION_COMPACT):
+            data = wire.encode([], [], 1.0, version=version, codec=wire.CODEC_ZLIB_JSON, id_pairs=[(538001, 37001)])
+            assert wire.decode(data)['id_pairs'] == [[538001, 37001]]
+        assert 'id_pairs' not in wire.decode(wire.encode([], [], 1.0, version=wire.VERSION_JSON))
+
+    def test_legacy_json(self) -> None:
+        new = [_comment(1, 1, 1)]
+        data = wire.encode(new, [], 2.0, version=wire.VERSION_JSON)
+        assert wire.get_version(data) == (wire.VERSION_JSON, 0)
+        assert json.loads(data)['new'] == new
+        assert wire.decode(data) == {'new': new, 'updated': [], 'published': 2.0}
+
+    @pytest.mark.skipif(wire.msgpack is None, reason='msgpack is not installed')
+    def test_msgpack(self) -> None:
+        new = [_comment(2, 1, 1)]
+        data = wire.encode(new, [], 3.0, version=wire.VERSION_COMPACT, codec=wire.CODEC_MSGPACK)
+        assert wire.decode(data)['new'][0]['user_name'] == 'user1'
+
+    def test_unknown_version(self) -> None:
+        with pytest.raises(ValueError):
+            wire.encode([], [], 0, version=3)
+        data = wire.encode([], [], 0, version=wire.VERSION_COMPACT, codec=wire.CODEC_ZLIB_JSON)
+        with pytest.raises(ValueError):
+            wire.decode(data[:2] + b'\x03' + data[3:])
+
+
+class Test_delta:
+    def test_make_and_apply(self) -> None:
+        comment = _comment(538000, 1, 26555)
+        changed = dict(comment, id_xyz=123)
+        delta = wire.make_delta(changed, ['id_xyz'], version=10.0)
+        assert wire.is_delta(delta)
+        assert 'text' not in delta
+        assert delta['post_id'] == 26555
+
+        patched = wire.apply_delta(comment, delta)
+        assert patched is not None
+        assert not wire.is_delta(patched)
+        assert patched == dict(changed, version=10.0)
+
+        older = wire.make_delta(dict(comment, id_xyz=100), ['id_xyz'], version=5.0)
+        assert wire.apply_delta(patched, older) is None
+        assert wire.is_delta(wire.apply_delta(older, delta))
+
+    def test_compact_deltas(self) -> None:
+        full = _comment(538000, 1, 26555)
+        delta = wire.make_delta(dict(_comment(538001, 1, 26555), id_xyz=5), ['id_xyz'], version=1.0)
+        data = wire.encode([], [full, delta], 1.0, version=wire.VERSION_COMPACT, codec=wire.CODEC_ZLIB_JSON)
+        updated = wire.decode(data)['updated']
+        assert len(updated) == 2
+        assert updated[1] == delta
@@ -12,6 +12,7 @@ return false;`;
 const SEARCH_LIMIT = 50;
 const COMMENTS_LIMIT = 20;
 const RESPONSE_PARENTS_LIMIT = 15;
+const IO_PROTOCOL = 2;  // ngk.api.IO_PROTOCOL
 
 function SocketTransport(socket) {
     this.socket = socket;
@@ -23,13 +24,22 @@ function SocketTransport(socket) {
         if (newMaxId != this.maxId || this.maxIdDirty) {
             this.maxId = newMaxId;
             if (this.isSocketIoConnected) {
-                this.socket.emit('set_max_id', newMaxId, (function() { this.maxIdDirt = false; }).bind(this));
+                this.socket.emit('set_max_id', newMaxId, (function() { this.maxIdDirty = false; }).bind(this));
             } else {
                 this.maxIdDirty = true;
             }
         }
     };
 
+    // See ngk.subscriptions.Subscription: post_ids, user_ids, replies_to, ignored_users, ignored_posts
+    this.subscription = undefined;
+    this.subscribe = function(subscription) {
+        this.subscription = subscription;
+        if (this.isSocketIoConnected) {
+            this.socket.emit('subscribe', subscription);
+        }
+    };
+
     this.disconnect = function() {
         this.socket.disconnect();
     }
@@ -37,10 +47,18 @@ function SocketTransport(socket) {
     this.onConnect = undefined;
     this.onDisconnect = undefined;
     this.onData = undefined;
+    this.onGap = undefined;
 
     socket.on('connect', (function() {
         console.log('Websockets connected.');
         this.isSocketIoConnected = true;
+        // Before anything else: the server sends 'comments_update' instead of the legacy 'new_comments'
+        this.socket.emit('set_protocol', IO_PROTOCOL);
+        if (this.subscription) {
+            this.socket.emit('subscribe', this.subscription);
+        }
+        // The server replies with the comments missed while disconnected
+        this.maxIdDirty = true;
         this.setMaxId(this.maxId);
         if (this.onConnect) {
             this.onConnect();
@@ -55,13 +73,26 @@ function SocketTransport(socket) {
         }
     }).bind(this));
     
-    socket.on('new_comments', (function(data) {
+    this.handleData = function(data) {
         if (this.onData) {
             this.onData(data);
         } else {
             console.log('New_comments arrived, but no dataHandler was set', data);
         }
+    };
+
+    // The server relays the published update as a JSON string: {new: [...], updated: [...]}.
+    // After a reconnect, truncated: the server sent only the newest of the missed comments
+    socket.on('comments_update', (function(message) {
+        let update = JSON.parse(message);
+        if (update.truncated && this.onGap) {
+            this.onGap();
+        }
+        this.handleData(update.new.concat(update.updated));
     }).bind(this));
+
+    // Legacy list of full comments, sent until the server gets set_protocol
+    socket.on('new_comments', this.handleData.bind(this));
 }
 
 function formatDate(timestamp_seconds) {
@@ -509,6 +540,15 @@ app.controller('CommentsController', function($scope, $http, $sce, $interval, $r
         });
     }
 
+    // Some missed comments were not sent: drop the loaded ones and load them again
+    function reloadComments() {
+        $scope.comments = [];
+        seen = {};
+        minDate = null;
+        limit = COMMENTS_LIMIT;
+        loadComments(null);
+    }
+
     function loadNewComments() {
         if (!transport.isSocketIoConnected) {
             loadComments(null);
@@ -529,13 +569,48 @@ app.controller('CommentsController', function($scope, $http, $sce, $interval, $r
     $scope.ignorePost = ignorePost.bind(undefined, $route);
     $scope.unignoreEverything = unignoreEverything.bind(undefined, $route);
 
+    // A delta has only the changed fields of a comment (see ngk.wire.make_delta)
+    function applyDelta(delta) {
+        if (seen[delta.id] !== undefined) {
+            let comment = $scope.comments[seen[delta.id]];
+            if ((comment.version || 0) > delta.version)
+                return;
+            for (let field in delta) {
+                if (field == 'text') {
+                    comment.text = $sce.trustAsHtml(delta.text);
+                } else if (field != 'delta') {
+                    comment[field] = delta[field];
+                }
+            }
+        } else if ($scope.comments.length > 0 && delta.id > $scope.comments[$scope.comments.length - 1].id) {
+            // Within the loaded comments, but not here: load the full comment
+            $http({
+                method: 'GET',
+                url: '/api/comments',
+                params: {id: delta.id},
+                headers: {
+                    'Accept': undefined,  // Fuck Chrome
+                }
+            }).then(function(response) {
+                for (let comment of response.data) {
+                    insertComment(comment);
+                }
+                updateViewedComments();
+            });
+        }
+    }
+
     function socketIOHandler(data) {
         const ignoredUsers = getIgnoredUsers();
         const ignoredPosts = getIgnoredPosts();
         let maxId = transport.maxId;
         for (let comment of data) {
             if (!(comment.user_id in ignoredUsers) && !(comment.post_id in ignoredPosts)) {
-                insertComment(comment);
+                if (comment.delta) {
+                    applyDelta(comment);
+                } else {
+                    insertComment(comment);
+                }
             }
             if (comment.id > maxId) {
                 maxId = comment.id;
@@ -550,7 +625,13 @@ app.controller('CommentsController', function($scope, $http, $sce, $interval, $r
     }
 
     loadComments(null);
+    // The server drops ignored comments; socketIOHandler still checks in case the lists change in another tab
+    transport.subscribe({
+        ignored_users: Object.keys(getIgnoredUsers()).map(Number),
+        ignored_posts: Object.keys(getIgnoredPosts()).map(Number),
+    });
     transport.onData = socketIOHandler;
+    transport.onGap = reloadComments;
 
     let updateTimer = $interval(loadNewComments, 5000);
     let infScroll = throttle(function() {
@@ -730,6 +811,15 @@ app.controller('RepliesController', function($scope, $http, $sce, $interval, $ro
         });
     }
 
+    // Some missed comments were not sent: drop the loaded ones and load them again
+    function reloadComments() {
+        $scope.comments = [];
+        seen = {};
+        minDate = null;
+        limit = COMMENTS_LIMIT;
+        loadComments(null);
+    }
+
     function loadNewComments() {
         loadComments(null);
     }